@@ -10,6 +10,174 @@ __all__ = ('ParkingClassifier', 'ParkingClassification')
 MODE_FILE = os.path.join(os.path.dirname(__file__), "modes.cf")
 RULE_FILE = os.path.join(os.path.dirname(__file__), "rules.cf")
 
+#
+# Literal prefiltering.
+#
+# Almost every rule can only match text that contains some fixed
+# string (its "anchor"): for instance, old_sedoparking_ad cannot match
+# unless "sedoparking.com" appears somewhere in the page.  Looking for
+# all the anchors with str.__contains__ is far cheaper than running
+# every rule's regex over the whole page, and only the handful of
+# rules whose anchors are present need to be run at all.
+#
+# The search is done on a lowercased copy of the page.  Rules are
+# matched case-insensitively, so this finds every anchor the regex
+# engine would, except for two characters whose lowercase forms are
+# not the ASCII letters they case-fold to; FOLD_FIXUPS takes care of
+# those.
+
+FOLD_FIXUPS = (("\u017f", "s"),     # LATIN SMALL LETTER LONG S
+               ("i\u0307", "i"))    # lowercase of U+0130, dotted capital I
+
+MIN_ANCHOR = 3
+
+def fold(text):
+    """Lowercase TEXT for anchor searches."""
+    text = text.lower()
+    if not text.isascii():
+        for old, new in FOLD_FIXUPS:
+            text = text.replace(old, new)
+    return text
+
+def _skip_group(pattern, i):
+    """PATTERN[i] is '(' or '['; return the index just past the
+       matching close bracket."""
+    depth = 0
+    in_class = False
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+        if depth == 0 and not in_class:
+            return i
+    raise ValueError("unbalanced brackets in rule: " + pattern)
+
+def _parse_quantifier(pattern, i):
+    """If there is a quantifier at PATTERN[i], return (min, end),
+       where min is its minimum repeat count and end is the index just
+       past it.  Otherwise return (1, i)."""
+    if i >= len(pattern):
+        return 1, i
+    c = pattern[i]
+    if c in '?*+':
+        lo, i = (0 if c in '?*' else 1), i + 1
+    elif c == '{':
+        m = re.match(r"\{(\d*)(?:,\d*)?\}", pattern[i:])
+        if not m:
+            return 1, i
+        lo, i = int(m.group(1) or 0), i + m.end()
+    else:
+        return 1, i
+    # lazy or possessive suffix
+    if i < len(pattern) and pattern[i] in '?+':
+        i += 1
+    return lo, i
+
+def _literal(pattern):
+    """If PATTERN matches only one fixed string, return that string
+       (lowercased), otherwise None."""
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern) and \
+           not pattern[i+1].isalnum():
+            out.append(pattern[i+1])
+            i += 2
+        elif c.isalnum() or c in '"\'/:;,=&%!<>_@~-':
+            out.append(c)
+            i += 1
+        else:
+            return None
+        if _parse_quantifier(pattern, i)[1] != i:
+            return None
+    return "".join(out).lower()
+
+def rule_anchors(pattern):
+    """Find fixed strings, at least one of which must occur
+       (case-insensitively) in any text that PATTERN matches.  Returns
+       a tuple of strings, or None if no usable anchor could be found,
+       in which case the rule has to be run on every text.
+
+       Only the top level of the pattern is examined: runs of literal
+       characters, and groups that are alternations of literals.  Any
+       construct not understood here just ends the current run."""
+    runs = []
+    alternations = []
+    run = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        literal = None
+        alts = None
+        if c == '\\':
+            if pattern[i+1].isalnum():
+                # \s, \b, \A, \1 and the like
+                pass
+            else:
+                literal = pattern[i+1]
+            i += 2
+        elif c in '([':
+            end = _skip_group(pattern, i)
+            if c == '(':
+                body = pattern[i+1:end-1]
+                if body.startswith('?:'):
+                    body = body[2:]
+                if not body.startswith('?'):
+                    alts = [_literal(a) for a in body.split('|')]
+                    if None in alts:
+                        alts = None
+            i = end
+        elif c == '|':
+            # top-level alternation; nothing is required
+            return None
+        elif c == '#':
+            # verbose-mode comment; too hard to be sure of
+            return None
+        elif c.isspace():
+            # ignored in verbose mode
+            i += 1
+            continue
+        elif c in '.^$':
+            i += 1
+        else:
+            literal = c
+            i += 1
+
+        lo, i = _parse_quantifier(pattern, i)
+        if literal is not None and lo > 0:
+            run.append(literal)
+        if literal is None or lo != 1:
+            if run:
+                runs.append("".join(run).lower())
+            run = []
+        if alts is not None and lo > 0:
+            alternations.append(tuple(alts))
+
+    if run:
+        runs.append("".join(run).lower())
+
+    # Prefer the candidate whose shortest string is longest, as the
+    # most selective.
+    candidates = [(r,) for r in runs] + alternations
+    best = max(candidates, key=lambda a: min(map(len, a)), default=None)
+    if best is None or min(map(len, best)) < MIN_ANCHOR:
+        return None
+    return best
+
 class Ruleset:
     """A set of tagged regular expressions."""
     def __init__(self, label, ruledict, only=None):
@@ -19,15 +187,47 @@ class Ruleset:
             for tag, rule in ruledict.items()
             if (only is None or tag in only)
         ]
+        self.anchors = [
+            rule_anchors(rule)
+            for tag, rule in ruledict.items()
+            if (only is None or tag in only)
+        ]
 
-    def test(self, text):
+    def test(self, text, present=None, pos=0, endpos=None):
         """Match TEXT against all of the regular expressions in this
-           set, and return the tags of those that matched."""
+           set, and return the tags of those that matched.  If PRESENT
+           is supplied, it is the set of anchors that occur in TEXT
+           (see Prefilter), and rules whose anchors are all absent
+           are skipped.  POS and ENDPOS restrict the search to part
+           of TEXT, as for regex.search."""
+        if endpos is None:
+            endpos = len(text)
+        if present is None:
+            return [
+                tag for tag, rule in self.rules
+                if rule.search(text, pos, endpos)
+            ]
         return [
-            tag for tag, rule in self.rules
-            if rule.search(text)
+            tag for (tag, rule), anchors in zip(self.rules, self.anchors)
+            if (anchors is None or not present.isdisjoint(anchors))
+            and rule.search(text, pos, endpos)
         ]
 
+class Prefilter:
+    """The combined anchors of several Rulesets.  Each distinct
+       anchor is searched for only once per text."""
+    def __init__(self, rulesets):
+        self.anchors = sorted(set(
+            anchor
+            for ruleset in rulesets
+            for anchors in ruleset.anchors if anchors is not None
+            for anchor in anchors))
+
+    def scan(self, text, pos=0, endpos=None):
+        """Return the set of anchors that occur in TEXT[pos:endpos]."""
+        folded = fold(text[pos:endpos])
+        return frozenset(a for a in self.anchors if a in folded)
+
 ParkingClassification = collections.namedtuple(
     "ParkingClassification",
     ("is_parked", "rules_matched"))
@@ -37,25 +237,55 @@ class ParkingClassifier:
        site.
 
        Methods:
-           isParked(html)  - returns a named 2-tuple:
+           isParked(html, text=None)
+                           - returns a named 2-tuple:
                              (is_parked, rules_matched)
                              is_parked is true or false, and rules is
                              the list of all rules that matched.
+           window_report() - summary of window_stats, as a string.
 
        Properties:
            mode            - The classification mode (see modes.cf)
-           size_limit      - Pages larger than this are assumed not
-                             to be parked.
+           size_limit      - Only this many characters of a page are
+                             examined: the first (size_limit - tail_limit)
+                             and the last tail_limit.  Pages no longer
+                             than this are examined in full.  None means
+                             always examine the whole page.
+           tail_limit      - See size_limit.
+           scan_text       - If true, and isParked is given the page's
+                             extracted text, examine that instead of
+                             the HTML.
+           audit_window    - If true, pages which are too large to be
+                             examined in full are examined in full
+                             anyway, and window_stats records how
+                             often that would have changed the result.
+                             For tuning size_limit and tail_limit.
+           window_stats    - Counter of pages classified ('pages'),
+                             pages too large to examine in full
+                             ('windowed'), and, when auditing, pages
+                             where a full examination would have found
+                             a different verdict ('verdict_changed') or
+                             only different rules ('rules_changed').
     """
 
     def __init__(self, *,
                  mode='full',
                  size_limit=200000,
+                 tail_limit=50000,
+                 scan_text=False,
+                 audit_window=False,
                  modefile=MODE_FILE,
                  rulefile=RULE_FILE):
 
-        self.mode       = mode
-        self.size_limit = size_limit
+        if size_limit is not None and not (0 <= tail_limit <= size_limit):
+            raise ValueError("tail_limit must be between 0 and size_limit")
+
+        self.mode         = mode
+        self.size_limit   = size_limit
+        self.tail_limit   = tail_limit
+        self.scan_text    = scan_text
+        self.audit_window = audit_window
+        self.window_stats = collections.Counter()
 
         mode_p = configparser.ConfigParser(interpolation=None,
                                            allow_no_value=True)
@@ -82,8 +312,11 @@ class ParkingClassifier:
         self.strong_rules = Ruleset("strong", rule_p["strong"], only)
         self.weak_rules_1 = Ruleset("weak1",  rule_p["weak1"],  only)
         self.weak_rules_2 = Ruleset("weak2",  rule_p["weak2"],  only)
+        self.prefilter    = Prefilter((self.strong_rules,
+                                       self.weak_rules_1,
+                                       self.weak_rules_2))
 
-    def isParked(self, html):
+    def isParked(self, html, text=None):
         """Test whether HTML appears to be a webpage from a parked domain.
            Returns a 2-tuple (is_parked, rules_matched) where is_parked
            is a boolean and rules_matched is the list of all rules
@@ -92,12 +325,59 @@ class ParkingClassifier:
            A page is considered to be parked if it matches at least
            one of the "strong" rules, or if it matches at least one of
            the "weak1" rules _and_ at least one of the "weak2" rules.
+
+           TEXT, if supplied, is the text content extracted from HTML;
+           it is examined instead of HTML if the scan_text property is
+           true.  Either way, only the head and tail of long documents
+           are examined; see size_limit.
         """
+        doc = text if (self.scan_text and text is not None) else html
+        windows = self._windows(doc)
+        result = self._classify(doc, windows)
+
+        self.window_stats['pages'] += 1
+        if len(windows) > 1:
+            self.window_stats['windowed'] += 1
+            if self.audit_window:
+                full = self._classify(doc, [(0, len(doc))])
+                if full.is_parked != result.is_parked:
+                    self.window_stats['verdict_changed'] += 1
+                elif set(full.rules_matched) != set(result.rules_matched):
+                    self.window_stats['rules_changed'] += 1
+
+        return result
+
+    def window_report(self):
+        st = self.window_stats
+        report = "{} pages, {} windowed".format(st['pages'], st['windowed'])
+        if self.audit_window:
+            report += (", full scan changes verdict of {}, rules of {}"
+                       .format(st['verdict_changed'], st['rules_changed']))
+        return report
+
+    def _windows(self, doc):
+        """Return a list of (pos, endpos) pairs: the parts of DOC
+           to be examined."""
+        n = len(doc)
+        if self.size_limit is None or n <= self.size_limit:
+            return [(0, n)]
+        return [(0, self.size_limit - self.tail_limit),
+                (n - self.tail_limit, n)]
 
-        m_strong = self.strong_rules.test(html)
-        m_weak1  = self.weak_rules_1.test(html)
-        m_weak2  = self.weak_rules_2.test(html)
+    def _classify(self, doc, windows):
+        # Collect the tags matched in any window as sets, then list
+        # them in ruleset order, so that the result does not depend on
+        # which window a rule happened to match in.
+        rulesets = (self.strong_rules, self.weak_rules_1, self.weak_rules_2)
+        found = [set() for _ in rulesets]
+        for pos, endpos in windows:
+            present = self.prefilter.scan(doc, pos, endpos)
+            for matched, rules in zip(found, rulesets):
+                matched.update(rules.test(doc, present, pos, endpos))
 
+        m_strong, m_weak1, m_weak2 = (
+            [tag for tag, _ in rules.rules if tag in matched]
+            for matched, rules in zip(found, rulesets))
         is_parked = bool(m_strong) or (bool(m_weak1) and bool(m_weak2))
         rules_matched = m_strong + m_weak1 + m_weak2
         rules_matched.sort()
@@ -142,23 +422,39 @@ def testParkedSample(content_dir, filename, classifier, outf):
     errors.sort()
     outf.write("{} (mode {!r}): {}\n"
                "OK: {}\n"
+               "Window: {}\n"
                "Errors:\n  {}\n\n"
                .format(filename, classifier.mode, interval, ok,
+                       classifier.window_report(),
                        "\n   ".join(errors)))
 
     return (not errors)
 
-def testRules(mode, outf, samples):
-    classifier = ParkingClassifier(mode=mode)
+def testRules(mode, outf, samples, **kwargs):
+    classifier = ParkingClassifier(mode=mode, audit_window=True, **kwargs)
     success = True
     for i in range(0, len(samples), 2):
+        classifier.window_stats.clear()
         success = testParkedSample(
             samples[i], samples[i+1], classifier, outf) and success
     return success
 
 if __name__ == '__main__':
+    import argparse
     import sys
+    ap = argparse.ArgumentParser(
+        description="Test the parking rules against labeled samples.")
+    ap.add_argument("--size-limit", type=int, default=200000,
+                    help="Scan window size (0 for no limit).")
+    ap.add_argument("--tail-limit", type=int, default=50000,
+                    help="Part of the scan window taken from the end.")
+    ap.add_argument("samples", nargs="+", metavar="CONTENT_DIR LABELS",
+                    help="Directory of NNN.html files, and a CSV file "
+                    "labeling them.")
+    args = ap.parse_args()
     success = True
     for mode in ('full', 'balanced', 'min'):
-        success = testRules(mode, sys.stdout, sys.argv[1:]) and success
+        success = testRules(mode, sys.stdout, args.samples,
+                            size_limit=args.size_limit or None,
+                            tail_limit=args.tail_limit) and success
     sys.exit(0 if success else 1)
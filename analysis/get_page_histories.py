@@ -6,6 +6,7 @@ import collections
 import concurrent.futures
 import csv
 import datetime
+import functools
 import glob
 import hashlib
 import itertools
@@ -26,8 +27,11 @@ import zlib
 
 import aiohttp
 import aiopg
+import psycopg2
 from werkzeug.http import parse_options_header
 
+from wayback_cache import WaybackCache, request_url
+
 import word_seg
 
 #
@@ -108,6 +112,19 @@ def sync_wait(coro, loop):
     loop.run_until_complete(task)
     return task.result()
 
+def chain_future(dests, src):
+    """Done-callback for the future SRC: give each of the futures DESTS
+       the same outcome.  Use with functools.partial."""
+    for dest in dests:
+        if dest.done():
+            continue
+        if src.cancelled():
+            dest.cancel()
+        elif src.exception() is not None:
+            dest.set_exception(src.exception())
+        else:
+            dest.set_result(src.result())
+
 # This appears in the official documentation for asyncio, but is not
 # actually defined by the library!  But it _is_ defined by the
 # externally maintained backport to 3.3 (and that's where this code
@@ -309,6 +326,113 @@ class work_buffer:
                 if not fut.done():
                     fut.set_exception(e)
 
+class HTTPSessionPool:
+    """A bounded pool of aiohttp client sessions.  aiohttp has serious
+       bugs if you allow one session any concurrent connections (mixing
+       up which data is supposed to be transmitted on which channel), so
+       each session is given a single connection and concurrency comes
+       from having SIZE of them.  No more than PER_HOST sessions are
+       lent out for the same host at once.
+
+       with HTTPSessionPool(size=8, per_host=4, headers={...}) as pool:
+           with (yield from pool.session("web.archive.org")) as client:
+               ...do something with client...
+
+    """
+
+    class _lease:
+        def __init__(self, pool, sess, slots):
+            self._pool  = pool
+            self._sess  = sess
+            self._slots = slots
+
+        def __enter__(self):
+            return self._sess
+
+        def __exit__(self, *dontcare):
+            self._pool.n_busy -= 1
+            self._pool.idle.put_nowait(self._sess)
+            self._slots.release()
+            return False
+
+    def __init__(self, *, size, per_host=None, headers=None,
+                 conn_timeout=5, loop=None):
+        self.loop     = loop or asyncio.get_event_loop()
+        self.size     = size
+        self.per_host = per_host or size
+        self.n_busy   = 0
+        self.slots    = {}
+        self.idle     = asyncio.Queue(loop=self.loop)
+        self.sessions = [
+            aiohttp.ClientSession(
+                headers   = headers,
+                connector = aiohttp.TCPConnector(
+                    loop          = self.loop,
+                    conn_timeout  = conn_timeout,
+                    limit         = 1,
+                    use_dns_cache = True))
+            for _ in range(size)
+        ]
+        for sess in self.sessions:
+            self.idle.put_nowait(sess)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        for sess in self.sessions:
+            sess.close()
+        return False
+
+    @asyncio.coroutine
+    def session(self, host):
+        slots = self.slots.get(host)
+        if slots is None:
+            slots = asyncio.Semaphore(self.per_host, loop=self.loop)
+            self.slots[host] = slots
+
+        yield from slots.acquire()
+        try:
+            sess = yield from self.idle.get()
+        except:
+            slots.release()
+            raise
+
+        self.n_busy += 1
+        return self._lease(self, sess, slots)
+
+class Histogram:
+    """Counts of observations in power-of-two buckets; the first
+       bucket holds everything up to and including LOW."""
+
+    def __init__(self, label, unit, low):
+        self.label  = label
+        self.unit   = unit
+        self.low    = low
+        self.counts = collections.Counter()
+        self.n      = 0
+        self.total  = 0
+
+    def add(self, value):
+        self.n     += 1
+        self.total += value
+        bucket = 0
+        limit  = self.low
+        while value > limit:
+            limit  *= 2
+            bucket += 1
+        self.counts[bucket] += 1
+
+    def report(self, fp):
+        if not self.n:
+            return
+        fp.write("{}: {} observations, mean {:.3f} {}\n"
+                 .format(self.label, self.n, self.total / self.n, self.unit))
+        for bucket in range(max(self.counts) + 1):
+            fp.write("  <= {:>12g} {}: {:>8}\n"
+                     .format(self.low * 2**bucket, self.unit,
+                             self.counts[bucket]))
+
 def find_le(a, x):
     """Find the rightmost value of A which is less than or equal to X."""
     i = bisect.bisect_right(a, x)
@@ -585,68 +709,204 @@ def intern_pruned_segmented(cur, hash, pruned, segmented):
         b" RETURNING id")
     return (yield from cur.fetchone())[0]
 
+# Set-based counterpart of the above, for interning many rows at once.
+# ROWS maps each key to the SQL text of a row constructor for COLUMNS,
+# whose first entry is the key column (which must have a unique
+# index).  Rows already present are left alone.  Returns a dict
+# mapping each key to a tuple of the RETURNING columns.
+@asyncio.coroutine
+def intern_many(cur, table, columns, rows, returning=(b"id",)):
+    key   = columns[0]
+    cols  = b", ".join(columns)
+    ret   = b", ".join(returning)
+    t_ret = b", ".join(b"t." + c for c in returning)
+
+    result  = {}
+    pending = rows
+    passes  = 0
+    while pending:
+        yield from cur.execute(
+            b"WITH input (" + cols + b") AS"
+            b"      (VALUES " + b",".join(pending.values()) + b"),"
+            b"     ins AS (INSERT INTO " + table + b" (" + cols + b")"
+            b"             SELECT * FROM input"
+            b"             ON CONFLICT (" + key + b") DO NOTHING"
+            b"             RETURNING " + key + b", " + ret + b")"
+            b" SELECT " + key + b", " + ret + b" FROM ins"
+            b" UNION ALL"
+            b" SELECT t." + key + b", " + t_ret +
+            b"   FROM " + table + b" t, input i"
+            b"  WHERE t." + key + b" = i." + key)
+        for row in (yield from cur.fetchall()):
+            k = row[0]
+            if isinstance(k, memoryview):
+                k = bytes(k)
+            result[k] = row[1:]
+
+        # A row inserted by a concurrent transaction that commits
+        # after this statement's snapshot was taken is neither inserted
+        # by us nor visible to us; asking again will find it.
+        pending = { k: v for k, v in pending.items() if k not in result }
+        passes += 1
+        if pending and passes >= 5:
+            raise RuntimeError("intern_many: {} rows of {} went missing"
+                               .format(len(pending), table.decode("ascii")))
+
+    return result
+
+# Historical pages are recorded this many at a time.
+PAGES_PER_BATCH = 50
+
 class Database:
-    def __init__(self, dbname, loop=None, **cargs):
-        self.loop   = loop or asyncio.get_event_loop()
+    """A pool of CONNECTIONS database connections.  Canned queries
+       borrow one connection each, so independent tasks can use the
+       database in parallel.  Time spent waiting for a connection, and
+       time spent holding one, are tallied for progress reports.
+
+       Historical pages are recorded BATCH_SIZE at a time, with a
+       constant number of queries per batch; set BATCH_SIZE to 1 to
+       record each page as it comes in."""
+
+    class _lease:
+        def __init__(self, pool, conn, cur):
+            self._pool  = pool
+            self._conn  = conn
+            self._cur   = cur
+            self._start = pool.loop.time()
+
+        def __enter__(self):
+            return self._cur
+
+        def __exit__(self, *dontcare):
+            self._pool.busy_time += self._pool.loop.time() - self._start
+            self._pool.idle.put_nowait((self._conn, self._cur))
+            return False
+
+    def __init__(self, dbname, loop=None, connections=1,
+                 batch_size=PAGES_PER_BATCH, **cargs):
+        self.loop        = loop or asyncio.get_event_loop()
         # aiopg offers asynchrony, but _not_ concurrency; only one query
-        # can be executing per connection.
-        self.dblock = asyncio.Lock(loop=loop)
-        self.dbname = dbname
-        self.cargs  = cargs
-        self.db     = None
-        self.cur    = None
+        # can be executing per connection.  Hence the pool.
+        self.dbname      = dbname
+        self.cargs       = cargs
+        self.nconns      = connections
+        self.conns       = []
+        self.idle        = asyncio.Queue(loop=self.loop)
+        self.batch_size  = batch_size
+        self.hpbuf       = work_buffer(self._record_historical_pages,
+                                       batch_size, label="hpages",
+                                       loop=self.loop)
+
+        self.n_leases    = 0
+        self.n_retries   = 0
+        self.wait_time   = 0.0
+        self.busy_time   = 0.0
+        self.started     = None
 
     def __enter__(self):
-        self.db = sync_wait(aiopg.connect(dbname=self.dbname, loop=self.loop,
-                                          **self.cargs),
-                            loop=self.loop)
-        self.cur = sync_wait(self.db.cursor(), loop=self.loop)
+        for _ in range(self.nconns):
+            db = sync_wait(aiopg.connect(dbname=self.dbname, loop=self.loop,
+                                         **self.cargs),
+                           loop=self.loop)
+            cur = sync_wait(db.cursor(), loop=self.loop)
+            self.conns.append(db)
+            self.idle.put_nowait((db, cur))
+        self.started = self.loop.time()
         return self
 
     def __exit__(self, *dontcare):
-        self.db.close()
+        self.loop.run_until_complete(
+            self.loop.create_task(
+                self.hpbuf.drain()))
+        for db in self.conns:
+            db.close()
         return False
 
-    # Canned queries
     @asyncio.coroutine
-    def get_translations(self):
-        with (yield from self.dblock):
-            cur = self.cur
-            yield from cur.execute("SELECT lang, word, engl FROM translations")
+    def connection(self):
+        """Borrow a connection from the pool:
 
-            translations = collections.defaultdict(dict)
-            words = 0
-            while True:
-                block = yield from cur.fetchmany(10000)
-                if not block: break
-                for lang, word, engl in block:
-                    translations[lang][word] = engl
-                    words += 1
+           with (yield from self.connection()) as cur:
+               ...
+        """
+        start = self.loop.time()
+        conn, cur = yield from self.idle.get()
+        self.n_leases  += 1
+        self.wait_time += self.loop.time() - start
+        return self._lease(self, conn, cur)
 
-                status("loading translations... {} languages {} words"
-                       .format(len(translations), words))
+    @asyncio.coroutine
+    def transaction(self, body, *args, retry_conflicts=True):
+        """Call BODY(cur, *ARGS) inside a transaction on a borrowed
+           connection, and return its result.  Connections are in
+           autocommit mode otherwise.  Two transactions interning the
+           same value at the same time will collide on a unique index;
+           the loser is rolled back and retried, and will find the
+           winner's row the second time around.  If RETRY_CONFLICTS
+           is false, such an IntegrityError is raised at once, and
+           only serialization failures and deadlocks are retried."""
+        retryable = (psycopg2.extensions.TransactionRollbackError,)
+        if retry_conflicts:
+            retryable += (psycopg2.IntegrityError,)
+        attempts = 0
+        while True:
+            with (yield from self.connection()) as cur:
+                yield from cur.execute("BEGIN")
+                try:
+                    rv = yield from body(cur, *args)
+                    yield from cur.execute("COMMIT")
+                    return rv
+
+                except retryable:
+                    yield from cur.execute("ROLLBACK")
+                    attempts += 1
+                    self.n_retries += 1
+                    if attempts >= 5:
+                        raise
+
+                except:
+                    yield from cur.execute("ROLLBACK")
+                    raise
+
+    def stats(self):
+        """Return (mean wait for a connection in seconds, fraction of
+           connection-time in use)."""
+        mean_wait = self.wait_time / self.n_leases if self.n_leases else 0
+        elapsed = (self.loop.time() - self.started) * self.nconns
+        return mean_wait, (self.busy_time / elapsed if elapsed > 0 else 0)
 
-            status("loading translations... {} languages {} words"
-                   .format(len(translations), words), done=True)
-            return translations
+    # Canned queries
+    @asyncio.coroutine
+    def lookup_translations(self, lang, words):
+        """Return a dictionary mapping each of WORDS (in LANG) that has
+           a recorded translation to that translation."""
+        with (yield from self.connection()) as cur:
+            yield from cur.execute(
+                "SELECT word, engl FROM translations"
+                " WHERE lang = %s AND word = ANY(%s)",
+                (lang, list(words)))
+            return dict((yield from cur.fetchall()))
 
     @asyncio.coroutine
     def record_translations(self, lang, translations):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
 
             query = b"INSERT INTO translations (lang, word, engl) VALUES"
-            values = b",".join(
-                (yield from cur.mogrify("(%s,%s,%s)", (lang, word, engl)))
-                for word, engl in translations
-                if len(word) < WORD_LENGTH_LIMIT)
+            # Not a generator expression: 'yield from' is not allowed
+            # inside one.
+            values = []
+            for word, engl in translations:
+                if len(word) < WORD_LENGTH_LIMIT:
+                    values.append((yield from cur.mogrify(
+                        "(%s,%s,%s)", (lang, word, engl))))
+            if not values:
+                return
 
-            yield from cur.execute(query + values)
+            yield from cur.execute(query + b",".join(values))
 
     @asyncio.coroutine
     def load_date_range_for_url(self, urlid):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute("""
                 SELECT MIN(COALESCE(
                            SUBSTRING(u.meta->>'timestamp' FOR 10)::DATE,
@@ -662,8 +922,7 @@ class Database:
 
     @asyncio.coroutine
     def load_page_availability(self, archive, urlid):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute(
                 "SELECT snapshots FROM collection.historical_page_availability"
                 " WHERE archive = %s AND url = %s",
@@ -675,8 +934,7 @@ class Database:
 
     @asyncio.coroutine
     def record_page_availability(self, archive, urlid, snapshots):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute("""
                 SELECT MIN(COALESCE(
                              SUBSTRING(u.meta->>'timestamp' FOR 10)::DATE,
@@ -699,8 +957,7 @@ class Database:
 
     @asyncio.coroutine
     def note_page_processed(self, archive, urlid):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute("""
                 UPDATE collection.historical_page_availability
                    SET processed = true
@@ -710,8 +967,7 @@ class Database:
 
     @asyncio.coroutine
     def load_page_topics(self, archive, urlid):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute(
                 "SELECT archive_time, topic_tag"
                 "  FROM historical_pages"
@@ -727,8 +983,7 @@ class Database:
 
     @asyncio.coroutine
     def load_page_texts(self, trans, archive, urlid):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute(
                 "SELECT h.archive_time, ep.segmented"
                 "  FROM collection.historical_pages h,"
@@ -755,8 +1010,7 @@ class Database:
 
     @asyncio.coroutine
     def load_contemp_capture(self, trans, urlid, access_time):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute("""
                 SELECT ep.segmented
                   FROM collection.captured_pages cp,
@@ -777,66 +1031,221 @@ class Database:
 
     @asyncio.coroutine
     def record_historical_page(self, archive, date, ec):
-        with (yield from self.dblock):
-            cur = self.cur
-            docid, eid = yield from intern_html_content(
-                cur, ec.ohash, ec.original)
-
-            if not eid:
-                cid = yield from intern_blob(
-                    cur, b"analysis.extracted_plaintext", b"plaintext",
-                    ec.chash, ec.content, False)
-                pid = yield from intern_pruned_segmented(
-                    cur, ec.phash, ec.pruned, ec.segmtd)
-                hid = yield from intern_blob(
-                    cur, b"analysis.extracted_headings", b"headings",
-                    ec.hhash, ec.heads, True)
-                lid = yield from intern_blob(
-                    cur, b"analysis.extracted_urls", b"urls",
-                    ec.lhash, ec.links, True)
-                rid = yield from intern_blob(
-                    cur, b"analysis.extracted_urls", b"urls",
-                    ec.rhash, ec.rsrcs, True)
-                did = yield from intern_blob(
-                    cur, b"analysis.extracted_dom_stats", b"dom_stats",
-                    ec.dhash, ec.domst, True)
-
-                yield from cur.execute(
-                    "INSERT INTO analysis.extracted_content_ov"
-                    " (content_len, raw_text, pruned_text, links, resources,"
-                    "  headings, dom_stats)"
-                    " VALUES (%s, %s, %s, %s, %s, %s, %s)"
-                    " RETURNING id",
-                    (ec.olen, cid, pid, lid, rid, hid, did))
-                eid = (yield from cur.fetchone())[0]
-
-                yield from cur.execute(
-                    "UPDATE collection.capture_html_content"
-                    "   SET extracted = %s,"
-                    "       is_parked = %s,"
-                    "       parking_rules_matched = %s"
-                    " WHERE id = %s",
-                    (eid, ec.parked, ec.prules, docid))
-
-            uid, _ = yield from add_url_string(cur, ec.url)
-            if ec.redir_url == ec.url:
-                ruid = uid
-            else:
-                ruid, _ = yield from add_url_string(cur, ec.redir_url)
+        if self.batch_size <= 1:
+            yield from self.transaction(self._record_historical_page,
+                                        archive, date, ec)
+        else:
+            yield from self.hpbuf.put((archive, date, ec))
+
+    @asyncio.coroutine
+    def _record_historical_pages(self, batch):
+        """work_buffer worker for record_historical_page."""
+        try:
+            yield from self.transaction(self._record_historical_page_batch,
+                                        [item for item, _ in batch],
+                                        retry_conflicts=False)
+        except Exception:
+            # Something in the batch is unacceptable to the database,
+            # or it collided with a concurrent insert.  Retrying the
+            # whole batch would most likely fail the same way, so fall
+            # back to one page at a time at once; only the bad pages
+            # fail, and collisions are retried page by page.
+            for (archive, date, ec), fut in batch:
+                try:
+                    yield from self.transaction(self._record_historical_page,
+                                                archive, date, ec)
+                    if not fut.done():
+                        fut.set_result(None)
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_result(None)
 
-            sid = yield from add_http_status(cur, ec.status, ec.reason)
+    @asyncio.coroutine
+    def _record_historical_page_batch(self, cur, pages):
+        # Raw HTML first; pages whose HTML was already extracted need
+        # nothing else interned.
+        html_rows = {}
+        for _, _, ec in pages:
+            if ec.ohash not in html_rows:
+                html_rows[ec.ohash] = yield from cur.mogrify(
+                    "(%s,%s)", (ec.ohash, ec.original))
+        html = yield from intern_many(
+            cur, b"collection.capture_html_content",
+            (b"hash", b"content"), html_rows, (b"id", b"extracted"))
+
+        to_extract = collections.OrderedDict()
+        for _, _, ec in pages:
+            docid, eid = html[ec.ohash]
+            if eid is None and docid not in to_extract:
+                to_extract[docid] = ec
+
+        if to_extract:
+            plain_rows = {}
+            head_rows  = {}
+            url_rows   = {}
+            dom_rows   = {}
+            for ec in to_extract.values():
+                if ec.chash not in plain_rows:
+                    plain_rows[ec.chash] = (
+                        (yield from cur.mogrify("(%s,", (ec.chash,))) +
+                        quote_utf8_as_text(ec.content) + b",NULL::jsonb)")
+                # The pruned text may be the same as the full text;
+                # if so, make sure the segmentation is recorded.
+                plain_rows[ec.phash] = (
+                    (yield from cur.mogrify("(%s,", (ec.phash,))) +
+                    quote_utf8_as_text(ec.pruned) + b"," +
+                    quote_utf8_as_text(ec.segmtd) + b"::jsonb)")
+                for rows, h, blob in ((head_rows, ec.hhash, ec.heads),
+                                      (url_rows,  ec.lhash, ec.links),
+                                      (url_rows,  ec.rhash, ec.rsrcs),
+                                      (dom_rows,  ec.dhash, ec.domst)):
+                    if h not in rows:
+                        rows[h] = (
+                            (yield from cur.mogrify("(%s,", (h,))) +
+                            quote_utf8_as_text(blob) + b"::jsonb)")
+
+            plain = yield from intern_many(
+                cur, b"analysis.extracted_plaintext",
+                (b"hash", b"plaintext", b"segmented"), plain_rows)
+            heads = yield from intern_many(
+                cur, b"analysis.extracted_headings",
+                (b"hash", b"headings"), head_rows)
+            urls = yield from intern_many(
+                cur, b"analysis.extracted_urls",
+                (b"hash", b"urls"), url_rows)
+            doms = yield from intern_many(
+                cur, b"analysis.extracted_dom_stats",
+                (b"hash", b"dom_stats"), dom_rows)
+
+            # Allocate the new extracted_content_ov ids up front, so
+            # that each can be tied back to its HTML without relying
+            # on the order of INSERT ... RETURNING.
+            yield from cur.execute(
+                "SELECT nextval(pg_get_serial_sequence("
+                "         'analysis.extracted_content_ov', 'id'))"
+                "  FROM generate_series(1, %s)", (len(to_extract),))
+            eids = [row[0] for row in (yield from cur.fetchall())]
+
+            ov_rows  = []
+            upd_rows = []
+            for eid, (docid, ec) in zip(eids, to_extract.items()):
+                ov_rows.append((yield from cur.mogrify(
+                    "(%s,%s,%s,%s,%s,%s,%s,%s)",
+                    (eid, ec.olen, plain[ec.chash][0], plain[ec.phash][0],
+                     urls[ec.lhash][0], urls[ec.rhash][0],
+                     heads[ec.hhash][0], doms[ec.dhash][0]))))
+                upd_rows.append((yield from cur.mogrify(
+                    "(%s,%s,%s::boolean,%s::text[])",
+                    (docid, eid, ec.parked, ec.prules))))
 
             yield from cur.execute(
-                "INSERT INTO collection.historical_pages"
-                " (url, archive, archive_time, result, redir_url,"
-                "  html_content, is_parked)"
-                " VALUES (%s,%s,%s,%s,%s,%s,%s)",
-                (uid, archive, date, sid, ruid, docid, ec.parked))
+                b"INSERT INTO analysis.extracted_content_ov"
+                b" (id, content_len, raw_text, pruned_text, links, resources,"
+                b"  headings, dom_stats)"
+                b" VALUES " + b",".join(ov_rows))
+            yield from cur.execute(
+                b"UPDATE collection.capture_html_content h"
+                b"   SET extracted = v.eid,"
+                b"       is_parked = v.parked,"
+                b"       parking_rules_matched = v.prules"
+                b"  FROM (VALUES " + b",".join(upd_rows) + b")"
+                b"    AS v(id, eid, parked, prules)"
+                b" WHERE h.id = v.id")
+
+        url_rows = {}
+        for _, _, ec in pages:
+            for u in (ec.url, ec.redir_url):
+                u = canon_url_syntax(u)
+                if u not in url_rows:
+                    url_rows[u] = yield from cur.mogrify("(%s)", (u,))
+        url_ids = yield from intern_many(
+            cur, b"collection.url_strings", (b"url",), url_rows)
+
+        # There are only ever a handful of distinct statuses in a batch.
+        sids = {}
+        for _, _, ec in pages:
+            if (ec.status, ec.reason) not in sids:
+                sids[(ec.status, ec.reason)] = yield from add_http_status(
+                    cur, ec.status, ec.reason)
+
+        hp_rows = []
+        for archive, date, ec in pages:
+            hp_rows.append((yield from cur.mogrify(
+                "(%s,%s,%s,%s,%s,%s,%s)",
+                (url_ids[canon_url_syntax(ec.url)][0], archive, date,
+                 sids[(ec.status, ec.reason)],
+                 url_ids[canon_url_syntax(ec.redir_url)][0],
+                 html[ec.ohash][0], ec.parked))))
+        yield from cur.execute(
+            b"INSERT INTO collection.historical_pages"
+            b" (url, archive, archive_time, result, redir_url,"
+            b"  html_content, is_parked)"
+            b" VALUES " + b",".join(hp_rows))
+
+    @asyncio.coroutine
+    def _record_historical_page(self, cur, archive, date, ec):
+        docid, eid = yield from intern_html_content(
+            cur, ec.ohash, ec.original)
+
+        if not eid:
+            cid = yield from intern_blob(
+                cur, b"analysis.extracted_plaintext", b"plaintext",
+                ec.chash, ec.content, False)
+            pid = yield from intern_pruned_segmented(
+                cur, ec.phash, ec.pruned, ec.segmtd)
+            hid = yield from intern_blob(
+                cur, b"analysis.extracted_headings", b"headings",
+                ec.hhash, ec.heads, True)
+            lid = yield from intern_blob(
+                cur, b"analysis.extracted_urls", b"urls",
+                ec.lhash, ec.links, True)
+            rid = yield from intern_blob(
+                cur, b"analysis.extracted_urls", b"urls",
+                ec.rhash, ec.rsrcs, True)
+            did = yield from intern_blob(
+                cur, b"analysis.extracted_dom_stats", b"dom_stats",
+                ec.dhash, ec.domst, True)
+
+            yield from cur.execute(
+                "INSERT INTO analysis.extracted_content_ov"
+                " (content_len, raw_text, pruned_text, links, resources,"
+                "  headings, dom_stats)"
+                " VALUES (%s, %s, %s, %s, %s, %s, %s)"
+                " RETURNING id",
+                (ec.olen, cid, pid, lid, rid, hid, did))
+            eid = (yield from cur.fetchone())[0]
+
+            yield from cur.execute(
+                "UPDATE collection.capture_html_content"
+                "   SET extracted = %s,"
+                "       is_parked = %s,"
+                "       parking_rules_matched = %s"
+                " WHERE id = %s",
+                (eid, ec.parked, ec.prules, docid))
+
+        uid, _ = yield from add_url_string(cur, ec.url)
+        if ec.redir_url == ec.url:
+            ruid = uid
+        else:
+            ruid, _ = yield from add_url_string(cur, ec.redir_url)
+
+        sid = yield from add_http_status(cur, ec.status, ec.reason)
+
+        yield from cur.execute(
+            "INSERT INTO collection.historical_pages"
+            " (url, archive, archive_time, result, redir_url,"
+            "  html_content, is_parked)"
+            " VALUES (%s,%s,%s,%s,%s,%s,%s)",
+            (uid, archive, date, sid, ruid, docid, ec.parked))
 
     @asyncio.coroutine
     def record_historical_page_topic(self, archive, date, urlid, topic):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute(
                 "UPDATE collection.historical_pages"
                 "   SET topic_tag = %s"
@@ -846,8 +1255,7 @@ class Database:
     @asyncio.coroutine
     def get_unprocessed_pages(self, session):
         status("counting completely unprocessed pages...")
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
             yield from cur.execute(
                 "    SELECT DISTINCT u.url, s.url"
                 "      FROM collection.urls u"
@@ -869,8 +1277,7 @@ class Database:
 
     @asyncio.coroutine
     def get_incomplete_pages(self, session):
-        with (yield from self.dblock):
-            cur = self.cur
+        with (yield from self.connection()) as cur:
 
             # status("recording date ranges of interest...")
             # yield from cur.execute("""
@@ -1020,9 +1427,9 @@ def extract_page(url, redir_url, status, reason, ctype, data):
 
     extr = html_extractor.ExtractedContent(redir_url, data, ctype, charset)
     lang = cld2.detect(extr.text_pruned, want_chunks=True)
-    segmented = [ { "l": c[0].code,
-                    "t": list(word_seg.segment(c[0].code, c[1])) }
-                  for c in lang.chunks ]
+    chunks = [ (c[0].code, c[1]) for c in lang.chunks ]
+    segmented = [ { "l": l, "t": t }
+                  for (l, _), t in zip(chunks, word_seg.segment_many(chunks)) ]
 
     original = zlib.compress(extr.original)
     olen     = len(extr.original)
@@ -1054,64 +1461,91 @@ def extract_page(url, redir_url, status, reason, ctype, data):
               parked, prules)
 
 class WaybackMachine:
-    def __init__(self, executor, http_client, rate, loop=None):
+    def __init__(self, executor, http_pool, rate, loop=None):
         self.executor    = executor
-        self.http_client = http_client
+        self.http_pool   = http_pool
         self.rate        = rate
         self.loop        = loop or asyncio.get_event_loop()
         self.errlog      = open("wayback-machine-errors.log", "at")
+        self.cache       = WaybackCache.from_environ()
+        self.host        = urllib.parse.urlsplit(
+            request_url("https://web.archive.org/")).netloc
         self.n_errors    = 0
         self.n_requests  = 0
         self.session     = None
-        self.serializer  = asyncio.Lock(loop=self.loop)
+
+        self.latency     = Histogram("wayback request latency", "s", 0.05)
+        self.size        = Histogram("wayback response size", "bytes", 1024)
 
     def __enter__(self):
         return self
 
     def __exit__(self, *dontcare):
         self.errlog.close()
+        if self.cache is not None:
+            self.cache.close()
+        self.latency.report(sys.stdout)
+        self.size.report(sys.stdout)
 
     @asyncio.coroutine
     def get_unique_snapshots_of_url(self, url):
         """Retrieve a list of all available snapshots of URL."""
+        text = None
+        if self.cache is not None:
+            text = yield from self.cache.run_in_executor(
+                self.loop, self.cache.get_cdx, url)
+
         backoff = 1
-        while True:
-            yield from self.rate()
-            resp = None
-            try:
-                self.n_requests += 1
-                resp = yield from self.http_client.get(
-                    "https://web.archive.org/cdx/search/cdx",
-                    params = { "url": url,
-                               "collapse": "digest",
-                               "fl": "original,timestamp,statuscode" })
-                if resp.status == 200:
-                    text = yield from resp.text()
-                    yield from resp.release()
-                    break
+        while text is None:
+            with (yield from self.http_pool.session(self.host)) as client:
+                yield from self.rate()
+                resp = None
+                try:
+                    self.n_requests += 1
+                    client.cookies.clear()
+                    started = self.loop.time()
+                    resp = yield from client.get(
+                        request_url("https://web.archive.org/cdx/search/cdx"),
+                        params = { "url": url,
+                                   "collapse": "digest",
+                                   "fl": "original,timestamp,statuscode" })
+                    if resp.status == 200:
+                        text = yield from resp.text()
+                        yield from resp.release()
+                        self.latency.add(self.loop.time() - started)
+                        self.size.add(len(text))
+                        if self.cache is not None:
+                            yield from self.cache.run_in_executor(
+                                self.loop, self.cache.put_cdx, url, text)
+                        break
+
+                    if resp.status == 403:
+                        # We get this when the Machine has snapshots but
+                        # can't show them to us because of robots.txt.
+                        self.errlog.write("GET /cdx/search/cdx?{} = {} {}\n"
+                                          .format(url, resp.status,
+                                                  resp.reason))
+                        yield from resp.release()
+                        if self.cache is not None:
+                            yield from self.cache.run_in_executor(
+                                self.loop, self.cache.put_cdx, url, "")
+                        return []
 
-                if resp.status == 403:
-                    # We get this when the Machine has snapshots but can't
-                    # show them to us because of robots.txt.
-                    self.errlog.write("GET /cdx/search/cdx?{} = {} {}\n"
-                                      .format(url, resp.status, resp.reason))
-                    yield from resp.release()
-                    return []
+                    if resp.status != 503:
+                        self.errlog.write("GET /cdx/search/cdx?{} = {} {}\n"
+                                          .format(url, resp.status,
+                                                  resp.reason))
+                        self.errlog.flush()
 
-                if resp.status != 503:
-                    self.errlog.write("GET /cdx/search/cdx?{} = {} {}\n"
-                                      .format(url, resp.status, resp.reason))
+                except Exception:
+                    traceback.print_exc(file=self.errlog)
                     self.errlog.flush()
 
-            except Exception:
-                traceback.print_exc(file=self.errlog)
-                self.errlog.flush()
-
-            if resp is not None:
-                try:
-                    yield from resp.release()
-                except Exception:
-                    resp.close()
+                if resp is not None:
+                    try:
+                        yield from resp.release()
+                    except Exception:
+                        resp.close()
 
             self.n_errors += 1
             self.session.progress()
@@ -1182,21 +1616,23 @@ class WaybackMachine:
         resp = None
         resp_released = False
         try:
-            # Since we can use only one concurrent connection, we must also
-            # have only one task issuing queries at a time, or N-1 of the
-            # tasks are likely to time out before they even get a chance to
-            # submit their query.  The ordering here is critical: first
-            # serialization, then rate-limiting, then the timeout.
-            with (yield from self.serializer):
+            # Each task must have a connection of its own before its
+            # timeout starts, or tasks waiting for a free connection are
+            # likely to time out before they even get a chance to submit
+            # their query.  The ordering here is critical: first a
+            # connection from the pool, then rate-limiting, then the
+            # timeout.
+            with (yield from self.http_pool.session(self.host)) as client:
                 yield from self.rate()
                 with aio_timeout(600, loop=self.loop):
                     # The Wayback Machine replays Set-Cookie headers, and
                     # since all requests are going to the same origin, they
                     # accumulate until we hit the request size limit.
                     # It doesn't ever _need_ us to send cookies, AFAICT.
-                    self.http_client.cookies.clear()
+                    client.cookies.clear()
+                    started = self.loop.time()
                     resp = yield from \
-                        self.http_client.get(query, allow_redirects=False)
+                        client.get(request_url(query), allow_redirects=False)
                     if 300 <= resp.status <= 399:
                         location = resp.headers.get('location', '')
                         ctype = None
@@ -1230,6 +1666,8 @@ class WaybackMachine:
                         resp.close()
 
                     resp_released = True
+                    self.latency.add(self.loop.time() - started)
+                    self.size.add(len(data) if data is not None else 0)
 
                     # It may or may not be appropriate to retry requests
                     # that provoke HTTP errors directly from the wayback
@@ -1261,6 +1699,12 @@ class WaybackMachine:
 
     @asyncio.coroutine
     def get_page_http_request(self, query):
+        if self.cache is not None:
+            data = yield from self.cache.run_in_executor(
+                self.loop, self.cache.get_page, query)
+            if data is not None:
+                return data
+
         backoff = 1
         while True:
             self.n_requests += 1
@@ -1268,6 +1712,9 @@ class WaybackMachine:
 
             data = yield from self.get_page_do_http_request(query)
             if data is not None:
+                if self.cache is not None:
+                    yield from self.cache.run_in_executor(
+                        self.loop, self.cache.put_page, query, *data)
                 return data
 
             self.n_errors += 1
@@ -1375,13 +1822,96 @@ WORDS_PER_POST = 128
 # we set the limit well below the threshold that triggers (b).
 WORD_LENGTH_LIMIT = 750
 
+# Each language's work_buffer looks up this many words in the database
+# at once; those that aren't there are sent to Google, WORDS_PER_POST
+# at a time.
+WORDS_PER_LOOKUP = 1000
+
+# Translations of this many words, per language, are kept in memory.
+TRANSLATION_CACHE_WORDS = 100000
+
+# The words that the database doesn't have are packed into posts
+# POSTS_PER_BATCH at a time.
+POSTS_PER_BATCH = 4
+
 TRANSLATE_URL = \
     "https://www.googleapis.com/language/translate/v2"
 GET_LANGUAGES_URL = \
     "https://www.googleapis.com/language/translate/v2/languages"
 
+def pack_posts(words, max_words=WORDS_PER_POST, max_chars=CHARS_PER_POST):
+    """Divide WORDS among as few translation requests as possible,
+       first-fit decreasing by length, and return a list of lists of
+       words.  No word may be longer than MAX_CHARS."""
+    posts = []
+    for word in sorted(words, key=len, reverse=True):
+        l = len(word)
+        for post in posts:
+            if len(post[1]) < max_words and post[0] + l <= max_chars:
+                break
+        else:
+            post = [0, []]
+            posts.append(post)
+        post[0] += l
+        post[1].append(word)
+    return [post[1] for post in posts]
+
+class TranslationCache:
+    """Translations to English of the MAX_WORDS most recently used
+       words in each language.  Which languages are cached is not
+       limited, but there are only a few hundred."""
+
+    def __init__(self, max_words=TRANSLATION_CACHE_WORDS):
+        self.max_words = max_words
+        self.langs     = collections.defaultdict(collections.OrderedDict)
+        self.n_hits    = 0
+        self.n_misses  = 0
+
+    def __len__(self):
+        return sum(len(tdict) for tdict in self.langs.values())
+
+    def get(self, lang, word):
+        """The cached translation of WORD from LANG, or None."""
+        tdict = self.langs[lang]
+        engl = tdict.get(word)
+        if engl is None:
+            self.n_misses += 1
+        else:
+            self.n_hits += 1
+            tdict.move_to_end(word)
+        return engl
+
+    def peek(self, lang, word):
+        """Like get, but doesn't count as a use of WORD."""
+        return self.langs[lang].get(word)
+
+    def put(self, lang, word, engl):
+        tdict = self.langs[lang]
+        tdict[word] = engl
+        tdict.move_to_end(word)
+        if len(tdict) > self.max_words:
+            tdict.popitem(last=False)
+
+    def hit_rate(self):
+        n = self.n_hits + self.n_misses
+        return self.n_hits / n if n else 0
+
 class GoogleTranslate:
-    def __init__(self, db, http_client, rate, loop=None):
+    """Translate words to English.  Recent translations are kept in a
+       TranslationCache; older ones are looked up in the database, in
+       batches, and only words that aren't there either are sent to
+       Google (and then recorded in the database).
+
+       Each word still being looked up or translated has one future,
+       in self.pending, which all the documents that want it share.
+       Words bound for Google are gathered from all lookup batches in
+       their language, and packed into as few posts as will hold
+       them.  Up to CONCURRENT_POSTS posts may be outstanding at once.
+    """
+
+    def __init__(self, db, http_client, rate, loop=None,
+                 cache_words=TRANSLATION_CACHE_WORDS,
+                 concurrent_posts=1):
         self.db           = db
         self.http_client  = http_client
         self.rate         = rate
@@ -1390,10 +1920,21 @@ class GoogleTranslate:
         self.n_errors     = 0
         self.n_requests   = 0
         self.langs        = None
-        self.translations = None
+        self.translations = TranslationCache(cache_words)
+        self.n_db_hits    = 0
+        self.n_db_misses  = 0
+        self.lookup_time  = Histogram("translation lookup latency", "s",
+                                      0.005)
         self.prepare_lock = asyncio.Lock(loop=self.loop)
-        self.serializer   = asyncio.Lock(loop=self.loop)
+        self.serializer   = asyncio.Semaphore(concurrent_posts,
+                                          loop=self.loop)
         self.tbufs        = {}
+        self.pbufs        = {}
+        self.pending      = {}
+        self.n_coalesced  = 0
+        self.n_posts      = 0
+        self.n_posted     = 0
+        self.n_chars      = 0
         self.session      = None
 
     def __enter__(self):
@@ -1404,20 +1945,29 @@ class GoogleTranslate:
             self.loop.create_task(
                 self.drain_translations()))
         self.errlog.close()
+        self.report(sys.stdout)
         return False
 
+    def report(self, fp):
+        fp.write("translations: {} cached, {:.1%} cache hits; "
+                 "{} found in database, {} not\n"
+                 .format(len(self.translations),
+                         self.translations.hit_rate(),
+                         self.n_db_hits, self.n_db_misses))
+        fp.write("translations: {} requests shared; {} posts to Google, "
+                 "{:.1f} words and {:.0f} chars per post\n"
+                 .format(self.n_coalesced, self.n_posts,
+                         self.n_posted / (self.n_posts or 1),
+                         self.n_chars / (self.n_posts or 1)))
+        self.lookup_time.report(fp)
+
     @asyncio.coroutine
     def prepare(self):
         # Many coroutines may call this simultaneously.  Only load
-        # translatable languages and old translations once.
+        # translatable languages once.
         with (yield from self.prepare_lock):
             if self.langs is not None: return
 
-            # Load the translations _first_, because the moment we
-            # assign to .langs, translate_segmented will think we're
-            # done.
-            self.translations = (yield from self.db.get_translations())
-
             yield from self.rate()
             self.n_requests += 1
             resp = yield from self.http_client.get(
@@ -1495,6 +2045,9 @@ class GoogleTranslate:
     def get_translations_internal(self, lang, words):
         backoff = 5
         with (yield from self.serializer):
+            self.n_posts  += 1
+            self.n_posted += len(words)
+            self.n_chars  += sum(len(word) for word in words)
             while True:
                 yield from self.rate()
                 self.n_requests += 1
@@ -1509,10 +2062,10 @@ class GoogleTranslate:
                             "NFKC", x["translatedText"]).casefold()
                          for x in blob["data"]["translations"])))
 
-            self.n_errors += 1
-            self.session.progress()
-            yield from asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 60)
+                self.n_errors += 1
+                self.session.progress()
+                yield from asyncio.sleep(backoff, loop=self.loop)
+                backoff = min(backoff * 2, 60)
 
     @asyncio.coroutine
     def get_translations_worker(self, batch, *, lang):
@@ -1525,52 +2078,75 @@ class GoogleTranslate:
 
         sleepers = collections.defaultdict(list)
         for word, fut in batch:
-            engl = self.translations[lang].get(word)
+            engl = self.translations.peek(lang, word)
             if engl is not None:
                 fut.set_result(engl)
             else:
                 sleepers[word].append(fut)
 
-        # Do not waste resources translating nonwords and URLs;
-        # enforce GTrans's request limits.
-        while sleepers:
-            translations = []
-            to_translate = []
-            nchars = 0
-            for word in sleepers.keys():
-                if len(to_translate) == WORDS_PER_POST: break
-                l = len(word)
-
-                if l > WORD_LENGTH_LIMIT:
-                    self.errlog.write(
-                        "{}: word too long, skipping: {}\n"
-                        .format(lang, word))
-                    translations.append((word, word))
-                    continue
+        # Then look for the rest in the database.
+        if sleepers:
+            start = self.loop.time()
+            known = yield from self.db.lookup_translations(
+                lang, [word for word in sleepers
+                       if len(word) < WORD_LENGTH_LIMIT])
+            self.lookup_time.add(self.loop.time() - start)
+            self.n_db_hits += len(known)
+            self.n_db_misses += len(sleepers) - len(known)
+            for word, engl in known.items():
+                self.translations.put(lang, word, engl)
+                for fut in sleepers.pop(word):
+                    fut.set_result(engl)
 
-                elif word_seg.is_nonword(word):
-                    translations.append((word, word))
+        # Do not waste resources translating nonwords and URLs.
+        translations = []
+        for word in list(sleepers.keys()):
+            if len(word) > WORD_LENGTH_LIMIT:
+                self.errlog.write("{}: word too long, skipping: {}\n"
+                                  .format(lang, word))
+                engl = word
+            elif word_seg.is_nonword(word):
+                engl = word
+            else:
+                engl = word_seg.is_url(word)
+                if not engl:
                     continue
 
-                u = word_seg.is_url(word)
-                if u:
-                    translations.append((word, u))
-                    continue
+            translations.append((word, engl))
+            self.translations.put(lang, word, engl)
+            for fut in sleepers.pop(word):
+                fut.set_result(engl)
 
-                if nchars + l > CHARS_PER_POST: break
-                to_translate.append(word)
-                nchars += l
+        if translations:
+            yield from self.db.record_translations(lang, translations)
 
-            if to_translate:
-                tbatch = yield from self.get_translations_internal(
-                    lang, to_translate)
-                translations.extend(tbatch)
+        # Everything else goes to Google.
+        if sleepers:
+            if lang not in self.pbufs:
+                self.pbufs[lang] = work_buffer(
+                    self.post_translations_worker,
+                    WORDS_PER_POST * POSTS_PER_BATCH,
+                    label="gpost-"+lang,
+                    loop=self.loop,
+                    lang=lang)
+            for word, futs in sleepers.items():
+                self.pbufs[lang].put(word).add_done_callback(
+                    functools.partial(chain_future, futs))
 
+    @asyncio.coroutine
+    def post_translations_worker(self, batch, *, lang):
+        words = collections.defaultdict(list)
+        for word, fut in batch:
+            words[word].append(fut)
+
+        # enforce GTrans's request limits
+        for post in pack_posts(words.keys()):
+            translations = yield from self.get_translations_internal(
+                lang, post)
             for word, engl in translations:
-                self.translations[lang][word] = engl
-                for fut in sleepers[word]:
+                self.translations.put(lang, word, engl)
+                for fut in words[word]:
                     fut.set_result(engl)
-                del sleepers[word]
 
             yield from self.db.record_translations(lang, translations)
 
@@ -1588,16 +2164,16 @@ class GoogleTranslate:
             lang = chunk['l']
             languages.add(lang)
             words = chunk['t']
-            tdict = self.translations[lang]
             for word in words:
                 key = (lang, word)
                 if key in words_seen:
-                    trans = words_seen[key]
-                    translation.append(trans)
+                    translation.append(words_seen[key])
+                    continue
 
-                elif word in tdict:
+                engl = self.translations.get(lang, word)
+                if engl is not None:
                     # this one has already been translated
-                    trans = " ".join(tdict[word].split())
+                    trans = " ".join(engl.split())
                     words_seen[key] = trans
                     translation.append(trans)
 
@@ -1605,19 +2181,28 @@ class GoogleTranslate:
                     # untranslatable, return as is
                     trans = " ".join(
                         unicodedata.normalize("NFKC", word).casefold().split())
-                    tdict[word] = trans
+                    self.translations.put(lang, word, trans)
                     words_seen[key] = trans
                     translation.append(trans)
 
                 else:
+                    # look it up in the database, or failing that,
+                    # ask Google
                     if lang not in self.tbufs:
                         self.tbufs[lang] = work_buffer(
                             self.get_translations_worker,
-                            WORDS_PER_POST,
+                            WORDS_PER_LOOKUP,
                             label="gtrans-"+lang,
                             loop=self.loop,
                             lang=lang)
-                    fut = self.tbufs[lang].put(word)
+                    fut = self.pending.get(key)
+                    if fut is None:
+                        fut = self.tbufs[lang].put(word)
+                        self.pending[key] = fut
+                        fut.add_done_callback(
+                            lambda _, key=key: self.pending.pop(key, None))
+                    else:
+                        self.n_coalesced += 1
                     words_seen[key] = fut
                     sleepers.append(fut)
                     translation.append(fut)
@@ -1643,12 +2228,16 @@ class GoogleTranslate:
 
     def flush_translations(self):
         for wb in self.tbufs.values(): wb.flush()
+        for wb in self.pbufs.values(): wb.flush()
 
     @asyncio.coroutine
     def drain_translations(self):
-        sleepers = [wb.drain() for wb in self.tbufs.values()]
-        if sleepers:
-            yield from asyncio.wait(sleepers, loop=self.loop)
+        # Draining the lookup buffers can put more work into the post
+        # buffers, so they must be drained second.
+        for bufs in (self.tbufs, self.pbufs):
+            sleepers = [wb.drain() for wb in bufs.values()]
+            if sleepers:
+                yield from asyncio.wait(sleepers, loop=self.loop)
 
 #
 # The topic-analysis subprocess
@@ -2129,14 +2718,17 @@ class HistoryRetrievalSession:
         if message and message != ".":
             message = "; " + message
 
+        db_wait, db_util = self.db.stats()
         status("{} unprocessed, {} incomplete, {} complete, {} errors; "
-               "wb {}e/{}r tr {}e/{}r ta {}p/{}r{}"
+               "wb {}e/{}r tr {}e/{}r/{:.0%}h ta {}p/{}r db {:.0f}ms/{:.0%}{}"
                .format(self.n_unprocessed, self.n_incomplete,
                        self.n_complete, self.n_errors,
                        self.wayback.n_errors, self.wayback.n_requests,
                        self.gtrans.n_errors, self.gtrans.n_requests,
+                       self.gtrans.translations.hit_rate(),
                        self.topic_analyzer.n_pending,
                        self.topic_analyzer.n_requests,
+                       db_wait * 1000, db_util,
                        message),
                done)
 
@@ -2186,7 +2778,11 @@ def inner_main(session):
         traceback.print_exc()
 
 def main(loop, argv):
-    _, dbname, analyzer = argv
+    # The optional third and fourth arguments are the number of
+    # concurrent connections to the Wayback Machine and to the database.
+    dbname, analyzer = argv[1:3]
+    wb_connections = int(argv[3]) if len(argv) > 3 else 4
+    db_connections = int(argv[4]) if len(argv) > 4 else 4
 
     # child watcher must be initialized before anything creates threads
     # everything that might spin the event loop on teardown must be a context
@@ -2195,14 +2791,11 @@ def main(loop, argv):
     # aiohttp has serious bugs if you allow it any concurrent connections
     # (mixing up which data is supposed to be transmitted on which channel)
     with asyncio.get_child_watcher() as watcher,                          \
-         aiohttp.ClientSession(
-             connector=aiohttp.TCPConnector(
-                 loop=loop,
-                 conn_timeout=5, limit=1, use_dns_cache=True
-             ),
+         HTTPSessionPool(
+             loop=loop, size=wb_connections,
              headers={
                  'User-Agent': 'tbbscraper/get_page_histories; zackw@cmu.edu'
-             }) as http_client_wb,                                         \
+             }) as http_pool_wb,                                           \
          aiohttp.ClientSession(
              connector=aiohttp.TCPConnector(
                  loop=loop,
@@ -2215,8 +2808,9 @@ def main(loop, argv):
          concurrent.futures.ProcessPoolExecutor() as executor,            \
          rate_limiter(10, loop=loop) as wb_rate,                          \
          rate_limiter(4096, loop=loop) as gt_rate,                        \
-         Database(dbname, loop, timeout = 3600 * 24) as db,               \
-         WaybackMachine(executor, http_client_wb, wb_rate, loop) as wayback, \
+         Database(dbname, loop, connections = db_connections,
+                  timeout = 3600 * 24) as db,                             \
+         WaybackMachine(executor, http_pool_wb, wb_rate, loop) as wayback,   \
          GoogleTranslate(db, http_client_gt, gt_rate, loop) as gtrans,       \
          HistoryRetrievalSession(
              "wayback", db, wayback,
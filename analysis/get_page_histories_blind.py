@@ -28,6 +28,8 @@ import aiohttp
 import aiopg
 from werkzeug.http import parse_options_header
 
+from wayback_cache import WaybackCache, request_url
+
 import word_seg
 
 #
@@ -674,12 +676,17 @@ class Database:
             cur = self.cur
 
             query = b"INSERT INTO translations (lang, word, engl) VALUES"
-            values = b",".join(
-                (yield from cur.mogrify("(%s,%s,%s)", (lang, word, engl)))
-                for word, engl in translations
-                if len(word) < WORD_LENGTH_LIMIT)
+            # Not a generator expression: 'yield from' is not allowed
+            # inside one.
+            values = []
+            for word, engl in translations:
+                if len(word) < WORD_LENGTH_LIMIT:
+                    values.append((yield from cur.mogrify(
+                        "(%s,%s,%s)", (lang, word, engl))))
+            if not values:
+                return
 
-            yield from cur.execute(query + values)
+            yield from cur.execute(query + b",".join(values))
 
     @asyncio.coroutine
     def load_date_range_for_url(self, urlid):
@@ -1137,6 +1144,7 @@ class WaybackMachine(MeteredHTTPClient):
         MeteredHTTPClient.__init__(self, **kwargs)
         self.executor    = executor
         self.errlog      = open("wayback-machine-errors.log", "at")
+        self.cache       = WaybackCache.from_environ()
         self.n_errors    = 0
         self.n_requests  = 0
         self.n_pending   = 0
@@ -1148,6 +1156,8 @@ class WaybackMachine(MeteredHTTPClient):
 
     def __exit__(self, *dontcare):
         self.errlog.close()
+        if self.cache is not None:
+            self.cache.close()
 
     @asyncio.coroutine
     def get_unique_snapshots_http_request(self, url):
@@ -1164,7 +1174,7 @@ class WaybackMachine(MeteredHTTPClient):
             client.cookies.clear()
 
             resp = yield from client.get(
-                "https://web.archive.org/cdx/search/cdx",
+                request_url("https://web.archive.org/cdx/search/cdx"),
                 params = { "url": url,
                            "collapse": "digest",
                            "fl": "original,timestamp,statuscode" })
@@ -1196,11 +1206,19 @@ class WaybackMachine(MeteredHTTPClient):
     @asyncio.coroutine
     def get_unique_snapshots_of_url(self, url):
         """Retrieve a list of all available snapshots of URL."""
+        text = None
+        if self.cache is not None:
+            text = yield from self.cache.run_in_executor(
+                self.loop, self.cache.get_cdx, url)
+
         backoff = 1
-        while True:
+        while text is None:
             try:
                 text = yield from self.get_unique_snapshots_http_request(url)
                 self.n_pending -= 1
+                if self.cache is not None:
+                    yield from self.cache.run_in_executor(
+                        self.loop, self.cache.put_cdx, url, text)
                 break
 
             except Exception:
@@ -1280,7 +1298,8 @@ class WaybackMachine(MeteredHTTPClient):
             # It doesn't ever _need_ us to send cookies, AFAICT.
             client.cookies.clear()
 
-            resp = yield from client.get(query, allow_redirects=False)
+            resp = yield from client.get(request_url(query),
+                                         allow_redirects=False)
             try:
                 status   = resp.status
                 reason   = resp.reason
@@ -1322,10 +1341,20 @@ class WaybackMachine(MeteredHTTPClient):
 
     @asyncio.coroutine
     def get_page_http_request(self, query):
+        if self.cache is not None:
+            result = yield from self.cache.run_in_executor(
+                self.loop, self.cache.get_page, query)
+            if result is not None:
+                return result
+
         backoff = 1
         while True:
             try:
-                return (yield from self.get_page_do_http_request(query))
+                result = yield from self.get_page_do_http_request(query)
+                if self.cache is not None:
+                    yield from self.cache.run_in_executor(
+                        self.loop, self.cache.put_page, query, *result)
+                return result
 
             except Exception as e:
                 self.n_errors += 1
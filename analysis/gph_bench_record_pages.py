@@ -0,0 +1,81 @@
+#! /usr/bin/python3
+
+# Measure how fast get_page_histories.Database can record historical
+# pages, one at a time and in batches.
+#
+#    gph_bench_record_pages.py DBNAME [NPAGES [BATCH_SIZE ...]]
+#
+# DBNAME must be a scratch database with the collection and analysis
+# schemas loaded; the benchmark adds rows to it.  Each run records a
+# fresh set of NPAGES synthetic pages (batch size 1 is the old
+# page-at-a-time path), of which a quarter share their HTML with
+# another page of the same run.
+
+import asyncio
+import datetime
+import hashlib
+import json
+import random
+import sys
+import time
+import zlib
+
+import get_page_histories as gph
+
+def sha(b):
+    return hashlib.sha256(b).digest()
+
+def synthetic_page(tag, n, rng):
+    body = rng.randrange(n) if n > 0 and rng.random() < 0.25 else n
+    text = "page {} of run {}".format(body, tag)
+    html = "<html><body><h1>{0}</h1><p>{0}</p></body></html>".format(text)
+    url  = "http://bench-{}.example/{}".format(tag, n)
+
+    original = zlib.compress(html.encode("utf-8"))
+    content  = text.encode("utf-8")
+    pruned   = content
+    segmtd   = json.dumps([{"l": "en", "t": text.split()}]).encode("utf-8")
+    heads    = json.dumps([text]).encode("utf-8")
+    links    = json.dumps([url + "/next"]).encode("utf-8")
+    rsrcs    = json.dumps([]).encode("utf-8")
+    domst    = json.dumps({"tags": 4, "depth": 3}).encode("utf-8")
+
+    return gph.EC(url, url, 200, "OK",
+                  sha(original), len(html), original,
+                  sha(content), content,
+                  sha(pruned), pruned, segmtd,
+                  sha(heads), heads,
+                  sha(links), links,
+                  sha(rsrcs), rsrcs,
+                  sha(domst), domst,
+                  False, [])
+
+@asyncio.coroutine
+def record_all(db, pages):
+    date = datetime.datetime(2016, 1, 1)
+    yield from asyncio.wait([db.record_historical_page("bench", date, ec)
+                             for ec in pages])
+
+def main():
+    dbname = sys.argv[1]
+    npages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    sizes  = [int(a) for a in sys.argv[3:]] or [1, 10, 50, 200]
+
+    loop = asyncio.get_event_loop()
+    tag  = "{:x}".format(int(time.time()))
+    sys.stdout.write("{:>10}  {:>8}  {:>10}\n"
+                     .format("batch", "seconds", "pages/sec"))
+    for size in sizes:
+        rng   = random.Random(size)
+        pages = [synthetic_page("{}-{}".format(tag, size), n, rng)
+                 for n in range(npages)]
+        with gph.Database(dbname, loop, connections=4,
+                          batch_size=size) as db:
+            start = time.monotonic()
+            loop.run_until_complete(record_all(db, pages))
+            elapsed = time.monotonic() - start
+
+        sys.stdout.write("{:>10}  {:>8.2f}  {:>10.1f}\n"
+                         .format(size, elapsed, npages / elapsed))
+
+main()
@@ -0,0 +1,150 @@
+#! /usr/bin/python3
+
+# Measure how GoogleTranslate batches its work, with a stub in place
+# of Google and another in place of the database.
+#
+#    gph_bench_translate.py [NDOCS [WORDS_PER_DOC [LATENCY [CONC ...]]]]
+#
+# NDOCS synthetic documents of WORDS_PER_DOC words each are translated
+# all at once, as HistoryRetrievalSession does.  Their words are drawn
+# from a Zipf-distributed vocabulary in three languages, a third of
+# which is already in the database.  Each post to the stub translator
+# takes LATENCY seconds (default 0.2), plus a millisecond per hundred
+# characters.  The run is repeated allowing each number CONC of
+# concurrent posts given (default 1 and 4).  Reported for each:
+# requests that shared another document's pending word, database
+# lookups, posts made, words and characters per post, and words that
+# were posted more than once.
+
+import asyncio
+import collections
+import os
+import random
+import sys
+import time
+
+import get_page_histories as gph
+
+LANGS = ("de", "fr", "ru")
+
+class StubDatabase:
+    def __init__(self, known):
+        self.known    = dict(known)
+        self.lookups  = 0
+        self.recorded = collections.Counter()
+
+    @asyncio.coroutine
+    def lookup_translations(self, lang, words):
+        self.lookups += 1
+        return { w: self.known[lang, w] for w in words
+                 if (lang, w) in self.known }
+
+    @asyncio.coroutine
+    def record_translations(self, lang, translations):
+        for word, engl in translations:
+            self.recorded[lang, word] += 1
+            self.known[lang, word] = engl
+
+class StubSession:
+    def __init__(self):
+        self.tatrace = open(os.devnull, "w")
+
+    def progress(self):
+        pass
+
+class StubTranslate(gph.GoogleTranslate):
+    def __init__(self, *args, latency, **kwargs):
+        gph.GoogleTranslate.__init__(self, *args, **kwargs)
+        self.latency = latency
+        self.posted  = collections.Counter()
+
+    @asyncio.coroutine
+    def prepare(self):
+        self.langs = frozenset(LANGS)
+
+    @asyncio.coroutine
+    def get_translations_http_request(self, lang, words):
+        for word in words:
+            self.posted[lang, word] += 1
+        yield from asyncio.sleep(self.latency +
+                                 sum(len(w) for w in words) / 100000,
+                                 loop=self.loop)
+        return { "data": { "translations": [
+            { "translatedText": "en-" + w } for w in words ] } }
+
+def vocabulary(rng, nwords):
+    letters = "abcdefghijklmnopqrstuvwxyzäöüßéèêàçñ"
+    vocab = []
+    for lang in LANGS:
+        seen = set()
+        while len(seen) < nwords:
+            if rng.random() < 0.05:
+                word = str(rng.randrange(100000))
+            else:
+                n = max(2, min(40, int(rng.lognormvariate(1.9, 0.5))))
+                word = "".join(rng.choice(letters) for _ in range(n))
+            if word not in seen:
+                seen.add(word)
+                vocab.append((lang, word))
+    return vocab
+
+def documents(rng, vocab, ndocs, words_per_doc):
+    # Zipf-ish: rank r is drawn with weight 1/r.
+    weights = [1 / (r + 1) for r in range(len(vocab) // len(LANGS))]
+    by_lang = collections.defaultdict(list)
+    for lang, word in vocab:
+        by_lang[lang].append(word)
+    docs = []
+    for _ in range(ndocs):
+        lang = rng.choice(LANGS)
+        words = rng.choices(by_lang[lang], weights, k=words_per_doc)
+        docs.append([{ "l": lang, "t": words }])
+    return docs
+
+def run(docs, known, latency, posts):
+    loop = asyncio.get_event_loop()
+    db = StubDatabase(known)
+    with gph.rate_limiter(4096, loop=loop) as rate:
+        gt = StubTranslate(db, None, rate, loop,
+                           latency=latency, concurrent_posts=posts)
+        gt.session = StubSession()
+        start = time.monotonic()
+        loop.run_until_complete(asyncio.wait(
+            [gt.translate_segmented(None, doc) for doc in docs],
+            loop=loop))
+        loop.run_until_complete(gt.drain_translations())
+        elapsed = time.monotonic() - start
+    gt.errlog.close()
+    gt.session.tatrace.close()
+
+    repeats = sum(n - 1 for n in gt.posted.values())
+    sys.stdout.write(
+        "{:>4}  {:>8.2f}  {:>7}  {:>6}  {:>6}  {:>10.1f}  {:>10.0f}  {:>7}\n"
+        .format(posts, elapsed, gt.n_coalesced, db.lookups, gt.n_posts,
+                gt.n_posted / (gt.n_posts or 1),
+                gt.n_chars / (gt.n_posts or 1), repeats))
+
+def main():
+    ndocs         = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    words_per_doc = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    latency       = float(sys.argv[3]) if len(sys.argv) > 3 else 0.2
+    posts         = [int(a) for a in sys.argv[4:]] or [1, 4]
+
+    rng   = random.Random(1)
+    vocab = vocabulary(rng, 20000)
+    known = { key: "en-" + key[1] for key in vocab if rng.random() < 1/3 }
+    docs  = documents(rng, vocab, ndocs, words_per_doc)
+
+    sys.stdout.write("{} documents, {} words each, {} distinct\n"
+                     .format(ndocs, words_per_doc,
+                             len({ (d[0]["l"], w) for d in docs
+                                   for w in d[0]["t"] })))
+    sys.stdout.write("{:>4}  {:>8}  {:>7}  {:>6}  {:>6}  {:>10}  {:>10}"
+                     "  {:>7}\n"
+                     .format("conc", "seconds", "shared", "lookup",
+                             "posted", "words/post", "chars/post",
+                             "repeats"))
+    for n in posts:
+        run(docs, known, latency, n)
+
+main()
@@ -0,0 +1,128 @@
+#! /usr/bin/python3 -u
+
+# Stand-in for the Wayback Machine, for exercising get_page_histories.py
+# without touching the real thing.
+#
+#    gph_stub_wayback.py PORT [DELAY [P_SLOW [P_REDIR [P_RESET]]]]
+#    WAYBACK_ORIGIN=http://127.0.0.1:PORT get_page_histories.py ...
+#
+# Every URL has a dozen snapshots, one per year from 2005.  Each
+# snapshot request is, at random, answered only after DELAY seconds
+# (probability P_SLOW), redirected through a chain of up to three
+# other snapshot URLs (P_REDIR), or answered by resetting the
+# connection (P_RESET).  Resets are transient, as they are on the
+# real thing, so a retry will usually get through.
+
+import http.server
+import random
+import re
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+SNAPSHOT_RE = re.compile(r"^/web/(\d{14})id_/(.*)$")
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, delay, p_slow, p_redir, p_reset):
+        http.server.HTTPServer.__init__(self, ("127.0.0.1", port), StubHandler)
+        self.delay   = delay
+        self.p_slow  = p_slow
+        self.p_redir = p_redir
+        self.p_reset = p_reset
+        self.lock    = threading.Lock()
+        self.counts  = { "cdx": 0, "page": 0, "slow": 0,
+                         "redir": 0, "reset": 0 }
+
+    def count(self, what):
+        with self.lock:
+            self.counts[what] += 1
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        srv = self.server
+        split = urllib.parse.urlsplit(self.path)
+        if split.path == "/cdx/search/cdx":
+            srv.count("cdx")
+            url = dict(urllib.parse.parse_qsl(split.query)).get("url", "")
+            self.send_body(200, "text/plain", "".join(
+                "{} {}0615120000 200\n".format(url, year)
+                for year in range(2005, 2017)))
+            return
+
+        m = SNAPSHOT_RE.match(split.path)
+        if not m:
+            self.send_body(404, "text/plain", "not found\n")
+            return
+
+        srv.count("page")
+        stamp, url = m.groups()
+        hops = int(dict(urllib.parse.parse_qsl(split.query)).get("hop", 0))
+        roll = random.random()
+
+        if roll < srv.p_reset:
+            srv.count("reset")
+            # SO_LINGER with a zero timeout makes close() send RST.
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return
+        roll -= srv.p_reset
+
+        if hops < 3 and roll < srv.p_redir:
+            srv.count("redir")
+            self.send_response(302)
+            self.send_header("Location", "/web/{}id_/{}?hop={}"
+                             .format(stamp, url, hops + 1))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        roll -= srv.p_redir
+
+        if roll < srv.p_slow:
+            srv.count("slow")
+            time.sleep(srv.delay)
+
+        self.send_body(200, "text/html; charset=utf-8",
+                       "<!doctype html><title>{0}</title>"
+                       "<h1>{0} as of {1}</h1>\n{2}"
+                       .format(url, stamp, "<p>lorem ipsum dolor</p>\n" * 200))
+
+    def send_body(self, status, ctype, text):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    args = sys.argv[1:]
+    port    = int(args[0])
+    delay   = float(args[1]) if len(args) > 1 else 5
+    p_slow  = float(args[2]) if len(args) > 2 else 0.1
+    p_redir = float(args[3]) if len(args) > 3 else 0.1
+    p_reset = float(args[4]) if len(args) > 4 else 0.02
+
+    srv = StubServer(port, delay, p_slow, p_redir, p_reset)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        sys.stderr.write(" ".join("{}={}".format(k, v)
+                                  for k, v in sorted(srv.counts.items()))
+                         + "\n")
+
+main()
@@ -73,8 +73,15 @@ cdef bytes convert_to_utf8(bytes page, str encoding):
         page = page[3:]
     return page
 
-cdef inline bytes determine_encoding_and_convert(bytes page,
-                                                 bytes ext_encoding):
+cdef inline const unsigned char *buffer_start(const unsigned char[::1] buf):
+    """Pointer to the beginning of BUF, which is valid even if BUF is
+       empty (and then points to an empty string)."""
+    if buf.shape[0] == 0:
+        return <const unsigned char *>b""
+    return &buf[0]
+
+cdef str determine_encoding(const unsigned char[::1] page,
+                            bytes ext_encoding, size_t *bom_len):
 
     """Determine the encoding of PAGE, following HTML5's "encoding
        sniffing algorithm"
@@ -82,34 +89,39 @@ cdef inline bytes determine_encoding_and_convert(bytes page,
        EXT_ENCODING may be either b"" or an encoding label in the
        list at https://encoding.spec.whatwg.org/#names-and-labels.
 
-       Regardless of what the encoding was detected to be, the return value
-       is PAGE converted to UTF-8, with BOM (if any) stripped.
+       Returns the name of the encoding.  If PAGE begins with a UTF-8
+       byte order mark, its length is stored in BOM_LEN[0], otherwise
+       zero is.  (convert_to_utf8 strips byte order marks itself.)
 
     """
     cdef const char *rv
     cdef str encoding
+    cdef size_t n = page.shape[0]
+    cdef const unsigned char *p = buffer_start(page)
+
+    bom_len[0] = 0
 
     # Step 1 does nothing (there is no user override).
     # Step 2 does nothing (we already have the full text).
 
     # Step 3
-    if page.startswith(b"\xfe\xff"):
-        return convert_to_utf8(page, "utf-16be")
-    if page.startswith(b"\xff\xfe"):
-        return convert_to_utf8(page, "utf-16le")
-    if page.startswith(b"\xef\xbb\xbf"):
-        return convert_to_utf8(page, "utf-8")
+    if n >= 2 and p[0] == 0xFE and p[1] == 0xFF:
+        return "utf-16be"
+    if n >= 2 and p[0] == 0xFF and p[1] == 0xFE:
+        return "utf-16le"
+    if n >= 3 and p[0] == 0xEF and p[1] == 0xBB and p[2] == 0xBF:
+        bom_len[0] = 3
+        return "utf-8"
 
     # Step 4
     if ext_encoding:
         rv = canonical_encoding_for_label(ext_encoding)
         if rv:
-            encoding = rv.decode("ascii")
-            return convert_to_utf8(page, encoding)
+            return rv.decode("ascii")
 
     # Step 5
     rv = prescan_a_byte_stream_to_determine_its_encoding(
-        page, min(len(page), 1024))
+        <const char *>p, min(n, 1024))
     if rv:
         encoding = rv.decode('ascii')
         # This is mandated by HTML5, with the justification that
@@ -124,17 +136,23 @@ cdef inline bytes determine_encoding_and_convert(bytes page,
         # rarely-used, non-ASCII-superset encodings than with keeping
         # old pages working.  Our concerns are precisely the opposite.
         if encoding != "replacement" and encoding != "x-user-defined":
-            return convert_to_utf8(page, encoding)
+            return encoding
 
     # Step 6 does nothing (there is no parent browsing context)
 
     # Steps 7, 8, and 9
+    # A page that is well-formed UTF-8 all the way through is almost
+    # certainly UTF-8 (or ASCII, which comes to the same thing), and
+    # checking is much cheaper than statistical detection.
+    if is_valid_utf8(p, n):
+        return "utf-8"
+
     # senc might be None, so not reusing 'encoding' for it
-    senc = detect_encoding_statistically(page).get('encoding', '')
+    senc = detect_encoding_statistically(bytes(page)).get('encoding', '')
     # HTML5's last-ditch default
     if not senc: senc = 'windows-1252'
 
-    return convert_to_utf8(page, senc)
+    return senc
 
 # Main tree walker.  Since this gets compiled now, we are safe to just
 # go ahead and use recursive function calls.
@@ -443,6 +461,12 @@ cdef class ExtractedContent:
     original     - Bytes: the original HTML of the page, converted to UTF-8
                    if necessary.
     mimetype     - The computed MIME type of the page.
+
+    PAGE may be a string, or any object supporting the buffer protocol
+    (bytes, bytearray, memoryview, mmap, ...).  A buffer that is already
+    well-formed UTF-8 is parsed where it lies, without being copied;
+    the extractor then holds on to it until 'original' is first read,
+    which makes a bytes copy only if PAGE was not already bytes.
     """
 
     cdef readonly unicode url, title, mimetype, text_content
@@ -450,13 +474,19 @@ cdef class ExtractedContent:
     cdef readonly object blocktree # for debugging
     cdef readonly double threshold # ditto
     cdef readonly object links, resources, headings, dom_stats
-    cdef readonly bytes original
+
+    # The UTF-8 text of the page is _page[_skip:]; see 'original'.
+    cdef object _page
+    cdef size_t _skip
+    cdef bytes _original
 
     def __init__(self, url, page, external_ctype='text/html',
                  external_charset='utf-8'):
 
+        cdef const unsigned char[::1] view
+        cdef size_t skip = 0
         cdef size_t pagelen
-        cdef char *pagebuf
+        cdef const char *pagebuf
         cdef GumboOptions opts
         cdef GumboOutput *output
 
@@ -469,20 +499,34 @@ cdef class ExtractedContent:
         if isinstance(page, str):
             # Without the cast, Cython doesn't realize it can use
             # PyUnicode_AsUTF8String here.
-            bytestr = (<str>page).encode('utf-8')
+            page = (<str>page).encode('utf-8')
+            view = page
             mimetype = get_computed_mimetype(mimetype, charset,
-                                             bytestr, len(bytestr))
+                                             buffer_start(view),
+                                             view.shape[0])
 
         else:
+            # Any object supporting the buffer protocol will do.  If
+            # it is already well-formed UTF-8, gumbo parses it in
+            # place; otherwise it is converted.
+            view = page
             mimetype = get_computed_mimetype(mimetype, charset,
-                                             page, len(page))
-            bytestr = determine_encoding_and_convert(page, charset)
+                                             buffer_start(view),
+                                             view.shape[0])
+            encoding = determine_encoding(view, charset, &skip)
+            if not (encoding == "utf-8" and
+                    is_valid_utf8(buffer_start(view) + skip,
+                                  view.shape[0] - skip)):
+                page = convert_to_utf8(bytes(view), encoding)
+                view = page
+                skip = 0
 
         mimetype = mimetype.decode("ascii")
         if mimetype != "text/html":
             # Match what PhantomJS does when asked to load certain types of
             # non-HTML resources as the base document.
             if mimetype.startswith("text/"):
+                bytestr = memoryview(page)[skip:].tobytes()
                 bytestr = (b"<html><head></head><body><pre style=\"word-wrap: "
                            b"break-word; white-space: pre-wrap;\">" +
                            bytestr.replace(b"&", b"&amp;")
@@ -501,10 +545,15 @@ cdef class ExtractedContent:
             else:
                 bytestr = b"<html><head></head><body></body></html>"
 
+            page = bytestr
+            view = page
+            skip = 0
+
         self.mimetype = mimetype
-        self.original = bytestr
-        pagebuf = bytestr
-        pagelen = len(bytestr)
+        self._page    = page
+        self._skip    = skip
+        pagebuf = <const char *>buffer_start(view) + skip
+        pagelen = view.shape[0] - skip
 
         opts = kGumboDefaultOptions
         opts.stop_on_first_error = False
@@ -532,3 +581,16 @@ cdef class ExtractedContent:
         tp, thresh        = extract_content(self.blocktree)
         self.text_pruned  = tp
         self.threshold    = thresh
+
+    property original:
+        def __get__(self):
+            if self._original is None:
+                if type(self._page) is bytes and self._skip == 0:
+                    self._original = self._page
+                else:
+                    self._original = \
+                        memoryview(self._page)[self._skip:].tobytes()
+                # Don't keep the caller's buffer exported any longer.
+                self._page = self._original
+                self._skip = 0
+            return self._original
@@ -27,8 +27,8 @@
 
 #include "prescan.h"
 #include <stdbool.h>
-#include <stdlib.h>
 #include <stdint.h>
+#include <stdlib.h>
 #include <string.h>
 
 /* Significant string literals. */
@@ -645,3 +645,49 @@ prescan_a_byte_stream_to_determine_its_encoding(const char *buffer,
  END_OF_FILE:
   return 0;
 }
+
+
+bool
+is_valid_utf8(const unsigned char *buffer, size_t nbytes)
+{
+  const unsigned char *p     = buffer;
+  const unsigned char *limit = buffer + nbytes;
+
+  while (p < limit) {
+    /* Skip ASCII eight bytes at a time where possible. */
+    while (limit - p >= 8) {
+      uint64_t w;
+      memcpy(&w, p, 8);
+      if (w & UINT64_C(0x8080808080808080))
+        break;
+      p += 8;
+    }
+    if (p >= limit)
+      break;
+
+    unsigned char c = *p;
+    size_t n;
+    unsigned char lo = 0x80, hi = 0xBF;
+
+    if (c < 0x80) { p++; continue; }
+    else if (c >= 0xC2 && c <= 0xDF) n = 1;
+    else if (c == 0xE0) { n = 2; lo = 0xA0; }          /* no overlongs */
+    else if (c >= 0xE1 && c <= 0xEC) n = 2;
+    else if (c == 0xED) { n = 2; hi = 0x9F; }          /* no surrogates */
+    else if (c >= 0xEE && c <= 0xEF) n = 2;
+    else if (c == 0xF0) { n = 3; lo = 0x90; }          /* no overlongs */
+    else if (c >= 0xF1 && c <= 0xF3) n = 3;
+    else if (c == 0xF4) { n = 3; hi = 0x8F; }          /* max U+10FFFF */
+    else return false;
+
+    if ((size_t)(limit - p) <= n)
+      return false;
+    if (p[1] < lo || p[1] > hi)
+      return false;
+    for (size_t i = 2; i <= n; i++)
+      if (p[i] < 0x80 || p[i] > 0xBF)
+        return false;
+    p += n + 1;
+  }
+  return true;
+}
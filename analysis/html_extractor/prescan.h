@@ -1,6 +1,7 @@
 #ifndef _PRESCAN_H
 #define _PRESCAN_H
 
+#include <stdbool.h>
 #include <stddef.h> /* size_t */
 
 /**
@@ -36,4 +37,13 @@ extern const char *
 prescan_a_byte_stream_to_determine_its_encoding(const char *buffer,
                                                 size_t nbytes);
 
+/**
+ * True if the NBYTES bytes at BUFFER are entirely well-formed UTF-8:
+ * no overlong forms, no surrogates, nothing above U+10FFFF, and no
+ * truncated sequences.  Decoding such a buffer as UTF-8 with error
+ * replacement and encoding it again would leave it unchanged.
+ */
+extern bool
+is_valid_utf8(const unsigned char *buffer, size_t nbytes);
+
 #endif
@@ -5,3 +5,5 @@ cdef extern from "prescan.h":
 
     const char *prescan_a_byte_stream_to_determine_its_encoding(const char *b,
                                                                 size_t len)
+
+    bint is_valid_utf8(const unsigned char *b, size_t len)
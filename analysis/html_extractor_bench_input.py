@@ -0,0 +1,98 @@
+#! /usr/bin/python3
+
+# Measure the throughput and memory overhead of html_extractor on a
+# set of saved pages, for each of the ways a page can be handed to it.
+#
+#    html_extractor_bench_input.py DIRECTORY [REPEATS]
+#
+# Every regular file under DIRECTORY is taken to be one page.  Each
+# page is extracted from a bytes object, from a memoryview of an mmap
+# of the file (as a capture archive reader would pass it), and, for
+# comparison, from a str decoded beforehand.  For each mode we report
+# MB/s over REPEATS passes (default 3), and, from a separate pass under
+# tracemalloc, the mean peak Python-level allocation per page as a
+# multiple of the page size (so 1.0 is one extra copy of every page).
+
+import mmap
+import os
+import sys
+import time
+import tracemalloc
+
+import html_extractor
+
+def load_pages(directory):
+    paths = []
+    for dirpath, _, filenames in os.walk(directory):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                paths.append(path)
+    paths.sort()
+    return paths
+
+def as_bytes(path, data, mapped):
+    return data
+
+def as_mmap(path, data, mapped):
+    return memoryview(mapped)
+
+def as_str(path, data, mapped):
+    return data.decode("utf-8", "replace")
+
+MODES = [("bytes", as_bytes), ("mmap", as_mmap), ("str", as_str)]
+
+def extract(path, page):
+    extr = html_extractor.ExtractedContent("http://example.com/", page)
+    return len(extr.text_content)
+
+def run(paths, pages, maps, label, convert, repeats):
+    nbytes = sum(len(p) for p in pages) * repeats
+    start = time.monotonic()
+    for _ in range(repeats):
+        for path, data, mapped in zip(paths, pages, maps):
+            page = convert(path, data, mapped)
+            extract(path, page)
+            del page
+    elapsed = time.monotonic() - start
+
+    ratios = []
+    tracemalloc.start()
+    for path, data, mapped in zip(paths, pages, maps):
+        page = convert(path, data, mapped)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        extract(path, page)
+        peak = tracemalloc.get_traced_memory()[1]
+        ratios.append((peak - base) / len(data))
+        del page
+    tracemalloc.stop()
+
+    sys.stdout.write("{:>6}  {:>8.1f}  {:>10.2f}\n"
+                     .format(label, nbytes / elapsed / (1024 * 1024),
+                             sum(ratios) / len(ratios)))
+
+def main():
+    directory = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    paths = load_pages(directory)
+    pages = []
+    maps = []
+    for path in paths:
+        with open(path, "rb") as f:
+            pages.append(f.read())
+            maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    sys.stdout.write("{} pages, {:.1f} MB\n"
+                     .format(len(pages),
+                             sum(len(p) for p in pages) / (1024 * 1024)))
+    sys.stdout.write("{:>6}  {:>8}  {:>10}\n"
+                     .format("input", "MB/s", "peak/size"))
+    for label, convert in MODES:
+        run(paths, pages, maps, label, convert, repeats)
+
+    for m in maps:
+        m.close()
+
+main()
@@ -4,6 +4,7 @@
 
 import os
 import psycopg2
+import psycopg2.extensions
 import zlib
 import json
 import random
@@ -11,6 +12,9 @@ from collections import defaultdict
 
 __all__ = ['PageText', 'PageObservation', 'DOMStatistics', 'PageDB']
 
+# Number of objects whose attributes are loaded by each prefetch query.
+PREFETCH_CHUNK = 1000
+
 class PageText:
     """The text of at least one page.  Corresponds to one row of the
        analysis.capture_pruned_content table.  Must cross-reference to
@@ -82,13 +86,13 @@ class PageText:
     @property
     def tfidf(self):
         if self._tfidf is None:
-            self._tfidf = self._db.get_text_statistic('tfidf', self.eid)
+            self._tfidf = self._db.get_text_statistic('tfidf', self)
         return self._tfidf
 
     @property
     def nfidf(self):
         if self._nfidf is None:
-            self._nfidf = self._db.get_text_statistic('nfidf', self.eid)
+            self._nfidf = self._db.get_text_statistic('nfidf', self)
         return self._nfidf
 
     @property
@@ -123,7 +127,7 @@ class PageText:
     def observations(self):
         if self._observations is None:
             self._observations = \
-                self._db.get_observations_for_text(self.eid)
+                self._db.get_observations_for_text(self.eid, self)
         return self._observations
 
 class DOMStatistics:
@@ -173,7 +177,7 @@ class PageObservation:
 
     """
 
-    def __init__(self, db, id, run, locale, country, vantage,
+    def __init__(self, db, id, run, locale, country, vantage, url,
                  access_time, elapsed_time, result, detail, redir_url,
                  document_id,
                  *,
@@ -200,11 +204,39 @@ class PageObservation:
     @property
     def document(self):
         if self._document is None:
-            self._document = self._db.get_page_text(self._document_id)
+            self._document = self._db.get_page_text(self.document_id)
         return self._document
 
 
 
+def unpack_text_statistic(blob):
+    """Decode one analysis.pruned_content_stats.data value."""
+    if blob:
+        return json.loads(zlib.decompress(blob).decode('utf-8'))
+    return {}
+
+class _CountingCursor(psycopg2.extensions.cursor):
+    """Cursor which reports every statement it executes to its
+       connection, so PageDB can count database round trips."""
+    def execute(self, query, vars=None):
+        self.connection.note_query(query, vars)
+        return super().execute(query, vars)
+
+class _CountingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_queries  = 0
+        self.query_hook = None
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", _CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def note_query(self, query, vars):
+        self.n_queries += 1
+        if self.query_hook is not None:
+            self.query_hook(query, vars)
+
 class PageDB:
     """Wraps a database handle and knows how to extract pages or other
        interesting material (add queries as they become useful!)"""
@@ -219,7 +251,8 @@ class PageDB:
 
         if "=" not in connstr:
             connstr = "dbname="+connstr
-        self._db = psycopg2.connect(connstr)
+        self._db = psycopg2.connect(connstr,
+                                    connection_factory=_CountingConnection)
         cur = self._db.cursor()
 
         # All tables are referenced with explicit schemas.
@@ -236,6 +269,23 @@ class PageDB:
         # tiny fraction of them held in RAM at once.)
         cur.execute("SET cursor_tuple_fraction TO 1e-6")
 
+    @property
+    def n_queries(self):
+        """Number of SQL statements executed so far on this database
+           handle.  Fetching more rows from a named cursor (as the bulk
+           retrieval generators do) is not counted."""
+        return self._db.n_queries
+
+    @property
+    def query_hook(self):
+        """If not None, a callable which is invoked as hook(query, vars)
+           just before each SQL statement is executed."""
+        return self._db.query_hook
+
+    @query_hook.setter
+    def query_hook(self, hook):
+        self._db.query_hook = hook
+
     @property
     def locales(self):
         """Retrieve a list of all available locales.  This involves a
@@ -361,7 +411,7 @@ class PageDB:
         gaps = set(x[0] for x in cur.fetchall())
 
         rng = random.Random(seed)
-       sample = set()
+        sample = set()
         while len(sample) < count:
             block = set(rng.sample(range(lo, hi+1),
                                    count - len(sample))) - gaps
@@ -483,14 +533,160 @@ class PageDB:
 
         return self.get_page_observations(where_clause=where_clause, **kwargs)
 
+    #
+    # Methods for loading attributes of many objects at once.
+    #
+
+    # PageText attributes which are columns of analysis.extracted_content,
+    # and how to convert each column's value to the attribute's value.
+    _text_columns = {
+        "contents":     ("pruned_text",    None),
+        "raw_contents": ("raw_text",       None),
+        "segmented":    ("segmented_text", None),
+        "headings":     ("headings",       None),
+        "links":        ("links",          None),
+        "resources":    ("resources",      None),
+        "dom_stats":    ("dom_stats",      DOMStatistics),
+    }
+    _text_statistics = ("tfidf", "nfidf")
+
+    def prefetch_texts(self, texts, attrs, chunk_size=PREFETCH_CHUNK):
+        """Load the attributes named in 'attrs' for every PageText in
+           'texts', with a few queries per 'chunk_size' texts, instead
+           of one query per attribute per text as happens when they are
+           loaded lazily.  Accessing the attributes afterward does not
+           touch the database.  Attributes that are already loaded are
+           not reloaded.
+
+           'texts' may contain PageText objects and/or bare eids; a
+           list of PageText objects, one for each element of 'texts'
+           in the same order, is returned.
+
+           'attrs' may include any of the attributes that get_page_texts
+           can load, plus 'observations'.
+        """
+        texts = [t if isinstance(t, PageText) else self.get_page_text(t)
+                 for t in texts]
+        for i in range(0, len(texts), chunk_size):
+            self._prefetch_chunk(texts[i:i+chunk_size], attrs)
+        return texts
+
+    def iter_prefetched_texts(self, texts, attrs, chunk_size=PREFETCH_CHUNK):
+        """Like prefetch_texts, but a generator: 'texts' is consumed,
+           and attributes are loaded, 'chunk_size' texts at a time.
+           Suitable for use on the output of get_page_texts, e.g.
+
+               for text in db.iter_prefetched_texts(
+                       db.get_page_texts(load=[]), ["segmented", "links"]):
+        """
+        chunk = []
+        for t in texts:
+            chunk.append(t if isinstance(t, PageText)
+                         else self.get_page_text(t))
+            if len(chunk) >= chunk_size:
+                self._prefetch_chunk(chunk, attrs)
+                yield from chunk
+                chunk = []
+        if chunk:
+            self._prefetch_chunk(chunk, attrs)
+            yield from chunk
+
+    def prefetch_observations(self, observations, attrs,
+                              chunk_size=PREFETCH_CHUNK):
+        """Load the PageText ('document') of every PageObservation in
+           'observations', and the attributes named in 'attrs' for each
+           of those texts.  Observations sharing a document share one
+           PageText object.  Returns 'observations' as a list."""
+        observations = list(observations)
+        texts = {}
+        for obs in observations:
+            if obs._document is None:
+                if obs.document_id not in texts:
+                    texts[obs.document_id] = self.get_page_text(
+                        obs.document_id)
+                obs._document = texts[obs.document_id]
+        self.prefetch_texts([obs.document for obs in observations
+                             if obs.document_id is not None],
+                            attrs, chunk_size)
+        return observations
+
+    def _prefetch_chunk(self, texts, attrs):
+        columns = []
+        for attr in attrs:
+            if (attr not in self._text_columns and
+                attr not in self._text_statistics and
+                attr != "observations"):
+                raise ValueError("unknown attribute "+repr(attr))
+            if attr in self._text_columns:
+                columns.append(attr)
+
+        def unloaded(attr):
+            return { t.eid: t for t in texts
+                     if getattr(t, "_" + attr) is None }
+
+        columns = [c for c in columns if unloaded(c)]
+        if columns:
+            want = {}
+            for c in columns:
+                want.update(unloaded(c))
+            cur = self._db.cursor()
+            cur.execute("SELECT id, " +
+                        ", ".join(self._text_columns[c][0] for c in columns) +
+                        "  FROM analysis.extracted_content"
+                        " WHERE id = ANY(%s)", (list(want.keys()),))
+            values = { row[0]: row[1:] for row in cur }
+            for t in texts:
+                row = values.get(t.eid)
+                if row is None:
+                    continue
+                for c, v in zip(columns, row):
+                    if getattr(t, "_" + c) is None:
+                        convert = self._text_columns[c][1]
+                        setattr(t, "_" + c, convert(v) if convert else v)
+
+        for stat in self._text_statistics:
+            if stat not in attrs:
+                continue
+            want = unloaded(stat)
+            if not want:
+                continue
+            cur = self._db.cursor()
+            cur.execute("SELECT text_id, data"
+                        "  FROM analysis.pruned_content_stats"
+                        " WHERE stat = %s AND text_id = ANY(%s)"
+                        "   AND runs = %s",
+                        (stat, list(want.keys()), self._runs))
+            values = { row[0]: row[1] for row in cur }
+            for t in texts:
+                if t.eid in want:
+                    setattr(t, "_" + stat,
+                            unpack_text_statistic(values.get(t.eid)))
+
+        if "observations" in attrs:
+            want = unloaded("observations")
+            if want:
+                for t in want.values():
+                    t._observations = []
+                for obs in self.get_page_observations(
+                        where_clause = "document_id = ANY(ARRAY[{}])".format(
+                            ",".join(str(int(eid)) for eid in want)),
+                        ordered = None):
+                    obs._document = want[obs.document_id]
+                    want[obs.document_id]._observations.append(obs)
+                for t in texts:
+                    if t._observations is None and t.eid in want:
+                        t._observations = want[t.eid]._observations
+
     #
     # Methods primarily for internal use by PageText and PageObservation.
     #
-    def get_observations_for_text(self, eid):
+    def get_observations_for_text(self, eid, text=None):
+        if text is None:
+            text = self.get_page_text(eid)
         return list(self.get_page_observations(
             where_clause       = "document_id = {}".format(eid),
             ordered            = None,
-            constructor_kwargs = { "document": self }))
+            constructor_kwargs = { "document": text }))
 
     def get_page_text(self, eid):
         return PageText(self, eid)
@@ -513,25 +709,25 @@ class PageDB:
                     " WHERE id = %s", (eid,))
         return cur.fetchone()[0]
 
-    def get_headings(self, eid):
+    def get_headings_for_text(self, eid):
         cur = self._db.cursor()
         cur.execute("SELECT headings FROM analysis.extracted_content"
                     " WHERE id = %s", (eid,))
         return cur.fetchone()[0]
 
-    def get_links(self, eid):
+    def get_links_for_text(self, eid):
         cur = self._db.cursor()
         cur.execute("SELECT links FROM analysis.extracted_content"
                     " WHERE id = %s", (eid,))
         return cur.fetchone()[0]
 
-    def get_resources(self, eid):
+    def get_resources_for_text(self, eid):
         cur = self._db.cursor()
         cur.execute("SELECT resources FROM analysis.extracted_content"
                     " WHERE id = %s", (eid,))
         return cur.fetchone()[0]
 
-    def get_dom_stats(self, run, locale, url_id):
+    def get_dom_stats_for_text(self, eid):
         cur = self._db.cursor()
         cur.execute("SELECT dom_stats FROM analysis.extracted_content"
                     " WHERE id = %s", (eid,))
@@ -596,9 +792,7 @@ class PageDB:
                     " WHERE stat = %s AND text_id = %s AND runs = %s",
                     (stat, text.eid, self._runs))
         row = cur.fetchone()
-        if row and row[0]:
-            return json.loads(zlib.decompress(row[0]).decode('utf-8'))
-        return {}
+        return unpack_text_statistic(row[0] if row else None)
 
     def prepare_text_statistic(self, stat):
         cur = self._db.cursor()
@@ -0,0 +1,133 @@
+#! /usr/bin/python3
+
+# Measure the throughput of domainparking.ParkingClassifier, with and
+# without its literal prefilter, and check that both ways of running
+# the rules give the same answers.  Then measure it again with the
+# default scan window, and report how many verdicts the window changed.
+#
+#    parking_bench.py [CONTENT_DIR LABELS.csv ...]
+#
+# The arguments are the same as for the domainparking self-test
+# (python3 domainparking/__init__.py); with no arguments, a synthetic
+# corpus of ordinary and parked-looking pages, up to a couple of
+# megabytes each, is used instead.
+
+import os
+import random
+import sys
+import time
+
+import domainparking
+
+FILLER = [
+    "<div class=\"content\"><p>", "</p></div>\n", "<a href=\"/about\">",
+    "About us</a>", "<script src=\"/static/app.js\"></script>\n",
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit. ",
+    "The quick brown fox jumps over the lazy dog. ", "<li>", "</li>",
+    "Search the archives", "Related articles", "our domain experts ",
+    "<img src=\"/img/logo.png\" alt=\"logo\">",
+]
+
+TRIGGERS = [
+    "<a href=\"http://www.buydomains.com/find-premium-domains/"
+    "domain-details.jsp?domain=example.com\">",
+    "&copy; 2016 HugeDomains.com.  All Rights Reserved.",
+    "<script src=\"http://sedoparking.com/frmpark/\"></script>",
+    "This domain may be for sale!  Sponsored Listings",
+    "Buy this domain.  Related Searches:",
+    "Search the web", "parked free, courtesy of a domain",
+    "Copyright © 2015 Cartersons Ltd",
+    "<iframe src=\"http://mcc.godaddy.com/park/\"></iframe>",
+    "<span class=\"forsale\">",
+]
+
+def synthetic_corpus(n, seed=1):
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(n):
+        size = int(min(2e6, rng.lognormvariate(10.5, 1.2)))
+        parts = []
+        length = 0
+        while length < size:
+            part = rng.choice(FILLER)
+            parts.append(part)
+            length += len(part)
+        # A fifth of the pages get a few parking-service phrases.
+        if rng.random() < 0.2:
+            for _ in range(rng.randint(1, 3)):
+                part = rng.choice(TRIGGERS)
+                if rng.random() < 0.5:
+                    part = part.upper()
+                parts.insert(rng.randrange(len(parts) + 1), part)
+        pages.append("<!doctype html><html><body>" + "".join(parts) +
+                     "</body></html>")
+    return pages
+
+def sample_corpus(args):
+    pages = []
+    for content_dir, filename in zip(args[0::2], args[1::2]):
+        with open(filename) as f:
+            for line in f:
+                eid = line.split(',')[0]
+                with open(os.path.join(content_dir, eid + '.html'),
+                          encoding='utf-8') as cf:
+                    pages.append(cf.read())
+    return pages
+
+def per_rule(cfr, html):
+    """isParked as it was before the prefilter."""
+    m_strong = cfr.strong_rules.test(html)
+    m_weak1  = cfr.weak_rules_1.test(html)
+    m_weak2  = cfr.weak_rules_2.test(html)
+    is_parked = bool(m_strong) or (bool(m_weak1) and bool(m_weak2))
+    return domainparking.ParkingClassification(
+        is_parked, sorted(m_strong + m_weak1 + m_weak2))
+
+def main():
+    if sys.argv[1:]:
+        pages = sample_corpus(sys.argv[1:])
+    else:
+        pages = synthetic_corpus(300)
+    mbytes = sum(len(p.encode("utf-8")) for p in pages) / 1e6
+    sys.stdout.write("{} pages, {:.1f} MB\n".format(len(pages), mbytes))
+    sys.stdout.write("{:>9}  {:>10}  {:>10}  {:>8}  {:>7}  {:>5}"
+                     "  {:>10}  {}\n"
+                     .format("mode", "per-rule", "prefilter", "speedup",
+                             "parked", "agree", "windowed", "changed"))
+
+    ok = True
+    for mode in ('full', 'balanced', 'min'):
+        cfr = domainparking.ParkingClassifier(mode=mode, size_limit=None)
+
+        start = time.monotonic()
+        old = [per_rule(cfr, p) for p in pages]
+        t_old = time.monotonic() - start
+
+        start = time.monotonic()
+        new = [cfr.isParked(p) for p in pages]
+        t_new = time.monotonic() - start
+
+        wcfr = domainparking.ParkingClassifier(mode=mode)
+        start = time.monotonic()
+        for p in pages:
+            wcfr.isParked(p)
+        t_win = time.monotonic() - start
+        wcfr.audit_window = True
+        wcfr.window_stats.clear()
+        for p in pages:
+            wcfr.isParked(p)
+
+        agree = (old == new)
+        ok = ok and agree
+        sys.stdout.write("{:>9}  {:>5.1f} MB/s  {:>5.1f} MB/s  {:>7.1f}x"
+                         "  {:>7}  {:>5}  {:>5.1f} MB/s  {}/{}\n"
+                         .format(mode, mbytes / t_old, mbytes / t_new,
+                                 t_old / t_new,
+                                 sum(r.is_parked for r in new),
+                                 "yes" if agree else "NO",
+                                 mbytes / t_win,
+                                 wcfr.window_stats['verdict_changed'],
+                                 wcfr.window_stats['windowed']))
+    sys.exit(0 if ok else 1)
+
+main()
@@ -76,9 +76,9 @@ def do_content_extraction(args):
     extr = html_extractor.ExtractedContent(baseurl, page)
     lang = cld2.detect(extr.text_pruned, want_chunks=True)
 
-    segmented = [ { "l": c[0].code,
-                    "t": list(word_seg.segment(c[0].code, c[1])) }
-                  for c in lang.chunks ]
+    chunks = [ (c[0].code, c[1]) for c in lang.chunks ]
+    segmented = [ { "l": l, "t": t }
+                  for (l, _), t in zip(chunks, word_seg.segment_many(chunks)) ]
 
     pagelen = len(page)
     content = extr.text_content.encode("utf-8")
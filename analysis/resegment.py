@@ -17,13 +17,23 @@ def fmt_interval(interval):
     h, m = divmod(m, 60)
     return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
 
-def do_resegment(args):
-    docid, text_pruned = args
-    lang = cld2.detect(text_pruned, want_chunks=True)
-    segmented = [ { "l": c[0].code,
-                    "t": list(word_seg.segment(c[0].code, c[1])) }
-                  for c in lang.chunks ]
-    return (docid, json.dumps(segmented))
+def do_resegment(batch):
+    # All the chunks of all the pages in BATCH are segmented together,
+    # so each segmenter sees as few, and as large, calls as possible.
+    docs = []
+    chunks = []
+    for docid, text_pruned in batch:
+        lang = cld2.detect(text_pruned, want_chunks=True)
+        docs.append((docid, len(chunks), len(lang.chunks)))
+        chunks.extend((c[0].code, c[1]) for c in lang.chunks)
+
+    words = word_seg.segment_many(chunks)
+    results = []
+    for docid, start, n in docs:
+        segmented = [ { "l": chunks[i][0], "t": words[i] }
+                      for i in range(start, start + n) ]
+        results.append((docid, json.dumps(segmented)))
+    return results
 
 def resegment_pages(db, cur, pool):
     # This is not in itertools, for no good reason.
@@ -64,11 +74,13 @@ def resegment_pages(db, cur, pool):
                         "  WHERE id = ANY(%s)",
                         ([c[0] for c in chunk],))
 
-            for result in pool.imap_unordered(do_resegment, cur.fetchall()):
-                cur.execute("INSERT INTO extracted_pt_resegment "
-                            "VALUES (%s,%s::jsonb)",
-                            result)
-                processed += 1
+            for results in pool.imap_unordered(do_resegment,
+                                               chunked(cur.fetchall(), 50)):
+                for result in results:
+                    cur.execute("INSERT INTO extracted_pt_resegment "
+                                "VALUES (%s,%s::jsonb)",
+                                result)
+                    processed += 1
 
         stop = time.monotonic()
         elapsed = stop - start
@@ -6,6 +6,7 @@ import json
 import multiprocessing
 import os
 import sys
+import tempfile
 import time
 
 import cld2
@@ -48,17 +49,75 @@ def quote_utf8_as_text(s):
             s.replace(b"'", b"''").replace(b"\x00", b"\xef\xbf\xbd") +
             b"'")
 
-def do_segmentation(args):
-    id, text = args
+# Texts longer than this (in characters) are segmented and encoded a
+# little at a time, rather than batched, so that neither the worker nor
+# the main process ever holds all of their words, or their encoded
+# segmentation, in memory.
+STREAM_THRESHOLD = 1024 * 1024
+
+def do_segmentation_stream(id, text):
+    """Segment TEXT and write the result, a piece at a time, to a
+       temporary file, as one line of COPY input for the
+       segmented_stream table (see store_streamed).  Returns
+       (id, None, name of the file)."""
     lang = cld2.detect(text, want_chunks=True)
-    segmented = [ { "l": c[0].code,
-                    "t": list(word_seg.segment(c[0].code, c[1])) }
-                  for c in lang.chunks ]
-    return id, quote_utf8_as_text(json.dumps(segmented).encode("utf-8"))
+    with tempfile.NamedTemporaryFile("wb", prefix="segmented-",
+                                     suffix=".copy", delete=False) as f:
+        f.write(str(id).encode("ascii") + b"\t")
+        # The JSON is pure ASCII, with every control character escaped,
+        # so the only character COPY needs escaped is the backslash.
+        for piece in word_seg.iter_segmented_json(
+                (c[0].code, word_seg.segment_iter(c[0].code, c[1]))
+                for c in lang.chunks):
+            f.write(piece.replace("\\", "\\\\").encode("ascii"))
+        f.write(b"\n")
+    return id, None, f.name
+
+def store_streamed(cur, id, fname):
+    """Load the segmentation written to FNAME by do_segmentation_stream
+       into the database.  COPY reads the file in small pieces, so the
+       value is never in this process's memory."""
+    try:
+        with open(fname, "rb") as f:
+            cur.copy_expert("COPY segmented_stream (id, segmented) "
+                            "FROM STDIN", f)
+        cur.execute("UPDATE analysis.extracted_plaintext p"
+                    "   SET segmented = s.segmented::jsonb"
+                    "  FROM segmented_stream s WHERE p.id = s.id")
+        cur.execute("TRUNCATE segmented_stream")
+    except psycopg2.InternalError:
+        progress("*** id {} segmented form too large @ {} bytes"
+                 .format(id, os.path.getsize(fname)))
+    finally:
+        os.unlink(fname)
+
+def do_segmentation(batch):
+    # All the chunks of all the texts in BATCH are segmented together,
+    # so each segmenter sees as few, and as large, calls as possible.
+    docs = []
+    chunks = []
+    results = []
+    for id, text in batch:
+        if len(text) > STREAM_THRESHOLD:
+            results.append(do_segmentation_stream(id, text))
+            continue
+        lang = cld2.detect(text, want_chunks=True)
+        docs.append((id, len(chunks), len(lang.chunks)))
+        chunks.extend((c[0].code, c[1]) for c in lang.chunks)
+
+    words = word_seg.segment_many(chunks)
+    for id, start, n in docs:
+        segmented = [ { "l": chunks[i][0], "t": words[i] }
+                      for i in range(start, start + n) ]
+        results.append((id, quote_utf8_as_text(
+            json.dumps(segmented).encode("utf-8")), None))
+    return results
 
 def main(pool, dbname):
     db = psycopg2.connect(dbname=dbname)
     cur = db.cursor()
+    cur.execute("CREATE TEMP TABLE segmented_stream "
+                "(id INTEGER PRIMARY KEY, segmented TEXT NOT NULL)")
 
     progress("computing job size...")
 
@@ -77,15 +136,22 @@ def main(pool, dbname):
             SELECT id, plaintext FROM analysis.extracted_plaintext WHERE id = ANY(%s)
         """, (chunk,))
 
-        for id, segmented in pool.imap_unordered(do_segmentation, cur.fetchall()):
-            try:
-                cur.execute(b"UPDATE analysis.extracted_plaintext" +
-                            b"   SET segmented = " + segmented +
-                            b"::jsonb WHERE id = " + str(id).encode("utf-8"))
-            except psycopg2.InternalError:
-                progress("*** id {} segmented form too large @ {} bytes"
-                         .format(id, len(segmented)))
-            n += 1
+        for results in pool.imap_unordered(do_segmentation,
+                                           chunked(cur.fetchall(), 50)):
+            for id, segmented, fname in results:
+                if fname is not None:
+                    store_streamed(cur, id, fname)
+                    n += 1
+                    continue
+                try:
+                    cur.execute(b"UPDATE analysis.extracted_plaintext" +
+                                b"   SET segmented = " + segmented +
+                                b"::jsonb WHERE id = " +
+                                str(id).encode("utf-8"))
+                except psycopg2.InternalError:
+                    progress("*** id {} segmented form too large @ {} bytes"
+                             .format(id, len(segmented)))
+                n += 1
 
         if n % 1000 == 0:
             progress("{}/{}".format(n, jsize))
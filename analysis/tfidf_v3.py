@@ -1,122 +1,226 @@
 #! /usr/bin/python3
 
 import collections
+import itertools
 import pagedb
 import sys
-import math
 import time
 
+import numpy as np
+
 def fmt_elapsed(start):
     interval = time.monotonic() - start
     m, s = divmod(interval, 60)
     h, m = divmod(m, 60)
     return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
 
+# Texts are processed this many at a time; memory use is proportional
+# to the size of the vocabulary plus the size of one chunk.
+CHUNK_SIZE = 10000
+
+def chunked(iterable, n):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+class Vocabulary:
+    """Interns words to consecutive integers, in order of first
+       appearance.  This is the innermost loop of the whole program,
+       so the per-word work is all done by C-level dict operations."""
+    def __init__(self):
+        self.ids = collections.defaultdict(itertools.count().__next__)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, words):
+        """Return a list of the ids of WORDS, assigning new ids as needed."""
+        return list(map(self.ids.__getitem__, words))
+
+    @property
+    def words(self):
+        """All the words, in id order."""
+        return list(self.ids)
+
+def add_padded(total, counts):
+    """Add COUNTS to TOTAL elementwise, growing TOTAL if COUNTS is longer
+       (the vocabulary grows as the corpus is read)."""
+    if len(total) < len(counts):
+        total = np.concatenate((total, np.zeros(len(counts) - len(total),
+                                                dtype=total.dtype)))
+    total[:len(counts)] += counts
+    return total
+
+def group_starts(keys):
+    """KEYS is a sorted array; return the index of the first element of
+       each run of equal keys."""
+    if not len(keys):
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
 def compute_idf(n_documents, raw_doc_freq):
     """Compute inverse document frequencies:
            idf(t, D) = log |D|/|{d in D: t in d}|
        i.e. total number of documents over number of documents containing
        the term.  Since this is within-corpus IDF we know by construction
-       that the denominator will never be zero."""
+       that the denominator will never be zero.  RAW_DOC_FREQ holds an
+       array of document frequencies, indexed by word id, per language."""
 
-    log = math.log
-    return { lang: { word: log(ndocs/doc_freq)
-                     for word, doc_freq in raw_doc_freq[lang].items() }
+    return { lang: np.log(ndocs / raw_doc_freq[lang])
              for lang, ndocs in n_documents.items() }
 
+def chunk_counts(chunk, vocab, n_documents, langs_in_block):
+    """Intern all the words in CHUNK, a list of texts, and count them.
+       Returns, per language, the total occurrences of each word and
+       the number of texts containing each word, as arrays indexed by
+       word id."""
+    word_ids = collections.defaultdict(list)
+    run_docs = collections.defaultdict(list)
+    run_lens = collections.defaultdict(list)
+    for i, text in enumerate(chunk):
+        langs_this_document = set()
+        for run in text.segmented:
+            lang = run["l"]
+            if lang not in langs_this_document:
+                n_documents[lang] += 1
+                langs_in_block.add(lang)
+                langs_this_document.add(lang)
+            ids = vocab[lang].intern(run["t"])
+            word_ids[lang].extend(ids)
+            run_docs[lang].append(i)
+            run_lens[lang].append(len(ids))
+
+    counts = {}
+    for lang, words in word_ids.items():
+        nwords = len(vocab[lang])
+        words  = np.array(words, dtype=np.int64)
+        docs   = np.repeat(np.array(run_docs[lang], dtype=np.int64),
+                           run_lens[lang])
+
+        # Each distinct (document, word) pair is one nonzero entry of
+        # the chunk's document-term matrix.
+        pairs = np.sort(docs * nwords + words)
+        pairs = pairs[group_starts(pairs)]
+        counts[lang] = (np.bincount(words, minlength=nwords),
+                        np.bincount(pairs % nwords, minlength=nwords))
+    return counts
+
 def corpus_wide_statistics(db, start):
     """Compute corpus-wide frequency and raw document frequency per term,
        and count the number of documents."""
 
-    corpus_word_freq = collections.defaultdict(collections.Counter)
-    raw_doc_freq     = collections.defaultdict(collections.Counter)
+    vocab            = collections.defaultdict(Vocabulary)
+    corpus_word_freq = collections.defaultdict(lambda: np.zeros(0, np.int64))
+    raw_doc_freq     = collections.defaultdict(lambda: np.zeros(0, np.int64))
     n_documents      = collections.Counter()
     n_all_documents  = 0
     langs_in_block   = set()
-    word_already_this_document = collections.defaultdict(set)
-    lang_already_this_document = set()
-
-    for text in db.get_page_texts(load = ["segmented"],
-                                  where_clause =
-                                  "p.segmented_text is not null"):
-        n_all_documents += 1
-        word_already_this_document.clear()
-        lang_already_this_document.clear()
-        for run in text.segmented:
-            lang  = run["l"]
-            words = run["t"]
-            if lang not in lang_already_this_document:
-                n_documents[lang] += 1
-                langs_in_block.add(lang)
-                lang_already_this_document.add(lang)
-            for word in words:
-                corpus_word_freq[lang][word] += 1
-                if word not in word_already_this_document[lang]:
-                    raw_doc_freq[lang][word] += 1
-                    word_already_this_document[lang].add(word)
-
-        if n_all_documents % 1000 == 0:
-            sys.stderr.write("[{}] CS: {} docs - {}\n"
-                             .format(fmt_elapsed(start),
-                                     n_all_documents,
-                                     " ".join(sorted(langs_in_block))))
-            langs_in_block.clear()
 
-    sys.stderr.write("[{}] CS: {} docs - {}\n"
-                     .format(fmt_elapsed(start),
-                             n_all_documents,
-                             " ".join(sorted(langs_in_block))))
-    idf = compute_idf(n_documents, raw_doc_freq)
+    for chunk in chunked(db.get_page_texts(load = ["segmented"],
+                                           where_clause =
+                                           "p.segmented_text is not null"),
+                         CHUNK_SIZE):
+        for lang, (cwf, rdf) in chunk_counts(chunk, vocab, n_documents,
+                                             langs_in_block).items():
+            corpus_word_freq[lang] = add_padded(corpus_word_freq[lang], cwf)
+            raw_doc_freq[lang]     = add_padded(raw_doc_freq[lang], rdf)
+
+        n_all_documents += len(chunk)
+        sys.stderr.write("[{}] CS: {} docs - {}\n"
+                         .format(fmt_elapsed(start),
+                                 n_all_documents,
+                                 " ".join(sorted(langs_in_block))))
+        langs_in_block.clear()
+
+    idf_v = compute_idf(n_documents, raw_doc_freq)
     sys.stderr.write("[{}] CS: IDF computed.\n"
                      .format(fmt_elapsed(start)))
+    idf = {}
     for lang in n_documents.keys():
-        db.update_corpus_statistics(lang, n_documents[lang],
-                                    [('cwf', corpus_word_freq[lang]),
-                                     ('rdf', raw_doc_freq[lang]),
-                                     ('idf', idf[lang])])
+        words = vocab[lang].words
+        idf[lang] = dict(zip(words, idf_v[lang].tolist()))
+        db.update_corpus_statistics(
+            lang, n_documents[lang],
+            [('cwf', dict(zip(words, corpus_word_freq[lang].tolist()))),
+             ('rdf', dict(zip(words, raw_doc_freq[lang].tolist()))),
+             ('idf', idf[lang])])
 
     sys.stderr.write("[{}] CS: complete.\n"
                      .format(fmt_elapsed(start)))
     return idf
 
 
-def compute_doc_statistics(db, text, idf, langs_in_block):
+def chunk_doc_statistics(chunk, idf, langs_in_block):
+    """Compute tf and nf (see below) for every text in CHUNK.  Returns
+       a list of (tf, nf) pairs of dictionaries."""
     # tf: baseline tfidf - no correction for document length.
     # nf: augmented normalized tfidf - use max term frequency within
     #     each document to normalize, so long documents cannot over-
     #     influence scoring of the entire corpus.
-    # both are computed _across_ all languages within the doc.
+    # both are computed _across_ all languages within the doc: a word
+    # that appears in runs of more than one language is counted
+    # together, and weighted by the IDF from the last such run.
 
-    allwords = collections.Counter()
-    for run in text.segmented:
-        langs_in_block.add(run["l"])
-        for word in run["t"]:
-            allwords[word] += 1
+    # Words regardless of language, for keying the results.
+    words    = Vocabulary()
+    word_ids = []
+    run_docs = []
+    run_lens = []
+    idfs     = []
+    for i, text in enumerate(chunk):
+        for run in text.segmented:
+            lang = run["l"]
+            langs_in_block.add(lang)
+            try:
+                idfs.extend(map(idf[lang].__getitem__, run["t"]))
+            except KeyError as e:
+                sys.stderr.write("*** '{}' missing IDF in '{}'\n"
+                                 .format(e.args[0], lang))
+                sys.stderr.write("*** seg dump: {!r}\n"
+                                 .format(text.segmented))
+                raise
 
-    tf = {}
-    nf = {}
-    if allwords:
-        max_tf = max(allwords.values())
+            word_ids.extend(words.intern(run["t"]))
+            run_docs.append(i)
+            run_lens.append(len(run["t"]))
 
-        for run in text.segmented:
-            lang  = run["l"]
-            words = run["t"]
+    if not word_ids:
+        return [({}, {}) for _ in chunk]
 
-            for word in words:
-                w_tf  = allwords[word]
-                try:
-                    w_idf = idf[lang][word]
-                except KeyError:
-                    sys.stderr.write("*** '{}' missing IDF in '{}'\n"
-                                     .format(word, lang))
-                    sys.stderr.write("*** seg dump: {!r}\n".format(text.segmented))
-                    raise
+    nwords   = len(words)
+    word_ids = np.array(word_ids, dtype=np.int64)
+    doc_ids  = np.repeat(np.array(run_docs, dtype=np.int64), run_lens)
+    idfs     = np.array(idfs)
 
-                tf[word] = w_tf * w_idf
-                nf[word] = (0.5 + (0.5 * w_tf)/max_tf) * w_idf
+    # Distinct (document, word) pairs, in document order, with their
+    # term frequencies.  The sort is stable, so the last element of
+    # each group is the last occurrence of that word in the document.
+    keys   = doc_ids * nwords + word_ids
+    order  = np.argsort(keys, kind="stable")
+    keys   = keys[order]
+    starts = group_starts(keys)
+    ends   = np.append(starts[1:], len(keys))
+    w_tf   = ends - starts
+    w_idf  = idfs[order[ends - 1]]
+    p_doc  = keys[starts] // nwords
+    p_word = keys[starts] % nwords
 
-    db.update_text_statistic('tfidf', text, tf)
-    db.update_text_statistic('nfidf', text, nf)
+    max_tf = np.zeros(len(chunk), dtype=np.int64)
+    np.maximum.at(max_tf, p_doc, w_tf)
+
+    tf = w_tf * w_idf
+    nf = (0.5 + (0.5 * w_tf) / max_tf[p_doc]) * w_idf
+
+    bounds = np.searchsorted(p_doc, np.arange(len(chunk) + 1)).tolist()
+    keys   = list(map(words.words.__getitem__, p_word.tolist()))
+    tf     = tf.tolist()
+    nf     = nf.tolist()
+    return [(dict(zip(keys[lo:hi], tf[lo:hi])),
+             dict(zip(keys[lo:hi], nf[lo:hi])))
+            for lo, hi in zip(bounds, bounds[1:])]
 
 def per_document_statistics(db, idf, start):
 
@@ -127,23 +231,22 @@ def per_document_statistics(db, idf, start):
     processed = 0
     langs_in_block = set()
     with db:
-        for text in db.get_page_texts(load = ["segmented"],
-                                      where_clause =
-                                      "p.segmented_text is not null"):
-            compute_doc_statistics(db, text, idf, langs_in_block)
-            processed += 1
-
-            if processed % 1000 == 0:
-                sys.stderr.write("[{}] DS: {} docs - {}\n"
-                                 .format(fmt_elapsed(start),
-                                         processed,
-                                         " ".join(sorted(langs_in_block))))
-                langs_in_block.clear()
-
-        sys.stderr.write("[{}] DS: {} docs - {}\n"
-                         .format(fmt_elapsed(start),
-                                 processed,
-                                 " ".join(sorted(langs_in_block))))
+        for chunk in chunked(db.get_page_texts(load = ["segmented"],
+                                               where_clause =
+                                               "p.segmented_text is not null"),
+                             CHUNK_SIZE):
+            stats = chunk_doc_statistics(chunk, idf, langs_in_block)
+            for text, (tf, nf) in zip(chunk, stats):
+                db.update_text_statistic('tfidf', text, tf)
+                db.update_text_statistic('nfidf', text, nf)
+            processed += len(chunk)
+
+            sys.stderr.write("[{}] DS: {} docs - {}\n"
+                             .format(fmt_elapsed(start),
+                                     processed,
+                                     " ".join(sorted(langs_in_block))))
+            langs_in_block.clear()
+
     sys.stderr.write("[{}] DS: complete.\n"
                      .format(fmt_elapsed(start)))
 
@@ -166,4 +269,5 @@ def main():
     idf = corpus_wide_statistics(db, start)
     per_document_statistics(db, idf, start)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#! /usr/bin/python3
+
+# Benchmark tfidf_v3.py's statistics against the straightforward
+# dictionary-based computation it replaced, on a synthetic corpus.
+#
+#    tfidf_v3_bench.py [NDOCS [WORDS_PER_DOC]]
+#
+# The corpus has three languages with Zipf-distributed vocabularies;
+# a fifth of the documents mix two languages.  Nothing is written to
+# a database: the statistics are collected in memory, and the two
+# computations' results are compared.
+
+import collections
+import math
+import sys
+import time
+
+import numpy as np
+
+import tfidf_v3
+
+Text = collections.namedtuple("Text", ("eid", "segmented"))
+
+def synthetic_corpus(ndocs, words_per_doc, seed=1):
+    rng = np.random.RandomState(seed)
+    langs = ["en", "ru", "zh"]
+    vocab = { lang: ["{}{}".format(lang, i) for i in range(50000)]
+              for lang in langs }
+    texts = []
+    for eid in range(ndocs):
+        nruns = 2 if eid % 5 == 0 else 1
+        runs = []
+        for lang in rng.choice(langs, nruns, replace=False):
+            n = max(1, int(rng.poisson(words_per_doc / nruns)))
+            ids = np.minimum(rng.zipf(1.3, n) - 1, len(vocab[lang]) - 1)
+            runs.append({ "l": lang, "t": [vocab[lang][i] for i in ids] })
+        texts.append(Text(eid, runs))
+    return texts
+
+class MemoryDB:
+    """Just enough of pagedb.PageDB for tfidf_v3."""
+    def __init__(self, texts):
+        self.texts  = texts
+        self.corpus = {}
+        self.docs   = collections.defaultdict(dict)
+
+    def get_page_texts(self, **kwargs):
+        return iter(self.texts)
+
+    def update_corpus_statistics(self, lang, n_documents, statistics):
+        self.corpus[lang] = (n_documents, dict(statistics))
+
+    def update_text_statistic(self, stat, text, data):
+        self.docs[stat][text.eid] = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+def reference(db):
+    """The dictionary-based computation, as tfidf_v3.py used to do it."""
+    corpus_word_freq = collections.defaultdict(collections.Counter)
+    raw_doc_freq     = collections.defaultdict(collections.Counter)
+    n_documents      = collections.Counter()
+    for text in db.get_page_texts():
+        seen_words = collections.defaultdict(set)
+        seen_langs = set()
+        for run in text.segmented:
+            lang = run["l"]
+            if lang not in seen_langs:
+                n_documents[lang] += 1
+                seen_langs.add(lang)
+            for word in run["t"]:
+                corpus_word_freq[lang][word] += 1
+                if word not in seen_words[lang]:
+                    raw_doc_freq[lang][word] += 1
+                    seen_words[lang].add(word)
+
+    idf = { lang: { word: math.log(ndocs/df)
+                    for word, df in raw_doc_freq[lang].items() }
+            for lang, ndocs in n_documents.items() }
+    for lang in n_documents:
+        db.update_corpus_statistics(lang, n_documents[lang],
+                                    [('cwf', corpus_word_freq[lang]),
+                                     ('rdf', raw_doc_freq[lang]),
+                                     ('idf', idf[lang])])
+
+    for text in db.get_page_texts():
+        allwords = collections.Counter()
+        for run in text.segmented:
+            for word in run["t"]:
+                allwords[word] += 1
+        tf = {}
+        nf = {}
+        if allwords:
+            max_tf = max(allwords.values())
+            for run in text.segmented:
+                for word in run["t"]:
+                    w_tf  = allwords[word]
+                    w_idf = idf[run["l"]][word]
+                    tf[word] = w_tf * w_idf
+                    nf[word] = (0.5 + (0.5 * w_tf)/max_tf) * w_idf
+        db.update_text_statistic('tfidf', text, tf)
+        db.update_text_statistic('nfidf', text, nf)
+
+def vectorized(db):
+    start = time.monotonic()
+    idf = tfidf_v3.corpus_wide_statistics(db, start)
+    tfidf_v3.per_document_statistics(db, idf, start)
+
+def same(a, b):
+    if a.keys() != b.keys():
+        return False
+    return all(math.isclose(a[k], b[k], rel_tol=1e-12) for k in a)
+
+def main():
+    ndocs = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    wpd   = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    sys.stderr.write("generating {} documents...\n".format(ndocs))
+    texts = synthetic_corpus(ndocs, wpd)
+    nwords = sum(len(run["t"]) for text in texts for run in text.segmented)
+
+    results = {}
+    for label, fn in (("reference", reference), ("vectorized", vectorized)):
+        db = MemoryDB(texts)
+        start = time.monotonic()
+        fn(db)
+        elapsed = time.monotonic() - start
+        results[label] = db
+        sys.stdout.write("{:>10}: {:8.2f}s  {:>10.0f} docs/s"
+                         "  {:>12.0f} words/s\n"
+                         .format(label, elapsed, ndocs / elapsed,
+                                 nwords / elapsed))
+
+    ref, vec = results["reference"], results["vectorized"]
+    ok = ref.corpus.keys() == vec.corpus.keys()
+    for lang in ref.corpus:
+        ok = ok and ref.corpus[lang][0] == vec.corpus[lang][0]
+        for stat in ('cwf', 'rdf', 'idf'):
+            ok = ok and same(ref.corpus[lang][1][stat],
+                             vec.corpus[lang][1][stat])
+    for stat in ('tfidf', 'nfidf'):
+        for eid, data in ref.docs[stat].items():
+            ok = ok and same(data, vec.docs[stat][eid])
+    sys.stdout.write("results {}\n".format("agree" if ok else "DIFFER"))
+
+main()
@@ -0,0 +1,326 @@
+#! /usr/bin/python3
+
+# Local cache of Wayback Machine responses, and a server that replays them.
+
+"""Persistent cache of Wayback Machine CDX listings and snapshots.
+
+get_page_histories.py (and its _blind variants) consult this cache
+before going to the network, if the environment variable
+WAYBACK_CACHE names a cache directory.  Everything they fetch
+successfully is added to it, so a restarted history retrieval does
+not repeat traffic it has already done.
+
+Responses are keyed by request URL, always spelled with the canonical
+origin https://web.archive.org.  Bodies are stored content-addressed
+by SHA-256, so identical snapshots and listings take up space only
+once.  Entries are reused conditionally: a snapshot retrieved with an
+explicit timestamp never changes, so it is always reused, but a CDX
+listing grows as the Machine crawls, so it is only reused for thirty
+days.  When the bodies in the cache add up to more than 64GiB (or
+$WAYBACK_CACHE_SIZE bytes), least-recently-used entries are evicted.
+
+Running this module as a program starts an HTTP server which replays
+the cache:
+
+    wayback_cache.py CACHE_DIR [PORT]
+
+Setting WAYBACK_ORIGIN=http://127.0.0.1:PORT then points the history
+retrieval programs at it, so the whole pipeline can be tested and
+benchmarked offline.
+
+Every operation on the cache does synchronous sqlite and file I/O
+(a store may evict many entries).  The history retrieval programs
+therefore never call it from their event loops directly; they go
+through run_in_executor, which runs the call on a thread belonging to
+the cache.  There is only one such thread, so operations on the
+database stay serialized.
+"""
+
+import concurrent.futures
+import hashlib
+import http.server
+import os
+import os.path
+import sqlite3
+import sys
+import time
+import urllib.parse
+
+__all__ = ['WaybackCache', 'CANONICAL_ORIGIN', 'WAYBACK_ORIGIN',
+           'request_url']
+
+CANONICAL_ORIGIN = "https://web.archive.org"
+WAYBACK_ORIGIN = os.environ.get("WAYBACK_ORIGIN", CANONICAL_ORIGIN)
+
+def request_url(query):
+    """Convert QUERY, a URL on CANONICAL_ORIGIN, to the URL that should
+       actually be requested."""
+    if (WAYBACK_ORIGIN != CANONICAL_ORIGIN and
+        query.startswith(CANONICAL_ORIGIN)):
+        return WAYBACK_ORIGIN + query[len(CANONICAL_ORIGIN):]
+    return query
+
+def cdx_key(url):
+    return (CANONICAL_ORIGIN + "/cdx/search/cdx?" +
+            urllib.parse.urlencode([("collapse", "digest"),
+                                    ("fl", "original,timestamp,statuscode"),
+                                    ("url", url)]))
+
+class WaybackCache:
+    def __init__(self, directory, *,
+                 max_bytes=64 * 1024**3, cdx_max_age=30 * 86400):
+        self.directory   = directory
+        self.max_bytes   = max_bytes
+        self.cdx_max_age = cdx_max_age
+        self.n_hits      = 0
+        self.n_misses    = 0
+
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"),
+                                  check_same_thread=False)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS entries (
+                key      TEXT PRIMARY KEY,
+                status   INTEGER NOT NULL,
+                reason   TEXT,
+                location TEXT,
+                ctype    TEXT,
+                body     TEXT REFERENCES blobs(hash),
+                stored   REAL NOT NULL,
+                used     REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_used ON entries(used);
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash     TEXT PRIMARY KEY,
+                size     INTEGER NOT NULL,
+                refs     INTEGER NOT NULL
+            );
+        """)
+        self.total_bytes = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        self._thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    def from_environ(cls):
+        """Return a cache in the directory named by $WAYBACK_CACHE, or
+           None if that variable is not set.  $WAYBACK_CACHE_SIZE, if
+           set, is the size cap in bytes."""
+        directory = os.environ.get("WAYBACK_CACHE")
+        if not directory:
+            return None
+        kwargs = {}
+        if os.environ.get("WAYBACK_CACHE_SIZE"):
+            kwargs["max_bytes"] = int(os.environ["WAYBACK_CACHE_SIZE"])
+        return cls(directory, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        self.close()
+        return False
+
+    def close(self):
+        self._thread.shutdown(wait=True)
+        self.db.close()
+
+    def run_in_executor(self, loop, fn, *args):
+        """Call FN (one of the public methods below) with ARGS on the
+           cache's own thread; returns an asyncio future for LOOP."""
+        return loop.run_in_executor(self._thread, fn, *args)
+
+    # Blob storage
+
+    def _blob_path(self, h):
+        return os.path.join(self.directory, "blobs", h[:2], h[2:])
+
+    def _read_blob(self, h):
+        try:
+            with open(self._blob_path(h), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _add_blob(self, data):
+        h = hashlib.sha256(data).hexdigest()
+        row = self.db.execute("SELECT refs FROM blobs WHERE hash = ?",
+                              (h,)).fetchone()
+        if row is not None:
+            self.db.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?",
+                            (h,))
+            return h
+
+        path = self._blob_path(h)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+        self.db.execute("INSERT INTO blobs (hash, size, refs) VALUES (?,?,1)",
+                        (h, len(data)))
+        self.total_bytes += len(data)
+        return h
+
+    def _drop_blob(self, h):
+        self.db.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?",
+                        (h,))
+        row = self.db.execute("SELECT size FROM blobs"
+                              " WHERE hash = ? AND refs <= 0",
+                              (h,)).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM blobs WHERE hash = ?", (h,))
+            self.total_bytes -= row[0]
+            try:
+                os.remove(self._blob_path(h))
+            except FileNotFoundError:
+                pass
+
+    # Entries
+
+    def _get(self, key, max_age=None):
+        row = self.db.execute(
+            "SELECT status, reason, location, ctype, body, stored"
+            "  FROM entries WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (max_age is not None and now - row[5] > max_age):
+            self.n_misses += 1
+            return None
+
+        status, reason, location, ctype, body, _ = row
+        if body is not None:
+            data = self._read_blob(body)
+            if data is None:
+                # Someone has been tidying up the blob directory.
+                self._delete(key)
+                self.db.commit()
+                self.n_misses += 1
+                return None
+        else:
+            data = None
+
+        self.db.execute("UPDATE entries SET used = ? WHERE key = ?",
+                        (now, key))
+        self.db.commit()
+        self.n_hits += 1
+        return (status, reason, location, ctype, data)
+
+    def _delete(self, key):
+        row = self.db.execute("SELECT body FROM entries WHERE key = ?",
+                              (key,)).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if row[0] is not None:
+                self._drop_blob(row[0])
+
+    def _put(self, key, status, reason, location, ctype, data):
+        self._delete(key)
+        body = self._add_blob(data) if data is not None else None
+        now = time.time()
+        self.db.execute(
+            "INSERT INTO entries"
+            " (key, status, reason, location, ctype, body, stored, used)"
+            " VALUES (?,?,?,?,?,?,?,?)",
+            (key, status, reason, location, ctype, body, now, now))
+        self._evict()
+        self.db.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            victims = self.db.execute(
+                "SELECT key FROM entries ORDER BY used LIMIT 64").fetchall()
+            if not victims:
+                break
+            for (key,) in victims:
+                self._delete(key)
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    # Public interface
+
+    def get_cdx(self, url):
+        """Return the text of the CDX listing for URL, or None if it is
+           not cached or too old to reuse."""
+        hit = self._get(cdx_key(url), self.cdx_max_age)
+        if hit is None:
+            return None
+        return hit[4].decode("utf-8")
+
+    def put_cdx(self, url, text):
+        self._put(cdx_key(url), 200, "OK", None, "text/plain",
+                  text.encode("utf-8"))
+
+    def get_page(self, query):
+        """Return (status, reason, location, ctype, data) for QUERY, a
+           snapshot URL, or None if it is not cached."""
+        return self._get(query)
+
+    def put_page(self, query, status, reason, location, ctype, data):
+        # Server errors are transient by definition.
+        if status >= 500:
+            return
+        self._put(query, status, reason, location, ctype, data)
+
+#
+# Replay server
+#
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        split = urllib.parse.urlsplit(self.path)
+        if split.path == "/cdx/search/cdx":
+            params = dict(urllib.parse.parse_qsl(split.query))
+            text = self.cache.get_cdx(params.get("url", ""))
+            if text is None:
+                self.send_miss()
+            else:
+                self.send_cached(200, "OK", None, "text/plain",
+                                 text.encode("utf-8"))
+            return
+
+        hit = self.cache.get_page(CANONICAL_ORIGIN + self.path)
+        if hit is None:
+            hit = self.cache.get_page(
+                CANONICAL_ORIGIN + urllib.parse.unquote(self.path))
+        if hit is None:
+            self.send_miss()
+        else:
+            self.send_cached(*hit)
+
+    def send_cached(self, status, reason, location, ctype, data):
+        self.send_response(status, reason)
+        if location:
+            self.send_header("Location", location)
+        if ctype:
+            self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data or b"")))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def send_miss(self):
+        sys.stderr.write("replay: not cached: {}\n".format(self.path))
+        self.send_error(404, "Not in replay cache")
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(directory, port):
+    with WaybackCache(directory) as cache:
+        ReplayHandler.cache = cache
+        server = http.server.HTTPServer(("127.0.0.1", port), ReplayHandler)
+        sys.stderr.write("replaying {} on http://127.0.0.1:{}/\n"
+                         .format(directory, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            sys.stderr.write("replay: {} hits, {} misses\n"
+                             .format(cache.n_hits, cache.n_misses))
+
+if __name__ == '__main__':
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8765)
@@ -1,8 +1,29 @@
 from collections import defaultdict
+import itertools
+import json
+import os
 import regex as re
+import tempfile
 import unicodedata
+import zlib
+
+__all__ = ('segment', 'segment_many', 'segment_iter', 'presegment',
+           'presegment_iter', 'iter_segmented_json', 'is_nonword', 'is_url',
+           'memo_stats')
+
+# Bump this whenever a change to this package (or to any of the
+# external segmenters) changes the output of segment().  It is part
+# of the key for memoized results (see memo.py).
+SEGMENTER_VERSION = "1"
+
+# Segmenters that want many words at a time are given the words of
+# this many whitespace-delimited tokens at once by segment(), so that
+# memory use does not grow with the length of the text.
+STREAM_WINDOW = 8192
+
+# The Vietnamese segmenter is given runs of at most this many words.
+VI_MAX_RUN = 8192
 
-__all__ = ('segment', 'presegment', 'is_nonword', 'is_url')
 
 def get_url_re():
     # https://data.iana.org/TLD/tlds-alpha-by-domain.txt
@@ -169,6 +190,98 @@ def get_url_re():
     """
     return re.compile(url_re, re.VERBOSE|re.IGNORECASE)
 
+def char_class_ranges(codepoints):
+    """Express a sorted list of code points as the body of a regex
+       character class, in terms of ranges of escaped characters.
+       Written this way, the classes compile much faster than when
+       they list every character individually."""
+    out = []
+    i = 0
+    while i < len(codepoints):
+        j = i
+        while (j + 1 < len(codepoints) and
+               codepoints[j + 1] == codepoints[j] + 1):
+            j += 1
+        if i == j:
+            out.append("\\U{:08x}".format(codepoints[i]))
+        else:
+            out.append("\\U{:08x}-\\U{:08x}"
+                       .format(codepoints[i], codepoints[j]))
+        i = j + 1
+    return "".join(out)
+
+def build_char_classes():
+    """Scan the entire Unicode character set and return the contents
+       of the character classes used by Segmenter, as a dictionary of
+       strings.  This takes a second or two; use load_char_classes."""
+    symbols_s = []
+    symbols_t = []
+    digits    = []
+    white     = []
+    for c in range(0x10FFFF):
+        x = chr(c)
+        cat = unicodedata.category(x)
+        if cat[0] in ('P', 'S'): # Punctuation, Symbols
+            # These symbol characters may appear inside a word without
+            # breaking it in two.  FIXME: Any others?
+            symbols_t.append(c)
+            if x not in ('-', '‐', '\'', '’', '.'):
+                symbols_s.append(c)
+
+        elif cat[0] == 'N':
+            digits.append(c)
+
+        # Treat all C0 and C1 controls the same as whitespace.
+        # (\t\r\n\v\f are *not* in class Z.)
+        elif cat[0] == 'Z' or cat in ('Cc', 'Cf'):
+            white.append(c)
+
+    return {
+        "unidata_version": unicodedata.unidata_version,
+        "symbols_s":       char_class_ranges(symbols_s),
+        "symbols_t":       char_class_ranges(symbols_t),
+        "digits":          char_class_ranges(digits),
+        "white":           char_class_ranges(white),
+    }
+
+def char_class_cache_path():
+    """The character classes depend only on the version of the Unicode
+       database, so they are cached in a file named after it, under
+       $WORD_SEG_CACHE_DIR or else $XDG_CACHE_HOME/word_seg."""
+    cachedir = os.environ.get("WORD_SEG_CACHE_DIR")
+    if not cachedir:
+        cachedir = os.path.join(
+            os.environ.get("XDG_CACHE_HOME",
+                           os.path.expanduser("~/.cache")),
+            "word_seg")
+    return os.path.join(cachedir, "charclasses-{}.json.z"
+                        .format(unicodedata.unidata_version))
+
+def load_char_classes():
+    """Return the character classes used by Segmenter, from the cache
+       if possible; otherwise build them and try to save them in the
+       cache for next time.  Any problem with the cache just means
+       building the classes from scratch."""
+    path = char_class_cache_path()
+    try:
+        with open(path, "rb") as f:
+            classes = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+        if classes.get("unidata_version") == unicodedata.unidata_version:
+            return classes
+    except (OSError, ValueError, zlib.error):
+        pass
+
+    classes = build_char_classes()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(zlib.compress(json.dumps(classes).encode("ascii")))
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return classes
+
 class Segmenter:
     """Segmenter is a singleton object which does lazy initialization of
        the various external segmenters, some of which are quite
@@ -177,39 +290,12 @@ class Segmenter:
        and nonwords (nonwords consist entirely of digits and punctuation).
     """
 
-    def __init__(self):
-        symbols_s = []
-        symbols_t = []
-        digits    = []
-        white     = []
-        for c in range(0x10FFFF):
-            x = chr(c)
-            cat = unicodedata.category(x)
-            if cat[0] in ('P', 'S'): # Punctuation, Symbols
-                # These symbol characters may appear inside a word without
-                # breaking it in two.  FIXME: Any others?
-                split = (x not in ('-', '‐', '\'', '’', '.'))
-
-                # These characters need to be escaped inside a character class.
-                if (x in '\\', '[', ']', '-'):
-                    x = '\\' + x
-
-                symbols_t.append(x)
-                if split:
-                    symbols_s.append(x)
-
-            elif cat[0] == 'N':
-                digits.append(x)
-
-            # Treat all C0 and C1 controls the same as whitespace.
-            # (\t\r\n\v\f are *not* in class Z.)
-            elif cat[0] == 'Z' or cat in ('Cc', 'Cf'):
-                white.append(x)
-
-        symbols_s = "".join(symbols_s)
-        symbols_t = "".join(symbols_t)
-        digits    = "".join(digits)
-        white     = "".join(white)
+    def __init__(self, memo=None):
+        classes   = load_char_classes()
+        symbols_s = classes["symbols_s"]
+        symbols_t = classes["symbols_t"]
+        digits    = classes["digits"]
+        white     = classes["white"]
 
         self.white      = re.compile("["  +             white +          "]+")
         self.split      = re.compile("["  + symbols_s + white +          "]+")
@@ -218,6 +304,7 @@ class Segmenter:
         self.right_trim = re.compile("["  + symbols_t + white +          "]+$")
 
         self.url = None
+        self.memo = memo
 
         self.mecab      = None
         self.dongdu     = None
@@ -243,6 +330,17 @@ class Segmenter:
                 'ur':      self._lang_segment_ar
             })
 
+        # For segment_many: the segmenters that can take all of the
+        # words of many texts at once, and the function that does so.
+        # (Vietnamese can't, because it needs to see whole phrases.)
+        self._word_segmenters = {
+            self._lang_segment_default: self._words_default,
+            self._lang_segment_zh:      self._words_zh,
+            self._lang_segment_ja:      self._words_ja,
+            self._lang_segment_th:      self._words_th,
+            self._lang_segment_ar:      self._words_ar,
+        }
+
     # Public entry points:
     def is_url(self, text):
         """If TEXT contains an URL, return that URL. Otherwise, return None."""
@@ -260,12 +358,80 @@ class Segmenter:
         """Perform generic word segmentation on TEXT.  Returns an iterable."""
         return self._lang_segment_default(text)
 
+    def presegment_iter(self, text):
+        """Perform generic word segmentation on TEXT.  Returns an
+           iterator which produces each word as it is found, so memory
+           use does not depend on the length of TEXT."""
+        return self._lang_segment_default(text)
+
+    @classmethod
+    def from_environ(cls):
+        """Return a Segmenter that uses the memo file named by
+           $WORD_SEG_MEMO, if that variable is set."""
+        from . import memo
+        return cls(memo=memo.SegmentationMemo.from_environ(
+            "{}/{}".format(SEGMENTER_VERSION, unicodedata.unidata_version)))
+
     def segment(self, lang, text):
         """Perform language-aware word segmentation on TEXT.
            Returns an iterable."""
+        if self.memo is None:
+            return self._lang_segmenters[lang](text)
+        return iter(self.segment_many([(lang, text)])[0])
+
+    def segment_iter(self, lang, text):
+        """Perform language-aware word segmentation on TEXT.  Returns
+           an iterator which produces the words a little at a time, so
+           memory use does not depend on the length of TEXT.  This
+           bypasses the memo, which can only store whole results."""
         return self._lang_segmenters[lang](text)
 
+    def segment_many(self, pairs):
+        """Perform language-aware word segmentation on each of PAIRS,
+           an iterable of (lang, text) tuples.  Texts that use the same
+           segmenter are grouped together, and each distinct word in
+           a group is segmented only once, in a single call to the
+           segmenter.  Returns a list of lists of words, in the same
+           order as PAIRS."""
+        pairs = list(pairs)
+        if self.memo is None:
+            return self._segment_many_internal(pairs)
+
+        results, keys = self.memo.lookup_many(pairs)
+        misses = [i for i, r in enumerate(results) if r is None]
+        if misses:
+            segmented = self._segment_many_internal(
+                [pairs[i] for i in misses])
+            for i, words in zip(misses, segmented):
+                results[i] = words
+            self.memo.store_many([(keys[i], results[i]) for i in misses])
+        return results
+
+    def memo_stats(self):
+        """Hit and miss counts for the memo, or None if there isn't one."""
+        if self.memo is None:
+            return None
+        return self.memo.stats()
+
     # Internal:
+    def _segment_many_internal(self, pairs):
+        groups = defaultdict(list)
+        for i, (lang, _) in enumerate(pairs):
+            groups[self._lang_segmenters[lang]].append(i)
+
+        results = [None] * len(pairs)
+        for lang_seg, indices in groups.items():
+            batch_seg = self._word_segmenters.get(lang_seg)
+            if batch_seg is None:
+                for i in indices:
+                    results[i] = list(lang_seg(pairs[i][1]))
+            else:
+                segmented = self._presegment_many(
+                    [pairs[i][1] for i in indices], batch_seg)
+                for i, words in zip(indices, segmented):
+                    results[i] = words
+        return results
+
     def _presegment_internal(self, text, language_seg):
         """Presegmentation is independent of language.  It first splits on
            (Unicode) whitespace, then detects embedded URLs which are
@@ -274,7 +440,7 @@ class Segmenter:
            punctuation.  Anything that survives that process is fed to the
            language-specific segmenter.
         """
-        for word in self.white.split(text):
+        for word in self.white.splititer(text):
             u = self.is_url(word)
             if u:
                 yield u
@@ -286,43 +452,131 @@ class Segmenter:
                         for lw in language_seg(w):
                             yield unicodedata.normalize('NFKC', lw).casefold()
 
+    def _presegment_units(self, text_tokens, words, tokens):
+        """The first half of _presegment_internal: split TEXT_TOKENS,
+           the whitespace-delimited tokens of a text, into units, each
+           of which is either an URL (a string) or the position in
+           WORDS of a word that survived presegmentation.  TOKENS
+           caches the units of each token already seen, so that
+           repeated tokens (and the words in them) are only processed,
+           and added to WORDS, once."""
+        units = []
+        for token in text_tokens:
+            tunits = tokens.get(token)
+            if tunits is None:
+                tunits = tokens[token] = self._token_units(token, words)
+            units.extend(tunits)
+        return units
+
+    def _token_units(self, token, words):
+        u = self.is_url(token)
+        if u:
+            return (u,)
+        tunits = []
+        for w in self.split.split(token):
+            w = self.left_trim.sub("", w)
+            if w:
+                tunits.append(len(words))
+                words.append(self.right_trim.sub("", w))
+        return tuple(tunits)
+
+    @staticmethod
+    def _assemble_units(units, segmented):
+        """The second half of _presegment_internal: replace each word
+           position in UNITS with the segmentation of that word, from
+           SEGMENTED, normalized.  Returns a list of lists of words,
+           one for each list of units."""
+        normalized = [[unicodedata.normalize('NFKC', lw).casefold()
+                       for lw in seg]
+                      for seg in segmented]
+        results = []
+        for tunits in units:
+            out = []
+            for unit in tunits:
+                if isinstance(unit, str):
+                    out.append(unit)
+                else:
+                    out.extend(normalized[unit])
+            results.append(out)
+        return results
+
+    def _presegment_batched(self, text, batch_seg):
+        """Like _presegment_internal, but BATCH_SEG is called with a
+           list of all the distinct words that survive presegmentation
+           in each STREAM_WINDOW tokens of TEXT, and must return a list
+           of the segmentations of each.  This is for segmenters that
+           are much more efficient when given many words at a time."""
+        text_tokens = self.white.splititer(text)
+        while True:
+            window = list(itertools.islice(text_tokens, STREAM_WINDOW))
+            if not window:
+                return
+            words = []
+            units = self._presegment_units(window, words, {})
+            segmented = batch_seg(words) if words else []
+            yield from self._assemble_units([units], segmented)[0]
+
+    def _presegment_many(self, texts, batch_seg):
+        """Like _presegment_batched, but for a list of TEXTS, all of
+           whose words go to BATCH_SEG in a single call.  Returns a
+           list of lists of words, one for each text."""
+        words = []
+        tokens = {}
+        units = [self._presegment_units(self.white.splititer(text),
+                                        words, tokens)
+                 for text in texts]
+        segmented = batch_seg(words) if words else []
+        return self._assemble_units(units, segmented)
+
     def _lang_segment_default(self, text):
         """The default behavior is just to do presegmentation."""
         return self._presegment_internal(text, lambda word: (word,))
 
+    def _words_default(self, words):
+        return [(word,) for word in words]
+
     # Thai: libthai/pythai
     def _lang_segment_th(self, text):
+        return self._presegment_batched(text, self._words_th)
+
+    def _words_th(self, words):
         if self.pythai is None:
             from . import pythai
             self.pythai = pythai
 
-        return self._presegment_internal(text, self.pythai.split)
+        return [self.pythai.split(word) for word in words]
 
     # Japanese: MeCab
     def _lang_segment_ja(self, text):
+        return self._presegment_batched(text, self._words_ja)
+
+    def _words_ja(self, words):
         if self.mecab is None:
             # '-O wakati' means "put spaces between the words"
             import MeCab
             self.mecab = MeCab.Tagger('-O wakati')
 
-        return self._presegment_internal(
-            text, lambda word: self.mecab.parse(word).split())
+        return [self.mecab.parse(word).split() for word in words]
 
     # Chinese: SNLP
     def _lang_segment_zh(self, text):
+        return self._presegment_batched(text, self._words_zh)
+
+    def _words_zh(self, words):
         if self.s_chinese is None:
             from . import stanford
-            self.s_chinese = stanford.ChineseSegmenter()
-        return self._presegment_internal(
-            text, lambda word: self.s_chinese.segment(word))
+            self.s_chinese = stanford.get_segmenter("zh")
+        return self.s_chinese.segment_batch(words)
 
     # Arabic and related languages: SNLP + heuristics
     def _lang_segment_ar(self, text):
+        return self._presegment_batched(text, self._words_ar)
+
+    def _words_ar(self, words):
         if self.s_arabic is None:
             from . import stanford
-            self.s_arabic = stanford.ArabicSegmenter()
-        return self._presegment_internal(
-            text, lambda word: self.s_arabic.segment(word))
+            self.s_arabic = stanford.get_segmenter("ar")
+        return self.s_arabic.segment_batch(words)
 
     # Vietnamese: dongdu
     # In Vietnamese, spaces appear _within_ every multisyllabic word.
@@ -346,7 +600,7 @@ class Segmenter:
                         yield self.right_trim.sub("", w).casefold()
                 run = []
 
-        for word in self.white.split(text):
+        for word in self.white.splititer(text):
             u = self.is_url(word)
             if u:
                 yield from flush()
@@ -357,31 +611,89 @@ class Segmenter:
                     if w:
                         w = self.right_trim.sub("", w)
                         run.append(unicodedata.normalize('NFKC', w))
+                # Very long runs are broken up (between tokens) to
+                # bound memory; this may split one word in VI_MAX_RUN.
+                if len(run) >= VI_MAX_RUN:
+                    yield from flush()
 
         yield from flush()
 
+def iter_segmented_json(chunks, batch=1024):
+    """Encode CHUNKS, an iterable of (lang, words) pairs, in which
+       WORDS may be any iterable of strings, as the JSON array
+
+           [{"l": lang, "t": [word, ...]}, ...]
+
+       exactly as json.dumps would encode the equivalent list, but
+       producing the text a piece at a time (every BATCH words), so
+       the words never need to be held in memory all at once.  With
+       segment_iter, this lets a huge text be segmented and encoded
+       in memory proportional to its encoded size, not to the number
+       of words in it."""
+    enc = json.encoder.encode_basestring_ascii
+    yield "["
+    sep = ""
+    for lang, words in chunks:
+        yield sep + '{"l": ' + enc(lang) + ', "t": ['
+        sep = ", "
+        wsep = ""
+        pending = []
+        for word in words:
+            pending.append(enc(word))
+            if len(pending) >= batch:
+                yield wsep + ", ".join(pending)
+                wsep = ", "
+                pending = []
+        if pending:
+            yield wsep + ", ".join(pending)
+        yield "]}"
+    yield "]"
+
+def stanford_service(jvms=1):
+    """Context manager which runs one set of Stanford segmenters (for
+       Chinese and Arabic) to be shared by this process and all the
+       processes it starts while the context is active, rather than
+       each starting its own.  See stanford/service.py."""
+    from .stanford import service
+    return service.running(jvms)
+
 _segmenter = None
 def presegment(text):
     global _segmenter
-    if _segmenter is None: _segmenter = Segmenter()
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
     return _segmenter.presegment(text)
 
 def segment(lang, text):
     global _segmenter
-    if _segmenter is None: _segmenter = Segmenter()
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
     return _segmenter.segment(lang, text)
 
+def segment_many(pairs):
+    global _segmenter
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
+    return _segmenter.segment_many(pairs)
+
+def segment_iter(lang, text):
+    global _segmenter
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
+    return _segmenter.segment_iter(lang, text)
+
 def presegment_iter(text):
     global _segmenter
-    if _segmenter is None: _segmenter = Segmenter()
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
     return _segmenter.presegment_iter(text)
 
 def is_url(text):
     global _segmenter
-    if _segmenter is None: _segmenter = Segmenter()
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
     return _segmenter.is_url(text)
 
 def is_nonword(text):
     global _segmenter
-    if _segmenter is None: _segmenter = Segmenter()
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
     return _segmenter.is_nonword(text)
+
+def memo_stats():
+    global _segmenter
+    if _segmenter is None: _segmenter = Segmenter.from_environ()
+    return _segmenter.memo_stats()
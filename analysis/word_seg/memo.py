@@ -0,0 +1,180 @@
+# Persistent memo of segmentation results.
+
+"""Segmentation memo.
+
+The same text turns up over and over: historical snapshots of a page
+that did not change, the same page captured from several locales,
+boilerplate shared by every page of a site.  Segmenting it again each
+time is wasted work.  If the environment variable MEMO_ENV names a
+file, word_seg.segment and word_seg.segment_many look each (language,
+text) pair up in that file first, and add whatever they had to
+segment to it.  Any number of processes can share one memo file.
+
+Each entry is keyed by the SHA-256 of the segmenter version, the
+language, and the text; changing word_seg.SEGMENTER_VERSION (or the
+Unicode database) therefore invalidates everything recorded before.
+The file is a sequence of records,
+
+    key (32 bytes) | length (4 bytes, big-endian) | words
+
+where WORDS is the segmented words, in UTF-8, separated by newlines
+(no word can contain a newline, as they are split on whitespace).
+Records are only ever appended, so the file can be mapped into memory
+and read without locking; appends are serialized with flock().  A
+record cut short by a crash is discarded by the next writer.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+
+MEMO_ENV = "WORD_SEG_MEMO"
+
+_HEADER = struct.Struct(">32sI")
+
+def memo_key(version, lang, text):
+    h = hashlib.sha256()
+    h.update(version.encode("utf-8"))
+    h.update(b"\0")
+    h.update(lang.encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8", "surrogatepass"))
+    return h.digest()
+
+class SegmentationMemo:
+    """A memo file of segmentation results, for segmenter VERSION."""
+
+    def __init__(self, path, version):
+        self.path     = path
+        self.version  = version
+        self.n_hits   = 0
+        self.n_misses = 0
+        self.n_stored = 0
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._fd    = os.open(path, os.O_RDWR|os.O_CREAT, 0o666)
+        self._map   = None
+        self._index = {}   # key -> (offset of words, length of words)
+        self._end   = 0    # end of the last complete record indexed
+        self._refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        self.close()
+        return False
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def hit_rate(self):
+        lookups = self.n_hits + self.n_misses
+        return self.n_hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return { "hits":     self.n_hits,
+                 "misses":   self.n_misses,
+                 "stored":   self.n_stored,
+                 "entries":  len(self._index),
+                 "hit_rate": self.hit_rate() }
+
+    def _refresh(self):
+        """Index any records that other processes have appended since
+           we last looked.  Returns the offset just past the last
+           complete record."""
+        size = os.fstat(self._fd).st_size
+        if size <= self._end:
+            return self._end
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+
+        pos = self._end
+        while pos + _HEADER.size <= size:
+            key, length = _HEADER.unpack_from(self._map, pos)
+            start = pos + _HEADER.size
+            if start + length > size:
+                break
+            self._index[key] = (start, length)
+            pos = start + length
+        self._end = pos
+        return pos
+
+    def _get(self, key):
+        loc = self._index.get(key)
+        if loc is None:
+            return None
+        start, length = loc
+        if not length:
+            return []
+        return self._map[start:start+length].decode(
+            "utf-8", "surrogatepass").split("\n")
+
+    def lookup_many(self, pairs):
+        """Look up each of PAIRS, a list of (lang, text) tuples.
+           Returns a list with the memoized words for each pair, or
+           None where there are none, and the list of keys (for
+           store_many)."""
+        keys = [memo_key(self.version, lang, text) for lang, text in pairs]
+        if any(k not in self._index for k in keys):
+            self._refresh()
+        results = [self._get(k) for k in keys]
+        hits = sum(1 for r in results if r is not None)
+        self.n_hits   += hits
+        self.n_misses += len(results) - hits
+        return results, keys
+
+    def lookup(self, lang, text):
+        results, _ = self.lookup_many([(lang, text)])
+        return results[0]
+
+    def store_many(self, entries):
+        """Record ENTRIES, a list of (key, words) pairs."""
+        records = []
+        seen = set()
+        for key, words in entries:
+            if key in self._index or key in seen:
+                continue
+            seen.add(key)
+            body = "\n".join(words).encode("utf-8", "surrogatepass")
+            records.append(_HEADER.pack(key, len(body)) + body)
+        if not records:
+            return
+
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            end = self._refresh()
+            # Discard any partial record left at the end by a crash.
+            if os.fstat(self._fd).st_size != end:
+                os.ftruncate(self._fd, end)
+            os.lseek(self._fd, end, os.SEEK_SET)
+            data = b"".join(records)
+            while data:
+                n = os.write(self._fd, data)
+                data = data[n:]
+            self.n_stored += len(records)
+            self._refresh()
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def store(self, lang, text, words):
+        self.store_many([(memo_key(self.version, lang, text), words)])
+
+    @classmethod
+    def from_environ(cls, version):
+        """Return the memo named by $WORD_SEG_MEMO, or None if that
+           variable is not set."""
+        path = os.environ.get(MEMO_ENV)
+        if not path:
+            return None
+        return cls(path, version)
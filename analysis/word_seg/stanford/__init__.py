@@ -1,4 +1,9 @@
 # Arabic (and Farsi) segmentation based on Stanford NLP.
+#
+# Each Segmenter runs its own JVM.  Programs that segment in many
+# worker processes can share one JVM per model among them instead,
+# by running the segmenter service (see service.py); get_segmenter()
+# returns a client for the service when one is running.
 
 import fcntl
 import os
@@ -16,6 +21,16 @@ CHINESE_DATA  = os.path.join(PKGDIR, "chinese")
 # This constant isn't in os.
 PIPE_BUF = 4096
 
+# If this environment variable is set, it names the Unix socket of a
+# running segmenter service.
+SERVICE_SOCKET_ENV = "WORD_SEG_STANFORD_SOCKET"
+
+# Sentinel value marking the end of each text's words.  This has to
+# pass through the segmenter proper unmolested, and also has to be
+# something extraordinarily unlikely to appear in the text itself.
+# U+FDD0 is an official permanent noncharacter.
+SENTINEL = "\uFDD0"
+
 # It may be necessary to convert .xz to .gz files on the fly.  (This
 # is for cases where the .gz file would be so big that Github won't
 # take it.)
@@ -47,7 +62,7 @@ def _read_all_available(f):
     assert len(events) == 1
     assert events[0][0] == f
     if events[0][1] == select.POLLHUP:
-        raise subprocess.CalledProcessError("Stanford NLP segmenter has exited")
+        raise RuntimeError("Stanford NLP segmenter has exited")
 
     chunks = []
     while True:
@@ -60,7 +75,7 @@ def _read_all_available(f):
         chunks.append(c)
 
     if not chunks:
-        raise subprocess.CalledProcessError("Stanford NLP segmenter has exited")
+        raise RuntimeError("Stanford NLP segmenter has exited")
 
     return b"".join(chunks).decode("utf-8")
 
@@ -91,6 +106,8 @@ def _write_many_chunks(f, q):
         return
 
 class Segmenter:
+    _proc = None
+
     def __init__(self):
         self._presegment_re = self._get_presegment_re()
 
@@ -105,37 +122,49 @@ class Segmenter:
 
 
     def __del__(self):
-        self._proc.terminate()
-        self._proc.wait()
+        self.close()
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
 
     def segment(self, text):
+        """Segment TEXT, which is a string or a list of strings, and
+           return an iterable of words."""
+        return iter(self.segment_batch([text])[0])
+
+    def segment_batch(self, texts):
+        """Segment each of TEXTS (strings, or lists of strings) and
+           return a list of lists of words, one for each text.  All of
+           the texts go through the segmenter in one stream."""
         presegmented = deque()
-        if isinstance(text, str):
-            text = [text]
-        for block in text:
-            for token in self._presegment_re.finditer(block):
-                presegmented.extend(token.group(0).split())
-
-        # Sentinel value to tell us when we're done with this block of
-        # text.  This has to pass through the segmenter proper
-        # unmolested, and also has to be something extraordinarily
-        # unlikely to appear in the text itself.  U+FDD0 is an
-        # official permanent noncharacter.
-        presegmented.append("\uFDD0")
-        while presegmented:
-            _write_many_chunks(self._proc.stdin, presegmented)
-            result = _read_all_available(self._proc.stdout)
-            for word in result.split():
-                if word == "\uFDD0":
-                    return
-                yield word
-
-        while True:
-            result = _read_all_available(self._proc.stdout)
-            for word in result.split():
-                if word == "\uFDD0":
-                    return
-                yield word
+        for text in texts:
+            if isinstance(text, str):
+                text = [text]
+            for block in text:
+                for token in self._presegment_re.finditer(block):
+                    presegmented.extend(token.group(0).split())
+            presegmented.append(SENTINEL)
+
+        results = [[]]
+        partial = ""
+        while len(results) <= len(texts):
+            if presegmented:
+                _write_many_chunks(self._proc.stdin, presegmented)
+            # Only whole lines of output can be split into words.
+            output = partial + _read_all_available(self._proc.stdout)
+            output, _, partial = output.rpartition("\n")
+            for word in output.split():
+                if word == SENTINEL:
+                    results.append([])
+                else:
+                    results[-1].append(word)
+
+        # The sentinel after the last text opens an extra list.
+        results.pop()
+        return results
 
 class ArabicSegmenter(Segmenter):
     SEGMENTER_INVOCATION = [
@@ -262,3 +291,18 @@ class ChineseSegmenter(Segmenter):
             """.format(c=chinese, C=not_chinese), re.VERBOSE)
 
         return cls._PRESEGMENT_RE
+
+SEGMENTERS = {
+    "zh": ChineseSegmenter,
+    "ar": ArabicSegmenter,
+}
+
+def get_segmenter(model):
+    """Return a segmenter for MODEL (a key of SEGMENTERS): a client for
+       the segmenter service if one is running (see service.py), or
+       else a Segmenter with its own JVM."""
+    path = os.environ.get(SERVICE_SOCKET_ENV)
+    if path:
+        from .service import SegmenterClient
+        return SegmenterClient(model, path)
+    return SEGMENTERS[model]()
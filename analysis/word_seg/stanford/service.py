@@ -0,0 +1,302 @@
+# A segmentation service shared by many worker processes.
+
+"""Stanford segmenter service.
+
+Each Stanford segmenter is a JVM with a gigabyte or two of heap, and
+takes several seconds to warm up.  When a program segments text in a
+pool of worker processes, giving each worker its own JVMs multiplies
+both costs by the size of the pool.  Instead, the program can start
+this service before it creates the pool:
+
+    with word_seg.stanford_service():
+        with multiprocessing.Pool() as pool:
+            ...
+
+The service listens on a Unix socket, whose path is passed to the
+workers in the environment variable SERVICE_SOCKET_ENV; get_segmenter()
+notices it and returns a SegmenterClient instead of starting a JVM.
+The service starts at most JVMS segmenters per model (default one),
+each when it is first needed, and hands each request to whichever of
+them is idle.
+
+Each segmenter JVM handles one batch at a time: it reads texts from a
+single pipe and answers in order.  So with the default of one JVM per
+model, concurrent requests for a model wait their turn, and a pool of
+N workers segments that language no faster than one worker with a JVM
+of its own, in 1/N of the memory.  That is the trade this service
+exists to make, since segmentation through the JVM is usually a small
+part of a worker's time.  Where it is not, each additional JVM buys
+back one stream of parallelism for one more heap; there is no point
+in more JVMs than workers.
+
+Requests and responses are frames: a 4-byte big-endian length,
+followed by that many bytes of UTF-8 JSON.  A request is
+
+    {"model": "zh", "texts": [TEXT, ...]}
+
+where each TEXT is a string or a list of strings, as for
+Segmenter.segment_batch.  The response is either
+
+    {"words": [[WORD, ...], ...]}
+
+with one list of words for each text, or {"error": MESSAGE}.  A
+connection may carry any number of requests, one at a time.
+
+The service can also be run by hand:
+
+    python3 -m word_seg.stanford.service [--jvms N] SOCKET
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from . import SEGMENTERS, SERVICE_SOCKET_ENV
+
+# Frames larger than this are refused.
+MAX_FRAME = 256 * 1024 * 1024
+
+_LENGTH = struct.Struct(">I")
+
+def _recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while n:
+        got = sock.recv_into(view[len(buf)-n:], n)
+        if not got:
+            return None
+        n -= got
+    return buf
+
+def recv_frame(sock):
+    """Receive one frame from SOCK and return its decoded contents, or
+       None if the peer closed the connection between frames."""
+    header = _recv_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    (length,) = _LENGTH.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError("frame too large: {} bytes".format(length))
+    body = _recv_exactly(sock, length)
+    if body is None:
+        raise ConnectionError("connection closed in the middle of a frame")
+    return json.loads(body.decode("utf-8"))
+
+def send_frame(sock, obj):
+    body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    sock.sendall(_LENGTH.pack(len(body)) + body)
+
+class SegmenterPool:
+    """Up to JVMS segmenters for MODEL, started as needed."""
+
+    def __init__(self, model, jvms):
+        self.cls      = SEGMENTERS[model]
+        self.jvms     = jvms
+        self.idle     = []
+        self.nstarted = 0
+        self.cond     = threading.Condition()
+
+    def _acquire(self):
+        """Take an idle segmenter, or start one if there are fewer than
+           JVMS, or wait until one of those becomes possible.  A thread
+           waiting here is woken both when a segmenter is put back and
+           when one is lost, so that it can start the replacement."""
+        with self.cond:
+            while not self.idle and self.nstarted >= self.jvms:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.nstarted += 1
+        try:
+            return self.cls()
+        except:
+            self._lost()
+            raise
+
+    def _release(self, seg):
+        with self.cond:
+            self.idle.append(seg)
+            self.cond.notify()
+
+    def _lost(self):
+        with self.cond:
+            self.nstarted -= 1
+            self.cond.notify()
+
+    def segment_batch(self, texts):
+        seg = self._acquire()
+        try:
+            result = seg.segment_batch(texts)
+        except:
+            # The JVM may have died; start a fresh one next time.
+            seg.close()
+            self._lost()
+            raise
+        self._release(seg)
+        return result
+
+    def close(self):
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for seg in idle:
+            seg.close()
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except (ValueError, ConnectionError) as e:
+                sys.stderr.write("segmenter service: {}\n".format(e))
+                return
+            if request is None:
+                return
+            try:
+                words = self.server.pool(request["model"]) \
+                                   .segment_batch(request["texts"])
+                response = { "words": words }
+            except Exception as e:
+                response = { "error": "{}: {}".format(type(e).__name__, e) }
+            send_frame(self.request, response)
+
+class SegmenterServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, jvms=1):
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.jvms   = jvms
+        self.pools  = {}
+        self.plock  = threading.Lock()
+
+    def pool(self, model):
+        with self.plock:
+            pool = self.pools.get(model)
+            if pool is None:
+                pool = self.pools[model] = SegmenterPool(model, self.jvms)
+            return pool
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        for pool in self.pools.values():
+            pool.close()
+
+class SegmenterClient:
+    """Drop-in replacement for a Segmenter, which sends its work to the
+       service listening at PATH."""
+
+    def __init__(self, model, path):
+        self.model = model
+        self.path  = path
+        self._sock = None
+        self._pid  = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def segment(self, text):
+        return iter(self.segment_batch([text])[0])
+
+    def segment_batch(self, texts):
+        with self._lock:
+            # A connection must not be shared with a forked child.
+            if self._sock is None or self._pid != os.getpid():
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(self.path)
+                self._pid = os.getpid()
+            try:
+                send_frame(self._sock, { "model": self.model,
+                                         "texts": list(texts) })
+                response = recv_frame(self._sock)
+            except:
+                self.close()
+                raise
+        if response is None:
+            self.close()
+            raise ConnectionError("segmenter service closed the connection")
+        if "error" in response:
+            raise RuntimeError("segmenter service: " + response["error"])
+        return response["words"]
+
+@contextlib.contextmanager
+def running(jvms=1, timeout=60):
+    """Context manager which runs the service in a subprocess, and
+       sets SERVICE_SOCKET_ENV so that this process, and any process
+       it starts, will use it.  If the variable is already set, the
+       service it names is used instead."""
+    if os.environ.get(SERVICE_SOCKET_ENV):
+        yield os.environ[SERVICE_SOCKET_ENV]
+        return
+
+    with tempfile.TemporaryDirectory(prefix="word-seg-") as tmpdir:
+        path = os.path.join(tmpdir, "stanford.sock")
+        libdir = os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [libdir] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep)
+                        if p])
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "word_seg.stanford.service",
+             "--jvms", str(jvms), path], env=env)
+        try:
+            deadline = time.monotonic() + timeout
+            while not os.path.exists(path):
+                if proc.poll() is not None:
+                    raise RuntimeError("segmenter service exited with "
+                                       "status {}".format(proc.returncode))
+                if time.monotonic() > deadline:
+                    raise RuntimeError("segmenter service did not start")
+                time.sleep(0.05)
+
+            os.environ[SERVICE_SOCKET_ENV] = path
+            try:
+                yield path
+            finally:
+                del os.environ[SERVICE_SOCKET_ENV]
+        finally:
+            proc.terminate()
+            proc.wait()
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Run Stanford segmenters for other processes.")
+    ap.add_argument("--jvms", type=int, default=1,
+                    help="Maximum number of JVMs per model (default 1).")
+    ap.add_argument("socket", help="Path of the Unix socket to listen on.")
+    args = ap.parse_args()
+
+    def terminate(*unused):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    # Bind to a temporary name and rename into place, so that clients
+    # waiting for the socket to appear never see it before it works.
+    tmp = args.socket + ".tmp"
+    server = SegmenterServer(tmp, args.jvms)
+    try:
+        os.rename(tmp, args.socket)
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for p in (tmp, args.socket):
+            try:
+                os.unlink(p)
+            except FileNotFoundError:
+                pass
+
+if __name__ == "__main__":
+    main()
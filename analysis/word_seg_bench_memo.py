@@ -0,0 +1,78 @@
+#! /usr/bin/python3
+
+# Measure what the segmentation memo (word_seg/memo.py) saves on a
+# corpus with realistic duplication.
+#
+#    word_seg_bench_memo.py [NDOCS [NUNIQUE [LANG...]]]
+#
+# NDOCS documents (default 5000) are drawn, with a heavy-tailed
+# distribution, from NUNIQUE distinct texts (default 1000), the way
+# unchanged historical snapshots and multi-locale captures repeat the
+# same few pages many times over.  Each document is segmented, one
+# batch of 50 at a time, with no memo, with an empty memo, and with
+# the memo left behind by the previous run (as a restarted or
+# second-pass job would see it).  Languages with external segmenters
+# need those segmenters installed.
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+import word_seg
+from word_seg.memo import SegmentationMemo
+
+def synthetic_text(rng, lang, vocab):
+    words = []
+    for _ in range(rng.randint(50, 2000)):
+        if rng.random() < 0.03:
+            words.append("http://example.com/{}".format(rng.randrange(10000)))
+        else:
+            words.append(rng.choice(vocab))
+    return (lang, " ".join(words))
+
+def run(label, segmenter, docs):
+    start = time.monotonic()
+    nwords = 0
+    for i in range(0, len(docs), 50):
+        nwords += sum(len(w) for w in segmenter.segment_many(docs[i:i+50]))
+    elapsed = time.monotonic() - start
+
+    stats = segmenter.memo_stats()
+    hit_rate = "{:.1%}".format(stats["hit_rate"]) if stats else "-"
+    sys.stdout.write("{:>10}  {:>8.2f}  {:>9.1f}  {:>8}  {:>9}\n"
+                     .format(label, elapsed, len(docs) / elapsed,
+                             hit_rate, nwords))
+
+def main():
+    ndocs   = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    nunique = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    langs   = sys.argv[3:] or ["en", "fr", "de", "ru"]
+
+    rng = random.Random(1)
+    vocab = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyzäöüéè")
+                     for _ in range(rng.randint(2, 10)))
+             for _ in range(20000)]
+    unique = [synthetic_text(rng, rng.choice(langs), vocab)
+              for _ in range(nunique)]
+    docs = [unique[min(int(rng.paretovariate(0.8)) - 1, nunique - 1)]
+            for _ in range(ndocs)]
+    sys.stdout.write("{} documents, {} distinct\n"
+                     .format(ndocs, len(set(docs))))
+
+    sys.stdout.write("{:>10}  {:>8}  {:>9}  {:>8}  {:>9}\n"
+                     .format("memo", "seconds", "docs/sec", "hit rate",
+                             "words"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "memo")
+        version = word_seg.SEGMENTER_VERSION
+        run("none", word_seg.Segmenter(), docs)
+        with SegmentationMemo(path, version) as memo:
+            run("cold", word_seg.Segmenter(memo=memo), docs)
+        with SegmentationMemo(path, version) as memo:
+            run("warm", word_seg.Segmenter(memo=memo), docs)
+        sys.stdout.write("memo file: {:.1f} MB\n"
+                         .format(os.path.getsize(path) / (1024 * 1024)))
+
+main()
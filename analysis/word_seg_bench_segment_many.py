@@ -0,0 +1,89 @@
+#! /usr/bin/python3
+
+# Compare segmenting a multilingual corpus one chunk at a time, as
+# word_seg.segment is called for each cld2 chunk, with segmenting
+# batches of documents through word_seg.segment_many.
+#
+#    word_seg_bench_segment_many.py [NDOCS [BATCH [LANG...]]]
+#
+# NDOCS synthetic documents (default 2000), each of one to eight
+# chunks in languages drawn from LANGs (default: en fr de ru th ja),
+# are segmented both ways; segment_many is given BATCH documents
+# (default 50) at a time, as segment_raw_text.py does.  Languages
+# with external segmenters need those segmenters installed.
+
+import random
+import sys
+import time
+
+import word_seg
+
+ALPHABETS = {
+    "th": (0x0E01, 0x0E30),
+    "ja": (0x3041, 0x3096),
+    "zh": (0x4E00, 0x4E00 + 3000),
+    "ar": (0x0621, 0x064A),
+    "ru": (0x0430, 0x044F),
+}
+
+def synthetic_chunk(rng, lang, vocab):
+    words = []
+    for _ in range(rng.randint(20, 300)):
+        r = rng.random()
+        if r < 0.03:
+            words.append("http://example.com/{}".format(rng.randrange(1000)))
+        elif r < 0.10:
+            words.append(rng.choice(["2016", "(", ")", "!", "--", "..."]))
+        else:
+            # Zipf-ish: most words are common ones.
+            words.append(vocab[min(int(rng.paretovariate(1.0)) - 1,
+                                   len(vocab) - 1)])
+    return (lang, " ".join(words))
+
+def make_vocab(rng, lang):
+    lo, hi = ALPHABETS.get(lang, (ord("a"), ord("z")))
+    letters = [chr(c) for c in range(lo, hi + 1)]
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(2, 9)))
+            for _ in range(5000)]
+
+def main():
+    ndocs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    langs = sys.argv[3:] or ["en", "fr", "de", "ru", "th", "ja"]
+
+    rng = random.Random(1)
+    vocabs = { lang: make_vocab(rng, lang) for lang in langs }
+    docs = []
+    for _ in range(ndocs):
+        docs.append([synthetic_chunk(rng, lang, vocabs[lang])
+                     for lang in (rng.choice(langs)
+                                  for _ in range(rng.randint(1, 8)))])
+    nchunks = sum(len(d) for d in docs)
+
+    # Start up every segmenter before timing anything.
+    word_seg.segment_many((lang, "warm up") for lang in langs)
+
+    start = time.monotonic()
+    one = [[list(word_seg.segment(lang, text)) for lang, text in doc]
+           for doc in docs]
+    t_one = time.monotonic() - start
+
+    start = time.monotonic()
+    many = []
+    for i in range(0, len(docs), batch):
+        chunks = [c for doc in docs[i:i+batch] for c in doc]
+        words = iter(word_seg.segment_many(chunks))
+        many.extend([next(words) for _ in doc] for doc in docs[i:i+batch])
+    t_many = time.monotonic() - start
+
+    if one != many:
+        sys.stderr.write("*** segment and segment_many disagree\n")
+        sys.exit(1)
+
+    sys.stdout.write("{} documents, {} chunks, languages: {}\n"
+                     .format(ndocs, nchunks, " ".join(langs)))
+    for label, elapsed in (("segment", t_one), ("segment_many", t_many)):
+        sys.stdout.write("{:>12}  {:>8.2f} s  {:>9.1f} chunks/s\n"
+                         .format(label, elapsed, nchunks / elapsed))
+
+main()
@@ -0,0 +1,142 @@
+#! /usr/bin/python3
+
+# Compare the memory use and throughput of Stanford segmentation in a
+# process pool, with a JVM per worker process and with one shared
+# segmenter service (word_seg.stanford_service).
+#
+#    word_seg_bench_stanford.py [WORKERS [NTEXTS [LANG [JVMS]]]]
+#
+# WORKERS processes (default 12) segment NTEXTS synthetic documents
+# (default 2000) in language LANG (zh or ar; default zh), first each
+# with its own JVM, then through a service running JVMS JVMs per model
+# (default 1).  The resident memory of all the JVMs is sampled every
+# tenth of a second and the peak is reported.  Java and the segmenter
+# models must be installed.
+
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+
+import word_seg
+
+def synthetic_text(rng, lang):
+    if lang == "zh":
+        letters = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+        def word():
+            return "".join(rng.choice(letters)
+                           for _ in range(rng.randint(2, 12)))
+    else:
+        letters = [chr(c) for c in range(0x0621, 0x064A)]
+        def word():
+            return "".join(rng.choice(letters)
+                           for _ in range(rng.randint(2, 8)))
+    words = []
+    for _ in range(rng.randint(50, 400)):
+        r = rng.random()
+        if r < 0.05:
+            words.append("http://example.com/{}".format(rng.randrange(1000)))
+        elif r < 0.15:
+            words.append(rng.choice(["2016", "Google", "iPhone", "(",
+                                     ")", "!", "--"]))
+        else:
+            words.append(word())
+    return " ".join(words)
+
+def segment_one(args):
+    lang, text = args
+    return len(list(word_seg.segment(lang, text)))
+
+def jvm_rss():
+    """Total resident memory, in bytes, of the JVMs descended from
+       this process, and how many there are."""
+    parents = {}
+    names = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name is in parentheses and may contain spaces.
+        name = stat[stat.index("(")+1:stat.rindex(")")]
+        fields = stat[stat.rindex(")")+2:].split()
+        parents[int(pid)] = int(fields[1])
+        names[int(pid)] = name
+
+    me = os.getpid()
+    total = njvms = 0
+    for pid, name in names.items():
+        if name != "java":
+            continue
+        p = pid
+        while p > 1 and p != me:
+            p = parents.get(p, 1)
+        if p != me:
+            continue
+        try:
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        njvms += 1
+                        break
+        except OSError:
+            pass
+    return total, njvms
+
+class RSSSampler:
+    def __init__(self):
+        self.peak  = 0
+        self.jvms  = 0
+        self._stop = threading.Event()
+        self._thr  = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thr.start()
+        return self
+
+    def __exit__(self, *dontcare):
+        self._stop.set()
+        self._thr.join()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(0.1):
+            rss, n = jvm_rss()
+            self.peak = max(self.peak, rss)
+            self.jvms = max(self.jvms, n)
+
+def run(label, workers, jobs):
+    with RSSSampler() as sampler:
+        start = time.monotonic()
+        with multiprocessing.Pool(workers) as pool:
+            nwords = sum(pool.imap_unordered(segment_one, jobs, 4))
+        elapsed = time.monotonic() - start
+
+    sys.stdout.write("{:>12}  {:>4}  {:>8.2f}  {:>9.1f}  {:>10.0f}  {:>8}\n"
+                     .format(label, sampler.jvms, elapsed,
+                             len(jobs) / elapsed,
+                             sampler.peak / (1024 * 1024), nwords))
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    ntexts  = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    lang    = sys.argv[3] if len(sys.argv) > 3 else "zh"
+    jvms    = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    rng  = random.Random(1)
+    jobs = [(lang, synthetic_text(rng, lang)) for _ in range(ntexts)]
+
+    sys.stdout.write("{:>12}  {:>4}  {:>8}  {:>9}  {:>10}  {:>8}\n"
+                     .format("mode", "jvms", "seconds", "texts/sec",
+                             "peak MB", "words"))
+    run("per-process", workers, jobs)
+    with word_seg.stanford_service(jvms):
+        run("service", workers, jobs)
+
+main()
@@ -0,0 +1,61 @@
+#! /usr/bin/python3
+
+# Measure how long a fresh process takes to import word_seg and get
+# its first Segmenter ready, with and without the cached Unicode
+# character-class tables.
+#
+#    word_seg_bench_startup.py [REPEATS]
+#
+# Each measurement is taken in a new Python process, as happens for
+# every worker in a process pool.  "cold" runs start with an empty
+# cache directory, so they include building the tables and saving
+# them; "warm" runs load the tables saved by a cold run.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+PROBE = r"""
+import json, time
+t0 = time.monotonic()
+import word_seg
+t1 = time.monotonic()
+seg = word_seg.Segmenter()
+t2 = time.monotonic()
+seg.is_url("http://example.com/")
+t3 = time.monotonic()
+print(json.dumps([t1 - t0, t2 - t1, t3 - t2]))
+"""
+
+def probe(cachedir):
+    env = dict(os.environ, WORD_SEG_CACHE_DIR=cachedir)
+    out = subprocess.check_output(
+        [sys.executable, "-c", PROBE], env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    return json.loads(out.decode("ascii"))
+
+def report(label, samples):
+    n = len(samples)
+    imp, seg, url = (sorted(col)[n // 2] for col in zip(*samples))
+    sys.stdout.write("{:>5}  {:>8.3f}  {:>10.3f}  {:>8.3f}  {:>8.3f}\n"
+                     .format(label, imp, seg, url, imp + seg + url))
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    cold = []
+    warm = []
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as cachedir:
+            cold.append(probe(cachedir))
+            warm.append(probe(cachedir))
+
+    sys.stdout.write("{:>5}  {:>8}  {:>10}  {:>8}  {:>8}\n"
+                     .format("cache", "import", "Segmenter", "is_url",
+                             "total"))
+    report("cold", cold)
+    report("warm", warm)
+
+main()
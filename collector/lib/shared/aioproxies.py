@@ -15,10 +15,13 @@ import locale
 import random
 import re
 import shlex
+import statistics
 import subprocess
 import sys
 import time
 
+from . import metrics
+
 # Utilities
 
 from .strsignal import strsignal
@@ -200,11 +203,115 @@ class NamespaceManager:
         self._result_f = None
         # don't clear self._exit_f yet, stop() may not yet have been called
 
+PROXY_EVENTS = metrics.counter(
+    "collector_proxy_events_total",
+    "Proxy state transitions: start, online, failed (did not come "
+    "online), offline (went down after coming online), degraded "
+    "(restarted for poor performance), abandoned.",
+    ("locale", "event"))
+PROXY_ONLINE = metrics.gauge(
+    "collector_proxy_online",
+    "1 if the proxy for this location is online, 0 if not.",
+    ("locale",))
+PROXY_CONNECT_SECONDS = metrics.histogram(
+    "collector_proxy_connect_seconds",
+    "Time from starting a proxy to its coming online.",
+    ("locale",))
+PROXIES_WAITING = metrics.gauge(
+    "collector_proxies_waiting",
+    "Proxies waiting to be started (or restarted).")
+
+class ProxyStats:
+    """Performance statistics for one proxy, as exponentially weighted
+       moving averages.  ALPHA is the weight given to each new
+       observation; the default is the same as the threaded
+       ProxyRunner's.  The averages persist when the proxy is
+       restarted, but 'session_captures' counts only the captures
+       made since it last came online.
+
+       Clients report each capture with note_capture(); ProxySet
+       reports connection times itself.
+    """
+
+    # Once a session has made this many captures, its averages are
+    # taken to reflect that session rather than earlier ones.
+    SETTLED_CAPTURES = 20
+
+    def __init__(self, alpha=2/11):
+        self.alpha            = alpha
+        self.connect_time     = None  # seconds from start() to online
+        self.success_rate     = None  # fraction of captures that succeeded
+        self.sec_per_job      = None  # seconds per capture, per worker
+        self.bytes_per_sec    = None  # bytes received per second of capture
+        self.best_cost        = None  # lowest settled cost() seen so far
+        self.nsucc            = 0
+        self.nfail            = 0
+        self.session_captures = 0
+
+    def _ewma(self, avg, sample):
+        if avg is None:
+            return sample
+        return avg * (1 - self.alpha) + sample * self.alpha
+
+    def note_connect(self, seconds):
+        self.connect_time = self._ewma(self.connect_time, seconds)
+        self.session_captures = 0
+
+    def note_capture(self, success, nbytes, elapsed):
+        if success:
+            self.nsucc += 1
+        else:
+            self.nfail += 1
+        self.session_captures += 1
+        self.success_rate = self._ewma(self.success_rate,
+                                       1.0 if success else 0.0)
+        self.sec_per_job = self._ewma(self.sec_per_job, elapsed)
+        if elapsed > 0:
+            self.bytes_per_sec = self._ewma(self.bytes_per_sec,
+                                            nbytes / elapsed)
+        if self.settled:
+            cost = self.cost()
+            if self.best_cost is None or cost < self.best_cost:
+                self.best_cost = cost
+
+    @property
+    def settled(self):
+        return self.session_captures >= self.SETTLED_CAPTURES
+
+    def cost(self):
+        """Expected worker-seconds per successful capture, or None if
+           there have not been any captures yet."""
+        if self.sec_per_job is None:
+            return None
+        return self.sec_per_job / max(self.success_rate, 0.05)
+
+    def degraded(self, factor):
+        """True if this session has settled at a cost more than FACTOR
+           times the best this proxy has managed."""
+        return (self.settled and self.best_cost is not None and
+                self.cost() > factor * self.best_cost)
+
+    def summary(self):
+        def fmt(val, spec):
+            return "-" if val is None else format(val, spec)
+        return ("{} ok, {} failed | connect {}s, {}% ok, {}s/job, "
+                "{} B/s".format(self.nsucc, self.nfail,
+                                fmt(self.connect_time, ".1f"),
+                                fmt(self.success_rate and
+                                    self.success_rate * 100, ".0f"),
+                                fmt(self.sec_per_job, ".2f"),
+                                fmt(self.bytes_per_sec, ".0f")))
+
 class BaseProxyManager:
     """Base class -- runs and supervises some kind of proxy, and tracks
        performance statistics.  Subclasses are responsible for implementing
        proxy-specific behavior.
     """
+
+    # Whether this kind of proxy needs a network namespace from
+    # NamespaceManager.
+    NEEDS_NAMESPACE = True
+
     def __init__(self, loop, loc):
         self._loop        = loop
         self.loc          = loc
@@ -215,6 +322,13 @@ class BaseProxyManager:
         self.cycle        = 0
         self.backoff      = 0
         self.last_attempt = 0
+        self.preempted    = False
+        self.stats        = ProxyStats()
+
+        # Number of concurrent workers the client should use with
+        # this proxy, or None for no particular limit; maintained by
+        # ProxySet.
+        self.worker_quota = None
 
     @property
     def fully_offline(self):
@@ -270,6 +384,7 @@ class DirectProxyManager(BaseProxyManager):
        _directly_ from the local machine."""
 
     TYPE = 'direct'
+    NEEDS_NAMESPACE = False
 
     def __init__(self, loop, loc, *args):
         BaseProxyManager.__init__(self, loop, loc)
@@ -497,6 +612,15 @@ class ProxySet:
      - max_simultaneous_proxies: maximum number of proxies to allow to
        run simultaneously.
 
+    It may also have these properties:
+
+     - total_workers: total number of concurrent workers the client
+       uses, across all proxies; if present (and REMAINING_WORK is
+       given to the constructor), each online proxy's worker_quota is
+       kept set to its share of them.
+     - proxy_start_interval: minimum number of seconds between proxy
+       starts (default 5).
+
     Proxy configuration files are line-oriented, one proxy per line,
     in the format
 
@@ -516,8 +640,30 @@ class ProxySet:
     Entire lines may be commented out with a leading '#', but '#'
     elsewhere in a line is not special.
 
+    If the client says how much work each location has left (see
+    REMAINING_WORK, below), proxies are scheduled to finish all of it
+    as soon as possible.  Each proxy keeps running averages of its
+    performance (see ProxyStats), from which ProxySet estimates how
+    many worker-seconds each location's remaining work will take.
+    Among the proxies ready to start, the one with the most is
+    started first (longest job first), so that slow locations do not
+    end up running by themselves at the end.  A proxy that has never
+    been measured is assumed to be typical.  For the same reason, the
+    client's workers are shared among the online proxies in
+    proportion to their estimates.  Without REMAINING_WORK, proxies
+    are started in PROXY_SORT_KEY order, as before.
+
+    Either way, an online proxy whose cost per successful capture has
+    settled at more than DEGRADED_FACTOR times the best it has done
+    before is restarted.  For OpenVPN proxies this also moves on to
+    the next server.  The restart does not count as a failure.
     """
 
+    # How often to review the running proxies' statistics, in seconds.
+    STATS_INTERVAL = 30
+
+    DEGRADED_FACTOR = 4
+
     _VALID_LOC_RE   = re.compile("^[a-z]{2,3}(?:_[a-z0-9_]+)?$")
     _VALID_NSTAG_RE = re.compile("^[a-z]+$")
 
@@ -525,7 +671,9 @@ class ProxySet:
                  nstag="t",
                  loop=None,
                  proxy_sort_key=None,
-                 include_locations=None):
+                 include_locations=None,
+                 proxy_factory=None,
+                 remaining_work=None):
         """Constructor.  ARGS is as described above.  NSTAG is a label
            for all of the namespaces created by this program; it must
            consist entirely of lowercase ASCII letters. LOOP is an event
@@ -541,6 +689,12 @@ class ProxySet:
            If INCLUDE_LOCATIONS is not None, it must be a set of
            locations (anything for which "'str' in X" works) and only
            the proxies for those locations will be activated.
+
+           PROXY_FACTORY is called with the same arguments as
+           ProxyManager, and defaults to it.
+
+           REMAINING_WORK, if not None, takes a 'loc' and returns the
+           number of jobs still to be done for that location.
         """
         if not self._VALID_NSTAG_RE.match(nstag):
             raise ValueError("namespace tag must be entirely ASCII lowercase")
@@ -549,9 +703,11 @@ class ProxySet:
             proxy_sort_key = lambda l, m: (m != 'direct', l)
 
         if loop is None: loop = asyncio.get_event_loop()
+        if proxy_factory is None: proxy_factory = ProxyManager
 
         self.loop            = loop
         self.proxy_sort_key  = proxy_sort_key
+        self.remaining_work  = remaining_work
         self.nstag           = nstag
         self.nsmgr           = None
         self.avail_nss       = None
@@ -562,6 +718,7 @@ class ProxySet:
         self.waiting_proxies = collections.deque()
         self.crashed_proxies = set()
         self.proxy_crash_evt = asyncio.Event(loop=loop)
+        self.start_interval  = getattr(args, "proxy_start_interval", 5)
 
         with open(self.args.locations) as f:
             proxies = []
@@ -578,7 +735,7 @@ class ProxySet:
                     raise RuntimeError("duplicate location: " + " ".join(w))
 
                 if include_locations is None or loc in include_locations:
-                    proxy = ProxyManager(self.loop, loc, method, args)
+                    proxy = proxy_factory(self.loop, loc, method, args)
                     self.locations[loc] = proxy
                     self.crashed_proxies.add(proxy)
 
@@ -599,11 +756,19 @@ class ProxySet:
                 except KeyError: pass
                 continue
 
+            if proxy.preempted:
+                # Stopped by _stop_degraded_proxies; not a failure.
+                proxy.preempted = False
+                proxy.backoff = 0
+                new_proxies.append(proxy)
+                continue
+
             proxy.cycle += 1
             if proxy.cycle >= 12:
                 # Abandon this proxy, it doesn't work.
                 sys.stderr.write("{}: 12 failures, giving up\n"
                                  .format(proxy.label()))
+                PROXY_EVENTS.labels(proxy.loc, "abandoned").inc()
                 proxy.close()
                 try: del self.locations[proxy.loc]
                 except KeyError: pass
@@ -641,6 +806,23 @@ class ProxySet:
         # No proxies are crashed anymore.
         self.proxy_crash_evt.clear()
 
+    def _expected_work(self, proxies):
+        """Estimated worker-seconds needed to finish the remaining work
+           of each of PROXIES, as a list; all zeroes if the client
+           hasn't told us how much work is left."""
+        if self.remaining_work is None:
+            return [0] * len(proxies)
+        known = [c for c in (p.stats.cost() for p in self.locations.values())
+                 if c is not None]
+        typical = statistics.median(known) if known else 1.0
+        work = []
+        for proxy in proxies:
+            cost = proxy.stats.cost()
+            if cost is None:
+                cost = typical
+            work.append(self.remaining_work(proxy.loc) * cost)
+        return work
+
     def _select_proxy_to_start(self):
         # This is a backstop; under no circumstances will the main loop
         # suspend itself for longer than this.
@@ -654,37 +836,61 @@ class ProxySet:
 
         if nactive >= self.max_simultaneous_proxies:
             sys.stderr.write("pset: no more simultaneous proxies allowed\n")
-            return (proxy, min_backoff)
+            return (proxy, min(min_backoff, self.STATS_INTERVAL))
 
-        # collections.deque needs to grow a _mutable_ iterator,
-        # one that supports "delete the element I'm looking at now"
-        # without getting confused about how long the list is.
-        nrotate  = 0
+        # Of the proxies whose backoff has expired, start the one with
+        # the most work left.  waiting_proxies is in sort-key order, and
+        # ties go to the first.
         now = time.monotonic()
-        while nrotate < nwait:
-            cand = self.waiting_proxies[0]
+        ready = []
+        for cand in list(self.waiting_proxies):
             if cand.done:
-                self.waiting_proxies.popleft()
-                nwait -= 1
+                self.waiting_proxies.remove(cand)
                 try: del self.locations[cand.loc]
                 except KeyError: pass
                 continue
 
             remaining = (cand.last_attempt + cand.backoff) - now
-            if remaining <= 0 and proxy is None:
-                proxy = cand
-                self.waiting_proxies.popleft()
-                nwait -= 1
+            if remaining <= 0:
+                ready.append(cand)
             else:
-                # Hardwired minimum 5-second delay between starting proxies.
-                min_backoff = min(min_backoff, max(remaining, 5))
-                self.waiting_proxies.rotate(-1)
-                nrotate += 1
+                min_backoff = min(min_backoff,
+                                  max(remaining, self.start_interval))
+
+        if ready:
+            work = self._expected_work(ready)
+            proxy = ready[work.index(max(work))]
+            self.waiting_proxies.remove(proxy)
+            if len(ready) > 1:
+                min_backoff = min(min_backoff, self.start_interval)
+
+        return (proxy, min(min_backoff, self.STATS_INTERVAL))
+
+    def _stop_degraded_proxies(self):
+        """Restart any online proxy that has become much slower, or
+           much less reliable, than it used to be."""
+        for proxy in list(self.active_proxies):
+            if (proxy.online and not proxy.stopping and not proxy.done
+                and proxy.stats.degraded(self.DEGRADED_FACTOR)):
+                sys.stderr.write("pset: {}: degraded ({}), restarting\n"
+                                 .format(proxy.label(),
+                                         proxy.stats.summary()))
+                PROXY_EVENTS.labels(proxy.loc, "degraded").inc()
+                proxy.preempted = True
+                proxy.stop()
+
+    def _assign_worker_quotas(self):
+        """Share the client's workers among the online proxies in
+           proportion to the work they have left."""
+        total = getattr(self.args, "total_workers", None)
+        online = [p for p in self.active_proxies if p.online]
+        if total is None or self.remaining_work is None or not online:
+            return
 
-        # We have now rotated waiting_proxies all the way around.
-        # We may or may not have a proxy to start, and we definitely
-        # do have a time to wait before starting another one.
-        return (proxy, min_backoff)
+        work = self._expected_work(online)
+        scale = total / (sum(work) or 1)
+        for proxy, w in zip(online, work):
+            proxy.worker_quota = max(1, int(round(w * scale)))
 
     @asyncio.coroutine
     def _run_one_proxy(self, client, proxy):
@@ -694,14 +900,26 @@ class ProxySet:
         self.active_proxies.add(proxy)
         ns = self.avail_nss.pop()
 
+        PROXY_EVENTS.labels(proxy.loc, "start").inc()
+        started = time.monotonic()
         yield from proxy.start(ns)
         if proxy.online:
+            elapsed = time.monotonic() - started
+            proxy.stats.note_connect(elapsed)
+            PROXY_CONNECT_SECONDS.labels(proxy.loc).observe(elapsed)
+            PROXY_EVENTS.labels(proxy.loc, "online").inc()
+            PROXY_ONLINE.labels(proxy.loc).set(1)
             posted_online = True
             yield from client.proxy_online(proxy)
             proxy.backoff = 0
 
+        else:
+            PROXY_EVENTS.labels(proxy.loc, "failed").inc()
+
         yield from proxy.wait()
         if posted_online:
+            PROXY_EVENTS.labels(proxy.loc, "offline").inc()
+            PROXY_ONLINE.labels(proxy.loc).set(0)
             yield from client.proxy_offline(proxy)
 
         proxy.last_attempt = time.monotonic()
@@ -733,10 +951,16 @@ class ProxySet:
         # We must bring up the namespace manager before doing anything else.
         # Proxies are not obliged to use a namespace, but we don't know which
         # ones need them and which don't, so assume the worst.
-        self.nsmgr = NamespaceManager(self.nstag,
-                                      self.max_simultaneous_proxies,
-                                      self.loop)
-        avail_nss = yield from self.nsmgr.start()
+        if any(proxy.NEEDS_NAMESPACE for proxy in self.locations.values()):
+            self.nsmgr = NamespaceManager(self.nstag,
+                                          self.max_simultaneous_proxies,
+                                          self.loop)
+            avail_nss = yield from self.nsmgr.start()
+        else:
+            # Placeholders; proxies that don't need a namespace ignore
+            # the one they are given.
+            avail_nss = ["{}{}".format(self.nstag, i)
+                         for i in range(self.max_simultaneous_proxies)]
         self.avail_nss = set(avail_nss)
 
         # Proxies are removed from self.locations when they become 'done'.
@@ -744,10 +968,15 @@ class ProxySet:
             if self.crashed_proxies:
                 self._refill_waiting_proxies()
 
+            self._stop_degraded_proxies()
+            self._assign_worker_quotas()
             (proxy, till_next) = self._select_proxy_to_start()
+            PROXIES_WAITING.set(len(self.waiting_proxies))
 
             if proxy:
-                sys.stderr.write("pset: selected {}\n".format(proxy.label()))
+                sys.stderr.write("pset: selected {} ({})\n"
+                                 .format(proxy.label(),
+                                         proxy.stats.summary()))
                 self.proxy_runners.append(
                     self.loop.create_task(self._run_one_proxy(client, proxy)))
 
@@ -0,0 +1,304 @@
+# Append-only archives of capture results.
+#
+# Copyright © 2014–2017 Zack Weinberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# There is NO WARRANTY.
+
+"""Capture archives: many capture results packed into a few large files.
+
+An archive is a directory containing one or more numbered segments
+(NNNNNN.cas) and, for each segment, a sidecar index (NNNNNN.idx).
+
+A segment begins with an eight-byte magic number:
+
+    7F 63 61 73 20 30 30 0A
+    ^? c  a  s  SP 0  0  LF
+
+followed by zero or more records.  Each record is a fixed-size frame
+header, the locale name (ASCII), and then the payload, which is a
+complete capture file exactly as CaptureResult.write_result used to
+write it ("\\x7fcap 00\\n" or "\\x7fcap 01\\n" and so on).  The frame
+header is, in network byte order:
+
+    u32  length of the payload
+    u32  CRC-32 of the length field and of everything in the record
+         after this field
+    f64  wall-clock time of capture (seconds since the Unix epoch)
+    u32  serial number of the URL
+    u8   length of the locale name
+
+Segments are only ever appended to.  If the writer is killed, the last
+record may be truncated; readers stop at the first record that is
+incomplete or fails its checksum.
+
+The index is UTF-8 text, one line per record, with five
+space-separated fields:
+
+    serial locale offset length url
+
+OFFSET is the position of the record's frame header within the
+segment and LENGTH is the length of its payload.  URL is the original
+URL, and comes last because it may contain spaces.  The index is
+redundant with the segment, and can be regenerated with rebuild_index
+if it is lost or falls behind.
+
+Each index line is written only after its record has been handed to
+the OS, so the index never describes a record the segment lacks; but
+after a crash (or a power failure before sync()) it may describe
+fewer records than the segment holds.  Readers that use the index
+must therefore continue scanning the segment from the end of the last
+indexed record; see index_end.
+"""
+
+import collections
+import mmap
+import os
+import os.path
+import struct
+import threading
+import time
+import weakref
+import zlib
+
+SEGMENT_MAGIC = b"\x7fcas 00\n"
+FRAME = struct.Struct(">IIdIB")
+
+# Segments are rotated when they grow past this size.
+DEFAULT_SEGMENT_SIZE = 1024 * 1024 * 1024
+
+CaptureRecord = collections.namedtuple("CaptureRecord", (
+    "serial", "locale", "access_time", "offset", "payload"
+))
+
+IndexEntry = collections.namedtuple("IndexEntry", (
+    "serial", "locale", "offset", "length", "url"
+))
+
+def _record_crc(length, atime, serial, locale, payload):
+    # The checksum covers every part of the frame header except itself.
+    crc = zlib.crc32(struct.pack(">I", length))
+    crc = zlib.crc32(FRAME.pack(0, 0, atime, serial, len(locale))[8:], crc)
+    crc = zlib.crc32(locale, crc)
+    return zlib.crc32(payload, crc)
+
+def segment_name(archive_dir, segno):
+    return os.path.join(archive_dir, "{:06d}.cas".format(segno))
+
+def index_name(segment_fname):
+    return os.path.splitext(segment_fname)[0] + ".idx"
+
+class CaptureArchiveWriter:
+    """Appends capture records to the segments of an archive in
+       ARCHIVE_DIR, starting a new segment whenever the current one
+       grows past SEGMENT_SIZE bytes.  Existing segments are never
+       touched; numbering continues after the highest one present.
+
+       append() may be called from any thread; each record is written
+       as a unit.
+    """
+
+    def __init__(self, archive_dir, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.archive_dir  = archive_dir
+        self.segment_size = segment_size
+        self._lock        = threading.Lock()
+        self._seg         = None
+        self._idx         = None
+        self._segno       = 0
+        self._offset      = 0
+
+        os.makedirs(archive_dir, exist_ok=True)
+        for fname in os.listdir(archive_dir):
+            base, ext = os.path.splitext(fname)
+            if ext == ".cas" and base.isdigit():
+                self._segno = max(self._segno, int(base))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _start_segment(self):
+        self._finish_segment()
+        self._segno += 1
+        fname = segment_name(self.archive_dir, self._segno)
+        self._seg = open(fname, "xb")
+        self._idx = open(index_name(fname), "xt", encoding="utf-8",
+                         newline="\n")
+        self._seg.write(SEGMENT_MAGIC)
+        self._offset = len(SEGMENT_MAGIC)
+
+    def _finish_segment(self):
+        if self._seg is not None:
+            self._seg.close()
+            self._idx.close()
+            self._seg = None
+            self._idx = None
+
+    def append(self, serial, locale, url, payload, access_time=None):
+        """Append one record.  PAYLOAD is the encoded capture file, as
+           produced by CaptureResult.encode.  Returns the segment
+           number and offset at which the record was written."""
+        if access_time is None:
+            access_time = time.time()
+        blocale = locale.encode("ascii")
+        header = FRAME.pack(len(payload),
+                            _record_crc(len(payload), access_time, serial,
+                                        blocale, payload),
+                            access_time, serial, len(blocale))
+
+        with self._lock:
+            if self._seg is None or self._offset >= self.segment_size:
+                self._start_segment()
+
+            offset = self._offset
+            self._seg.write(header)
+            self._seg.write(blocale)
+            self._seg.write(payload)
+            self._offset += len(header) + len(blocale) + len(payload)
+            # The record must reach the OS before its index line does.
+            self._seg.flush()
+            self._idx.write("{} {} {} {} {}\n".format(
+                serial, locale, offset, len(payload), url))
+            self._idx.flush()
+
+            return (self._segno, offset)
+
+    def sync(self):
+        """Force everything appended so far out to disk."""
+        with self._lock:
+            if self._seg is not None:
+                for f in (self._seg, self._idx):
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def close(self):
+        with self._lock:
+            self._finish_segment()
+
+class CaptureSegment:
+    """Read-only, memory-mapped view of one archive segment.
+       Records can be read sequentially, by iterating over the
+       segment, or directly, given an offset from the index.
+       Closing the segment releases every payload view it handed out,
+       whether or not the caller is finished with them."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._views = []   # weak references to payload views
+        with open(fname, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            self._map.close()
+            raise ValueError(fname + ": not a capture archive segment")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        for ref in self._views:
+            view = ref()
+            if view is not None:
+                view.release()
+        self._views = []
+        self._map.close()
+
+    def read(self, offset):
+        """Return the CaptureRecord whose frame header is at OFFSET.
+           The payload is a memoryview onto the mapped segment, valid
+           until the segment is closed.  Raises ValueError if the
+           record is truncated or corrupt."""
+        m = self._map
+        if offset + FRAME.size > len(m):
+            raise ValueError("{}@{}: truncated frame header"
+                             .format(self.fname, offset))
+
+        length, crc, atime, serial, loclen = FRAME.unpack_from(m, offset)
+        lbeg = offset + FRAME.size
+        pbeg = lbeg + loclen
+        pend = pbeg + length
+        if pend > len(m):
+            raise ValueError("{}@{}: truncated record"
+                             .format(self.fname, offset))
+
+        view    = memoryview(m)
+        blocale = view[lbeg:pbeg]
+        payload = view[pbeg:pend]
+        view.release()
+        try:
+            if crc != _record_crc(length, atime, serial, blocale, payload):
+                raise ValueError("{}@{}: checksum mismatch"
+                                 .format(self.fname, offset))
+            locale = bytes(blocale).decode("ascii")
+        except:
+            payload.release()
+            raise
+        finally:
+            blocale.release()
+
+        if len(self._views) >= 1024:
+            self._views = [r for r in self._views if r() is not None]
+        self._views.append(weakref.ref(payload))
+        return CaptureRecord(serial, locale, atime, offset, payload)
+
+    def next_offset(self, record):
+        """Offset of the record following RECORD."""
+        return (record.offset + FRAME.size + len(record.locale)
+                + len(record.payload))
+
+    def __iter__(self):
+        offset = len(SEGMENT_MAGIC)
+        end = len(self._map)
+        while offset < end:
+            try:
+                rec = self.read(offset)
+            except ValueError:
+                # Incomplete tail left by an interrupted writer.
+                return
+            yield rec
+            offset = self.next_offset(rec)
+
+def index_end(entry):
+    """Offset just past the record described by index ENTRY, from
+       which a reader should continue scanning the segment in case the
+       index lags behind it."""
+    return (entry.offset + FRAME.size + len(entry.locale.encode("ascii"))
+            + entry.length)
+
+def read_index(fname):
+    """Yield an IndexEntry for each line of the index file FNAME."""
+    with open(fname, "rt", encoding="utf-8", newline="\n") as fp:
+        for line in fp:
+            if not line.endswith("\n"):
+                # Incomplete tail left by an interrupted writer.
+                return
+            serial, locale, offset, length, url = \
+                line[:-1].split(" ", 4)
+            yield IndexEntry(int(serial), locale, int(offset),
+                             int(length), url)
+
+def _payload_url(payload):
+    # The original URL is the first line after the capture-file magic.
+    end = bytes(payload[8:8+4096]).find(b"\n")
+    return bytes(payload[8:8+end]).decode("utf-8")
+
+def rebuild_index(segment_fname):
+    """Regenerate the index for SEGMENT_FNAME by scanning the segment."""
+    tmpname = index_name(segment_fname) + ".tmp"
+    with CaptureSegment(segment_fname) as seg, \
+         open(tmpname, "wt", encoding="utf-8", newline="\n") as idx:
+        for rec in seg:
+            idx.write("{} {} {} {} {}\n".format(
+                rec.serial, rec.locale, rec.offset, len(rec.payload),
+                _payload_url(rec.payload)))
+            del rec
+    os.rename(tmpname, index_name(segment_fname))
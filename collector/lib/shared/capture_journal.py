@@ -0,0 +1,187 @@
+# Progress journals for resumable capture runs.
+#
+# Copyright © 2014–2017 Zack Weinberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# There is NO WARRANTY.
+
+"""Capture journals: which (URL, locale) pairs a run has finished.
+
+A capture run can take days, and may be interrupted.  Each run
+directory holds a journal, JOURNAL_NAME, listing every result that has
+been written to the run's capture archive.  When the run is resumed,
+the journal is read back, and the finished URLs are taken out of each
+locale's work queue before any capturing starts.
+
+The journal is UTF-8 text.  The first line is a header,
+
+    #cjl 00 SEED DIGEST
+
+where SEED is the hexadecimal seed for the shuffle of the URL list
+(see shared/url_table.py) and DIGEST is the SHA-256 of the list, so
+that a resumed run gives each URL the same serial number as before,
+and refuses to resume with a different list.  Each subsequent line is
+
+    locale serial
+
+for one completed capture.  Lines are held in memory and written in
+batches: a batch is written and forced to disk, after the capture
+archive itself, once it holds SYNC_RECORDS entries or is SYNC_INTERVAL
+seconds old, and when the journal is closed.  Nothing reaches the
+journal file before the archive records it describes are on disk.  If the writer is killed, the end of the journal
+may be missing or cut off partway through a line.  Resuming discards
+the incomplete line, and the captures whose lines were lost are done
+again.  The archive can then contain two records for the same serial
+number and locale; the later one should be used.
+"""
+
+import os
+import os.path
+import random
+import threading
+import time
+
+from .capture_archive import CaptureArchiveWriter
+from .url_table import URLTable
+
+JOURNAL_NAME  = "progress.jnl"
+JOURNAL_MAGIC = "#cjl 00"
+
+SYNC_RECORDS  = 1000
+SYNC_INTERVAL = 10.0
+
+class CaptureJournal:
+    """Appends completion records to the journal open as FP (a text
+       file).  ARCHIVE, if not None, is the CaptureArchiveWriter that
+       the recorded results went to; it is synced before the journal
+       is, so the journal never gets ahead of the archive.
+
+       record() may be called from any thread.
+    """
+
+    def __init__(self, fp, archive=None,
+                 sync_records=SYNC_RECORDS, sync_interval=SYNC_INTERVAL):
+        self.archive       = archive
+        self.sync_records  = sync_records
+        self.sync_interval = sync_interval
+        self._fp           = fp
+        self._lock         = threading.Lock()
+        self._pending      = []
+        self._last_sync    = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def record(self, locale, serial):
+        """Note that the URL with serial number SERIAL has been
+           captured from LOCALE, and its result written out."""
+        with self._lock:
+            self._pending.append("{} {}\n".format(locale, serial))
+            if (len(self._pending) >= self.sync_records or
+                time.monotonic() - self._last_sync >= self.sync_interval):
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        # The lines are not written until now, so that the file's own
+        # buffering cannot push them out ahead of the archive.
+        if self.archive is not None:
+            self.archive.sync()
+        self._fp.write("".join(self._pending))
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._pending   = []
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._sync()
+                self._fp.close()
+                self._fp = None
+
+def latest_run(output_dir):
+    """The most recent run directory in OUTPUT_DIR that has a journal,
+       or None if there isn't one."""
+    runs = [int(d) for d in os.listdir(output_dir)
+            if d.isdigit() and os.path.isfile(
+                    os.path.join(output_dir, d, JOURNAL_NAME))]
+    if not runs:
+        return None
+    return os.path.join(output_dir, str(max(runs)))
+
+def _new_run(output_dir, urls_fname):
+    run = 1
+    while True:
+        try:
+            run_dir = os.path.join(output_dir, str(run))
+            os.makedirs(run_dir)
+            break
+        except FileExistsError:
+            run += 1
+            continue
+
+    seed = random.SystemRandom().getrandbits(64)
+    table = URLTable(urls_fname, run_dir, rng=random.Random(seed))
+    fp = open(os.path.join(run_dir, JOURNAL_NAME), "xt",
+              encoding="utf-8", newline="\n")
+    fp.write("{} {:016x} {}\n".format(JOURNAL_MAGIC, seed, table.digest))
+    fp.flush()
+    os.fsync(fp.fileno())
+    return run_dir, table, fp
+
+def _resume_run(run_dir, urls_fname):
+    fname = os.path.join(run_dir, JOURNAL_NAME)
+    with open(fname, "rb") as fp:
+        header = fp.readline().decode("utf-8").split()
+        if len(header) != 4 or " ".join(header[:2]) != JOURNAL_MAGIC:
+            raise ValueError(fname + ": not a capture journal")
+        seed, digest = int(header[2], 16), header[3]
+
+        table = URLTable(urls_fname, run_dir, rng=random.Random(seed))
+        if table.digest != digest:
+            table.close()
+            raise ValueError("{}: URL list {} does not match the run "
+                             "being resumed".format(fname, urls_fname))
+
+        end = fp.tell()
+        for line in fp:
+            if not line.endswith(b"\n"):
+                break
+            locale, serial = line.decode("ascii").split()
+            table.queue(locale).mark_done(int(serial))
+            end += len(line)
+
+    # Cut off any incomplete last line before appending to it.
+    with open(fname, "r+b") as fp:
+        fp.truncate(end)
+    return table, open(fname, "at", encoding="utf-8", newline="\n")
+
+def open_run(output_dir, urls_fname, resume=False):
+    """Start a new capture run in a fresh numbered subdirectory of
+       OUTPUT_DIR, capturing the URLs listed in URLS_FNAME; or, if
+       RESUME is true, pick up the most recent run in OUTPUT_DIR where
+       it left off.  Returns a 4-tuple (run_dir, archive, url_table,
+       journal).  When resuming, each locale's queue in url_table
+       already excludes the URLs the journal says are done."""
+    if resume:
+        run_dir = latest_run(output_dir)
+        if run_dir is None:
+            raise FileNotFoundError("{}: no capture run to resume"
+                                    .format(output_dir))
+        table, fp = _resume_run(run_dir, urls_fname)
+    else:
+        run_dir, table, fp = _new_run(output_dir, urls_fname)
+
+    archive = CaptureArchiveWriter(run_dir)
+    return run_dir, archive, table, CaptureJournal(fp, archive)
@@ -0,0 +1,446 @@
+# Operational metrics for long-running collector programs.
+#
+# Copyright © 2014–2017 Zack Weinberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# There is NO WARRANTY.
+
+"""Counters, gauges and latency histograms, for graphing.
+
+Code that wants to be measured declares its metrics once, at module
+level, and updates them as it goes:
+
+    CAPTURES = metrics.counter("collector_captures_total",
+                               "Captures completed.", ("locale", "status"))
+    ...
+    CAPTURES.labels(locale="us", status="ok").inc()
+
+Declaring the same name twice returns the same metric.  Updates take a
+lock and do a dictionary lookup or two, so they may be made from any
+thread, and cost next to nothing whether or not anyone is looking.
+A gauge can also be given a function to call whenever it is read,
+instead of being set; use this for values (like queue lengths) that
+are cheaper to sample than to track.
+
+Nothing is exported unless the program asks for it:
+
+    serve_http(port)         answers GET requests on 127.0.0.1:PORT
+                             with all metrics in the Prometheus text
+                             exposition format (version 0.0.4)
+    SnapshotWriter(fname)    rewrites FNAME every SNAPSHOT_INTERVAL
+                             seconds with all metrics as JSON
+
+Both run on daemon threads of their own; exported() sets up either or
+both for the duration of a with-block.  Metric names should follow
+the Prometheus conventions: a 'collector_' prefix, a unit suffix, and
+'_total' for counters.
+"""
+
+import bisect
+import contextlib
+import http.server
+import json
+import math
+import os
+import socketserver
+import threading
+import time
+
+# Upper bounds, in seconds, of the default histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+SNAPSHOT_INTERVAL = 15
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\")
+            .replace("\n", "\\n").replace('"', '\\"'))
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v))
+                          for k, v in pairs) + "}"
+
+class _Metric:
+    """Common behavior of all metric families.  A family with no
+       label names has exactly one child, which is the family itself
+       as far as callers are concerned; otherwise, labels() selects a
+       child by its label values."""
+
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name       = name
+        self.help       = help
+        self.labelnames = tuple(labelnames)
+        self._lock      = threading.Lock()
+        self._children  = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            if values:
+                raise TypeError("labels: use positional or keyword "
+                                "arguments, not both")
+            values = tuple(kwargs[n] for n in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError("{}: expected labels {}, got {!r}"
+                             .format(self.name, self.labelnames, values))
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _only_child(self):
+        if self.labelnames:
+            raise ValueError("{}: label values required"
+                             .format(self.name))
+        return self._children[()]
+
+    def samples(self):
+        """Yield (suffix, label pairs, value) for every sample in this
+           family, as the text exposition format wants them."""
+        for key, child in sorted(list(self._children.items())):
+            pairs = list(zip(self.labelnames, key))
+            for suffix, extra, value in child.samples():
+                yield suffix, pairs + extra, value
+
+    def snapshot(self):
+        """A JSON-serializable representation of this family."""
+        return {
+            "type": self.TYPE,
+            "help": self.help,
+            "values": [
+                dict(child.snapshot(),
+                     labels=dict(zip(self.labelnames, key)))
+                for key, child in sorted(list(self._children.items()))
+            ]
+        }
+
+class _CounterChild:
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("counters can only go up")
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def samples(self):
+        yield "", [], self._value
+
+    def snapshot(self):
+        return { "value": self._value }
+
+class Counter(_Metric):
+    """A count of events, which only ever goes up."""
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._only_child().inc(amount)
+
+class _GaugeChild:
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._value = 0
+        self._fn    = None
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, fn):
+        """Read this gauge by calling FN (with no arguments) from now
+           on.  FN may be called on any thread; exceptions it raises
+           are ignored, and the gauge reads as NaN."""
+        self._fn = fn
+
+    @property
+    def value(self):
+        fn = self._fn
+        if fn is None:
+            return self._value
+        try:
+            return fn()
+        except Exception:
+            return math.nan
+
+    def samples(self):
+        yield "", [], self.value
+
+    def snapshot(self):
+        value = self.value
+        # JSON has no NaN.
+        return { "value": None if value != value else value }
+
+class Gauge(_Metric):
+    """A value which can go up and down."""
+    TYPE = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._only_child().set(value)
+
+    def inc(self, amount=1):
+        self._only_child().inc(amount)
+
+    def dec(self, amount=1):
+        self._only_child().dec(amount)
+
+    def set_function(self, fn):
+        self._only_child().set_function(fn)
+
+class _HistogramChild:
+    def __init__(self, bounds):
+        self._lock   = threading.Lock()
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum    = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self):
+        """Context manager which observes the time spent inside it."""
+        return _Timer(self)
+
+    def _cumulative(self):
+        with self._lock:
+            counts = list(self._counts)
+            total  = self._sum
+        cum = []
+        n = 0
+        for c in counts:
+            n += c
+            cum.append(n)
+        return cum, total
+
+    def samples(self):
+        cum, total = self._cumulative()
+        for bound, n in zip(self._bounds + (math.inf,), cum):
+            yield "_bucket", [("le", _format_value(float(bound)))], n
+        yield "_sum", [], total
+        yield "_count", [], cum[-1]
+
+    def snapshot(self):
+        cum, total = self._cumulative()
+        return {
+            "count": cum[-1],
+            "sum": total,
+            "buckets": [[bound, n] for bound, n
+                        in zip(self._bounds, cum[:-1])],
+        }
+
+class _Timer:
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.monotonic() - self._start)
+        return False
+
+class Histogram(_Metric):
+    """A distribution of observed values, usually latencies in
+       seconds, counted into buckets with the upper bounds BUCKETS."""
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(b) for b in buckets
+                                    if b != math.inf))
+        _Metric.__init__(self, name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._only_child().observe(value)
+
+    def time(self):
+        return self._only_child().time()
+
+class Registry:
+    """A collection of metric families, by name."""
+
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = \
+                    cls(name, help, labelnames, **kwargs)
+            elif (type(metric) is not cls or
+                  metric.labelnames != tuple(labelnames)):
+                raise ValueError("metric {} already declared differently"
+                                 .format(name))
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames,
+                         buckets=buckets)
+
+    def _sorted(self):
+        with self._lock:
+            return sorted(self._metrics.items())
+
+    def prometheus_text(self):
+        lines = []
+        for name, metric in self._sorted():
+            lines.append("# HELP {} {}".format(
+                name, metric.help.replace("\\", "\\\\")
+                                 .replace("\n", "\\n")))
+            lines.append("# TYPE {} {}".format(name, metric.TYPE))
+            for suffix, pairs, value in metric.samples():
+                lines.append("{}{}{} {}".format(name, suffix,
+                                                _format_labels(pairs),
+                                                _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "metrics": { name: metric.snapshot()
+                         for name, metric in self._sorted() }
+        }
+
+    def write_snapshot(self, fname):
+        """Write snapshot() to FNAME as JSON, atomically."""
+        tmpname = fname + ".tmp"
+        with open(tmpname, "wt", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+            f.write("\n")
+        os.replace(tmpname, fname)
+
+REGISTRY = Registry()
+counter   = REGISTRY.counter
+gauge     = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def serve_http(port, host="127.0.0.1", registry=REGISTRY):
+    """Start answering HTTP requests for the metrics in REGISTRY on
+       HOST:PORT, on a daemon thread.  Returns the server object;
+       call its shutdown() method to stop."""
+    server = _MetricsServer((host, port), _MetricsHandler)
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True,
+                     name="metrics-http").start()
+    return server
+
+class SnapshotWriter:
+    """Rewrite FNAME with a JSON snapshot of REGISTRY every INTERVAL
+       seconds, on a daemon thread, and once more when closed."""
+
+    def __init__(self, fname, interval=SNAPSHOT_INTERVAL, registry=REGISTRY):
+        self.fname    = fname
+        self.interval = interval
+        self.registry = registry
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target=self._run, daemon=True,
+                                         name="metrics-snapshot")
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.registry.write_snapshot(self.fname)
+
+    def close(self):
+        if not self._stop.is_set():
+            self._stop.set()
+            self._thread.join()
+            self.registry.write_snapshot(self.fname)
+
+@contextlib.contextmanager
+def exported(http_port=None, snapshot_file=None, registry=REGISTRY):
+    """Context manager which exports REGISTRY via serve_http(HTTP_PORT)
+       and/or a SnapshotWriter(SNAPSHOT_FILE), whichever are not None,
+       for the duration of the with-block."""
+    server = writer = None
+    try:
+        if http_port is not None:
+            server = serve_http(http_port, registry=registry)
+        if snapshot_file is not None:
+            writer = SnapshotWriter(snapshot_file, registry=registry)
+        yield registry
+    finally:
+        if writer is not None:
+            writer.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
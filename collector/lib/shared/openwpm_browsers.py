@@ -16,10 +16,13 @@ import shutil
 import signal
 import subprocess
 import threading
+import time
 
 from concurrent import futures as cf
 from urllib.parse import urlsplit
 
+from . import metrics
+
 # we need a secure RNG in one place below, to generate unpredictable
 # authentication tokens
 rng = random.SystemRandom()
@@ -71,6 +74,56 @@ from openwpm.automation.DeployBrowsers.deploy_firefox import deploy_firefox
 from openwpm.automation.MPLogger import loggingclient
 from openwpm.automation.Commands import browser_commands as bcmd
 from openwpm.automation.SocketInterface import clientsocket
+from selenium.common.exceptions import WebDriverException
+
+VISIT_PHASE_SECONDS = metrics.histogram(
+    "collector_visit_phase_seconds",
+    "Time spent in each phase of an OpenWPM visit (see VisitStats).",
+    ("phase",))
+BROWSER_RESTARTS = metrics.counter(
+    "collector_browser_restarts_total",
+    "Planned browser restarts, by reason.", ("reason",))
+
+class VisitStats:
+    """Running totals of the time spent in each phase of a visit, and
+       a count of browser restarts by reason.  The phases are:
+
+           restart     restarting the browser before the visit, if due
+           reset       clearing state left behind by the previous visit
+           navigate    loading the page (driver.get)
+           settle      waiting for the HAR exporter to see the page finish
+           har_export  exporting the HAR
+    """
+    PHASES = ("restart", "reset", "navigate", "settle", "har_export")
+
+    def __init__(self):
+        self.visits   = 0
+        self.count    = collections.Counter()
+        self.total    = collections.Counter()
+        self.worst    = collections.Counter()
+        self.restarts = collections.Counter()
+
+    def record(self, phases):
+        self.visits += 1
+        for phase, elapsed in phases.items():
+            self.count[phase] += 1
+            self.total[phase] += elapsed
+            self.worst[phase] = max(self.worst[phase], elapsed)
+            VISIT_PHASE_SECONDS.labels(phase).observe(elapsed)
+
+    def report(self):
+        lines = ["{} visits; browser restarts: {}".format(
+            self.visits,
+            ", ".join("{} {}".format(n, reason)
+                      for reason, n in sorted(self.restarts.items()))
+            or "none")]
+        for phase in self.PHASES:
+            n = self.count[phase]
+            if n:
+                lines.append("  {:<10}  n={:<6}  mean={:.3f}s  max={:.3f}s"
+                             .format(phase, n, self.total[phase] / n,
+                                     self.worst[phase]))
+        return "\n".join(lines) + "\n"
 
 class BrowserManager:
     """Global state associated with OpenWPM.
@@ -80,7 +133,10 @@ class BrowserManager:
     """
     def __init__(self, loop, data_directory,
                  manager_overrides={},
-                 browser_overrides={}):
+                 browser_overrides={}, *,
+                 restart_every=50,
+                 max_rss=None,
+                 visit_timeout=300):
         manager_params, browser_params = TaskManager.load_default_params(1)
 
         manager_params["data_directory"] = data_directory
@@ -98,6 +154,17 @@ class BrowserManager:
         self.browser_params = browser_params
         self.logger = loggingclient(*manager_params["logger_address"])
 
+        # Restart policy: a browser is restarted after RESTART_EVERY
+        # visits, or when its process tree's resident set exceeds
+        # MAX_RSS bytes (None: no limit), or after a visit that took
+        # longer than VISIT_TIMEOUT seconds.  In between, the browser
+        # is reused, with its cookies and storage cleared before each
+        # visit.
+        self.restart_every = restart_every
+        self.max_rss       = max_rss
+        self.visit_timeout = visit_timeout
+        self.visit_stats   = VisitStats()
+
         self.active_browsers = set()
 
     def __enter__(self):
@@ -123,21 +190,47 @@ class BrowserManager:
         yield from b.start()
         return b
 
+def process_tree_rss(pid):
+    """The total resident set size, in bytes, of process PID and all
+       its descendants, or 0 if it cannot be determined."""
+    rss = 0
+    pids = [str(pid)]
+    try:
+        while pids:
+            pid = pids.pop()
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir("/proc/{}/task".format(pid)):
+                with open("/proc/{}/task/{}/children"
+                          .format(pid, task)) as f:
+                    pids.extend(f.read().split())
+    except (OSError, ValueError):
+        pass
+    return rss
+
 class BrowserWatchdog(threading.Thread):
     def __init__(self, *args, browser=None, **kwargs):
-        threading.Thread.__init__(*args, **kwargs)
+        threading.Thread.__init__(self, *args, **kwargs)
         self._browser = browser
         self._pq = queue.Queue()
+        self.hung = False
 
     def run(self):
         while True:
             pid = self._pq.get()
-            status = os.waitpid(pid)
+            _, status = os.waitpid(pid, 0)
             self._browser.manager.logger.debug(
                 "browser %i: process %d exit %d"
                 % (self._browser.tag, pid, status))
             if not self._browser.running:
                 break
+            if pid != self._browser.pid:
+                # A deliberate restart; the replacement has already
+                # been (or soon will be) reported to us.
+                continue
             self._browser.manager.logger.warning(
                 "browser %i: crashed, restarting"
                 % (self._browser.tag, pid))
@@ -149,6 +242,37 @@ class BrowserWatchdog(threading.Thread):
     def browser_started(self, pid):
         self._pq.put(pid)
 
+    def restart_reason(self, max_rss):
+        """If the browser has hung or grown too large, and should be
+           restarted before its next visit, return a short reason;
+           otherwise None."""
+        if self.hung:
+            return "hang"
+        pid = self._browser.pid
+        if max_rss is not None and pid is not None and \
+           process_tree_rss(pid) > max_rss:
+            return "memory"
+        return None
+
+# Chrome-privileged script which discards cookies, DOM storage, and
+# the like, so that a browser can be reused for an unrelated visit.
+CLEAR_STATE_SCRIPT = """
+    var Services = Components.utils.import(
+        "resource://gre/modules/Services.jsm", {}).Services;
+    Services.cookies.removeAll();
+    Services.obs.notifyObservers(null, "browser:purge-session-history", "");
+    return true;
+"""
+
+def clear_browser_state(driver):
+    """Clear cookies and storage in DRIVER's browser without
+       restarting it.  Returns False if this could not be done."""
+    try:
+        with driver.context(driver.CONTEXT_CHROME):
+            return bool(driver.execute_script(CLEAR_STATE_SCRIPT))
+    except (AttributeError, WebDriverException):
+        return False
+
 # Subroutines of Browser.visit_url which do not need to be methods.
 def extract_status_from_har(har, url):
     # URL _should_ be the final redirection destination, so we can
@@ -226,6 +350,10 @@ def get_neterr_details(url, nnsp, *, loop):
 class Browser:
     TAGGER = 0
 
+    # How long to wait for the thread running a hung visit to notice
+    # that its browser has been killed, before giving up on it.
+    STALE_VISIT_GRACE = 30
+
     """One browser running under a particular proxy."""
     def __init__(self, manager, proxy, loop):
         self.tag = Browser.TAGGER
@@ -240,9 +368,11 @@ class Browser:
         self.profile   = None
         self.profile2  = None
         self.driver    = None
+        self.stale_visit = None
         self.crash_ev  = asyncio.Event(loop=self.loop)
         self.ready_ev  = asyncio.Event(loop=self.loop)
         self.visit_id  = 0
+        self.visits_since_restart = 0
         self.har_token = "{:x}".format(rng.getrandbits(128))
 
         self.browser_params = manager.browser_params.copy()
@@ -277,62 +407,141 @@ class Browser:
     def restart(self):
         self.internal_cleanup()
         return asyncio.run_coroutine_threadsafe(
-            self.internal_restart, self.loop).result()
+            self.internal_restart(), self.loop).result()
 
     @asyncio.coroutine
     def internal_restart(self):
         q = queue.Queue()
         yield from asyncio.wait([
-            self.loop.run_in_executor(self.internal_start, q),
-            self.loop.run_in_executor(self.internal_start_qworker, q)
+            self.loop.run_in_executor(None, self.internal_start, q),
+            self.loop.run_in_executor(None, self.internal_start_qworker, q)
         ], loop=self.loop)
+        self.visits_since_restart = 0
+        self.watchdog.hung = False
         self.crash_ev.clear()
         self.ready_ev.set()
 
+    def restart_reason(self):
+        """Why the browser should be restarted before the next visit,
+           or None if it can be reused."""
+        if self.visits_since_restart >= self.manager.restart_every:
+            return "visits"
+        return self.watchdog.restart_reason(self.manager.max_rss)
+
+    @asyncio.coroutine
+    def planned_restart(self, reason):
+        self.manager.logger.info(
+            "browser %i: restarting (%s)" % (self.tag, reason))
+        self.manager.visit_stats.restarts[reason] += 1
+        BROWSER_RESTARTS.labels(reason).inc()
+        self.ready_ev.clear()
+        yield from self.finish_stale_visit()
+        yield from self.loop.run_in_executor(None, self.internal_quit)
+        yield from self.internal_restart()
+
+    @asyncio.coroutine
+    def finish_stale_visit(self):
+        """If a visit timed out or was interrupted by a crash, its
+           executor thread may still be driving the browser, and must
+           be done with it before anything else touches the driver.
+           Kill the browser, so that the thread's pending WebDriver
+           call fails, and wait for the thread to return; if it still
+           hasn't after STALE_VISIT_GRACE seconds, abandon it.  An
+           abandoned thread cannot touch a restarted browser, since
+           internal_visit_url only uses the driver it started with."""
+        visit = self.stale_visit
+        self.stale_visit = None
+        if visit is None or visit.done():
+            return
+
+        # Forget the pid first, so the watchdog takes this for a
+        # deliberate restart rather than a crash.
+        pid = self.pid
+        self.pid = None
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        try:
+            yield from asyncio.wait_for(asyncio.shield(visit),
+                                        self.STALE_VISIT_GRACE,
+                                        loop=self.loop)
+        except asyncio.TimeoutError:
+            self.manager.logger.warning(
+                "browser %i: abandoning hung visit thread" % self.tag)
+        except Exception:
+            # Failing is what we expected it to do.
+            pass
+
     @asyncio.coroutine
     def stop(self):
         if self.running:
             self.manager.forget_browser(self)
             self.running = False
+            yield from self.finish_stale_visit()
             yield from self.loop.run_in_executor(
-                self.internal_stop)
+                None, self.internal_stop)
 
     @asyncio.coroutine
-    def visit_url(self, url, timeout):
+    def visit_url(self, url, timeout=None):
         """Load URL and report the results.
            Returns a 5-tuple (url, final_url, status, page_html, har).
+           The HAR's log records how long each phase of the visit
+           took, as "_visit_phases"; see VisitStats.
         """
         if not self.running:
             raise RuntimeError("visit_url called when not running")
+        if timeout is None:
+            timeout = self.manager.visit_timeout
 
         yield from self.ready_ev.wait()
 
+        phases = {}
+        reason = self.restart_reason()
+        if reason is not None:
+            start = time.monotonic()
+            yield from self.planned_restart(reason)
+            phases["restart"] = time.monotonic() - start
+
         visit_task = self.loop.run_in_executor(
-                self.internal_visit_url, url)
-        crash_task = self.crash_ev.wait()
+                None, self.internal_visit_url, url, phases)
+        crash_task = self.loop.create_task(self.crash_ev.wait())
 
         fin, pen = yield from asyncio.wait(
             [visit_task, crash_task],
             loop=self.loop, timeout=timeout,
             return_when=cf.FIRST_COMPLETED)
 
-        for fut in pen:
-            fut.cancel()
+        # Cancelling visit_task would not stop the thread running it;
+        # keep hold of it instead, so the restart that must follow can
+        # wait for it (see finish_stale_visit).
+        if visit_task in pen:
+            visit_task.add_done_callback(
+                lambda fut: fut.cancelled() or fut.exception())
+            self.stale_visit = visit_task
+        if crash_task in pen:
+            crash_task.cancel()
             try:
-                yield from fut
+                yield from crash_task
             except asyncio.CancelledError:
                 pass
 
         if len(fin) == 0:
+            # The browser will be restarted before the next visit.
+            self.watchdog.hung = True
             return (url, "timeout", "", "", {})
 
-        if fin[0] is crash_task:
-            fin[0].result()
+        if crash_task in fin:
             return (url, "browser crashed", "", "", {})
 
-        (final_url, page_html, har) = fin[0].result()
+        self.visits_since_restart += 1
+        self.manager.visit_stats.record(phases)
+
+        (final_url, page_html, har) = visit_task.result()
+        har["log"]["_visit_phases"] = phases
         full_status = extract_status_from_har(har, final_url)
-        if not status:
+        if not full_status["status"]:
             full_status = yield from get_neterr_details(
                 final_url, self.browser_params["network_namespace"],
                 loop=self.loop
@@ -366,7 +575,7 @@ class Browser:
 
                 if message[1] == "Browser Launched":
                     self.pid = message[2][0]
-                    self.watchdog.browser_started(pid)
+                    self.watchdog.browser_started(self.pid)
                     break
                 elif message[1] == "Profile Created":
                     self.profile = message[2]
@@ -378,6 +587,25 @@ class Browser:
                         self.browser_params["network_namespace"],
                         message[1]))
 
+    def internal_quit(self):
+        """Shut down the browser process, for a restart.  Unlike
+           internal_stop, the watchdog thread keeps running."""
+        # Forget the pid first, so the watchdog takes the browser's
+        # exit for a deliberate restart rather than a crash.
+        pid = self.pid
+        self.pid = None
+        try:
+            self.driver.quit()
+        except WebDriverException as e:
+            self.manager.logger.warning(
+                "browser %i: driver.quit() failed: %s" % (self.tag, e))
+            if pid is not None:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        self.internal_cleanup()
+
     def internal_stop(self):
         self.driver.quit()
         self.watchdog.join(timeout=5)
@@ -402,7 +630,7 @@ class Browser:
 
         self.internal_cleanup()
 
-    def internal_cleanup():
+    def internal_cleanup(self):
         def log_rmtree_error(fn, path, exc_info):
             self.manager.logger.warning(
                 "%s: %s: %s" % (fn, path, exc_info[1].strerror))
@@ -417,13 +645,25 @@ class Browser:
             self.profile = None
 
         if self.profile2 is not None:
-            shutil.rmtree(self.profile, onerror=log_rmtree_error)
+            shutil.rmtree(self.profile2, onerror=log_rmtree_error)
             self.profile2 = None
 
-    def internal_visit_url(self, url):
+    def internal_visit_url(self, url, phases):
         self.visit_id += 1
-        bcmd.tab_restart_browser(self.driver)
-        self.driver.execute_async_script("""
+        # If this visit hangs, the browser will be restarted without
+        # waiting for us; don't touch the replacement if we wake up.
+        driver = self.driver
+
+        # Isolate this visit from the previous one: get off the old
+        # page, so it can't set any more cookies, then clear them and
+        # everything else the old page may have stored.  If the browser
+        # doesn't let us do that, fall back to a fresh tab.
+        start = time.monotonic()
+        bcmd.close_other_windows(driver)
+        driver.get("about:blank")
+        if not clear_browser_state(driver):
+            bcmd.tab_restart_browser(driver)
+        driver.execute_async_script("""
             var done = arguments[arguments.length-1];
             window['HAR_pageReady'] = false;
             window.addEventListener('har-page-ready', function (e) {
@@ -438,25 +678,38 @@ class Browser:
             }
         """)
 
-        self.driver.get(url)
-        har = self.driver.execute_async_script("""
+        phases["reset"] = time.monotonic() - start
+
+        start = time.monotonic()
+        driver.get(url)
+        phases["navigate"] = time.monotonic() - start
+
+        start = time.monotonic()
+        driver.execute_async_script("""
             var done = arguments[arguments.length-1];
-            function doExport() {
-                window.HAR.triggerExport({
-                    token: "%s", getData: true
-                }).then(function (result) { done(result.data); })
-            }
             if (window.HAR_pageReady) {
-                doExport();
+                done();
             } else {
-                window.addEventListener('har-page-ready', doExport, false);
+                window.addEventListener('har-page-ready', function (e) {
+                    done();
+                }, false);
             }
+        """)
+        phases["settle"] = time.monotonic() - start
+
+        start = time.monotonic()
+        har = driver.execute_async_script("""
+            var done = arguments[arguments.length-1];
+            window.HAR.triggerExport({
+                token: "%s", getData: true
+            }).then(function (result) { done(result.data); })
         """ % self.har_token)
+        phases["har_export"] = time.monotonic() - start
 
-        final_url = self.driver.url
-        page_html = self.driver.page_source.encode("utf8")
+        final_url = driver.current_url
+        page_html = driver.page_source.encode("utf8")
 
-        bcmd.close_other_windows(self.driver)
-        bcmd.bot_mitigation(self.driver)
+        bcmd.close_other_windows(driver)
+        bcmd.bot_mitigation(driver)
 
         return (final_url, page_html, har)
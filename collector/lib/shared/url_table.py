@@ -0,0 +1,213 @@
+# Compact URL lists shared among many capture locales.
+#
+# Copyright © 2014–2017 Zack Weinberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# There is NO WARRANTY.
+
+"""URL tables: one copy of the URL list, many per-locale work queues.
+
+A capture run visits every URL in its list once from each locale.
+Rather than give each locale its own list of URL strings, the
+dispatcher loads the list once into a URLTable, and each locale gets
+a URLQueue which hands out serial numbers into that table.
+
+The table is kept in three anonymous temporary files, all memory-
+mapped read-only once the table is built:
+
+    blob     all the URLs, UTF-8 encoded, back to back, in the order
+             they appear in the input file
+    offsets  (N+1) unsigned 64-bit offsets into 'blob'; URL number i
+             is blob[offsets[i]:offsets[i+1]]
+    order    N unsigned 32-bit URL numbers, shuffled; the URL with
+             serial number s is URL number order[s]
+
+so the resident cost of the table is whatever the kernel chooses to
+keep paged in.  While the table is being built, only the shuffled
+'order' array (four bytes per URL) is held in memory.
+
+A URLQueue's state is a cursor into the serial numbers, a stack of
+claims that were given back, and a bitmap of the serial numbers that
+have been completed (one bit per URL).  Claiming and completing are
+both O(1).  URLQueue supports just enough of the list interface
+(len, pop, append) to be used with the capture programs' claim_one.
+
+The shuffle is determined by the random number generator passed to
+URLTable, and the table records a digest of the URL list, so that an
+interrupted run can be resumed with the same serial numbers; see
+shared/capture_journal.py.
+"""
+
+import array
+import hashlib
+import mmap
+import random
+import tempfile
+
+class URLTable:
+    """Read-only, shuffled table of the URLs listed in the file FNAME
+       (one per line; blank lines and lines beginning with '#' are
+       ignored).  Temporary files are created in DIRECTORY, or the
+       system default if it is None."""
+
+    def __init__(self, fname, directory=None, rng=random):
+        self._files = []
+        self._maps  = []
+        self.queues = {}
+        digest = hashlib.sha256()
+
+        blob    = self._tempfile(directory)
+        offsets = self._tempfile(directory)
+        pos = 0
+        chunk = array.array('Q', [0])
+        with open(fname, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line[0] == ord('#'):
+                    continue
+                blob.write(line)
+                digest.update(line)
+                digest.update(b"\n")
+                pos += len(line)
+                chunk.append(pos)
+                if len(chunk) >= 65536:
+                    chunk.tofile(offsets)
+                    del chunk[:]
+        chunk.tofile(offsets)
+        del chunk
+
+        nurls = offsets.tell() // 8 - 1
+        if nurls >= 2**32:
+            raise ValueError(fname + ": too many URLs")
+
+        order = array.array('I', range(nurls))
+        rng.shuffle(order)
+        orderf = self._tempfile(directory)
+        order.tofile(orderf)
+        del order
+
+        self.digest   = digest.hexdigest()
+        self._nurls   = nurls
+        self._blob    = self._map(blob)
+        self._offsets = self._map(offsets).cast('Q')
+        self._order   = self._map(orderf).cast('I')
+
+    def _tempfile(self, directory):
+        f = tempfile.TemporaryFile(dir=directory)
+        self._files.append(f)
+        return f
+
+    def _map(self, f):
+        f.flush()
+        if f.tell() == 0:
+            # Can't mmap an empty file.
+            return memoryview(b"")
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(m)
+        return memoryview(m)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        for v in (self._blob, self._offsets, self._order):
+            v.release()
+        for m in self._maps:
+            m.close()
+        for f in self._files:
+            f.close()
+        self._maps = []
+        self._files = []
+
+    def __len__(self):
+        return self._nurls
+
+    def __getitem__(self, serial):
+        """The URL with serial number SERIAL."""
+        if not 0 <= serial < self._nurls:
+            raise IndexError(serial)
+        i = self._order[serial]
+        return bytes(self._blob[self._offsets[i]:self._offsets[i+1]]) \
+            .decode("utf-8")
+
+    def queue(self, locale):
+        """Create (or retrieve) the work queue for LOCALE."""
+        q = self.queues.get(locale)
+        if q is None:
+            q = self.queues[locale] = URLQueue(self)
+        return q
+
+    def progress(self):
+        """Return a dictionary mapping each locale to a 2-tuple
+           (completed, remaining) counting URLs."""
+        return { loc: (q.n_done, len(q))
+                 for loc, q in self.queues.items() }
+
+class URLQueue:
+    """The work of one locale: every URL in TABLE, once.
+
+       pop() claims the next URL and returns (serial, url); append()
+       gives a claim back, so that it will be handed out again; and
+       complete() records that a claimed URL has been dealt with.
+       mark_done() records that a URL was dealt with by an earlier,
+       interrupted run, so it will never be handed out.
+       len() is the number of URLs not currently claimed or completed.
+    """
+
+    def __init__(self, table):
+        self.table      = table
+        self.n_done     = 0
+        self._next      = 0
+        self._retry     = []
+        self._remaining = len(table)
+        self._done      = bytearray((len(table) + 7) // 8)
+
+    def __len__(self):
+        return self._remaining
+
+    def pop(self):
+        if self._retry:
+            serial = self._retry.pop()
+        else:
+            while self._next < len(self.table) and \
+                  self.is_done(self._next):
+                self._next += 1
+            if self._next >= len(self.table):
+                raise IndexError("pop from empty URLQueue")
+            serial = self._next
+            self._next += 1
+        self._remaining -= 1
+        return (serial, self.table[serial])
+
+    def append(self, task):
+        serial = task[0]
+        if self.is_done(serial):
+            raise ValueError("URL {} already completed".format(serial))
+        self._retry.append(serial)
+        self._remaining += 1
+
+    def mark_done(self, serial):
+        if not 0 <= serial < len(self.table):
+            raise IndexError(serial)
+        if self._next or self._retry:
+            raise RuntimeError("mark_done after URLs have been claimed")
+        if not self.is_done(serial):
+            self.complete(serial)
+            self._remaining -= 1
+
+    def complete(self, serial):
+        byte, bit = divmod(serial, 8)
+        if not self._done[byte] & (1 << bit):
+            self._done[byte] |= (1 << bit)
+            self.n_done += 1
+
+    def is_done(self, serial):
+        byte, bit = divmod(serial, 8)
+        return bool(self._done[byte] & (1 << bit))
@@ -11,18 +11,36 @@ simultaneously --- implementation."""
 
 import asyncio
 import json
-import os
-import os.path
-import random
 import subprocess
 import sys
 import time
 import zlib
 
 from shared.util import canon_url_syntax, categorize_result_ff
+from shared import metrics
 from shared.aioproxies import ProxySet
+from shared.capture_journal import open_run
 from shared.openwpm_browsers import BrowserManager
 
+CAPTURES = metrics.counter(
+    "collector_captures_total",
+    "Captures completed, by result category.", ("locale", "status"))
+CAPTURE_SECONDS = metrics.histogram(
+    "collector_capture_seconds",
+    "Time taken by each capture.", ("locale",))
+CAPTURES_IN_PROGRESS = metrics.gauge(
+    "collector_captures_in_progress",
+    "Captures currently under way.", ("locale",))
+URLS_REMAINING = metrics.gauge(
+    "collector_urls_remaining",
+    "URLs not yet captured (or claimed for capture).", ("locale",))
+WRITE_BACKLOG = metrics.gauge(
+    "collector_write_backlog",
+    "Results waiting to be, or being, written out by executor threads.")
+WRITE_SECONDS = metrics.histogram(
+    "collector_write_seconds",
+    "Time taken to write out each result and journal it.")
+
 class CaptureResult:
     """The result of one capture job."""
     def __init__(self, url):
@@ -61,9 +79,10 @@ class CaptureResult:
         self.content = content
         self.log = capture_log
 
-    def write_result(self, fname):
-        """Write the results file for this URL, to FNAME.  Results files are
-           binary, but the first chunk is mostly human-readable.
+    def encode(self):
+        """Encode the results for this URL as a capture file, and
+           return it as a bytes object.  Capture files are binary, but
+           the first chunk is mostly human-readable.
 
            The initial eight bytes of a result file are a magic number:
 
@@ -104,36 +123,32 @@ class CaptureResult:
            Note that in both versions, the page contents are a
            serialization of the DOM at snapshot time, *not* the
            original HTML received on the wire.
-
-           If any parent directory of FNAME does not exist it will be
-           created.  It is an error if FNAME itself already exists.
-
         """
-        fname = os.path.abspath(fname)
-        os.makedirs(os.path.dirname(fname), exist_ok=True)
-
-        with open(fname, "xb") as fp:
-            compressed_content = zlib.compress(self.content.encode("utf-8"), 9)
-            compressed_log = zlib.compress(self.log.encode("utf-8"), 9)
-
-            fp.write("\u007Fcap 01\n"
-                     "{ourl}\n"
-                     "{curl}\n"
-                     "{stat}\n"
-                     "{dtyl}\n"
-                     "{elap:.6f}\n"
-                     "{clen} {llen}\n"
-                     .format(ourl=self.original_url,
-                             curl=self.canon_url,
-                             stat=self.status,
-                             dtyl=self.detail,
-                             elap=self.elapsed,
-                             clen=len(compressed_content),
-                             llen=len(compressed_log))
-                     .encode("utf-8"))
-
-            fp.write(compressed_content)
-            fp.write(compressed_log)
+        compressed_content = zlib.compress(self.content.encode("utf-8"), 9)
+        compressed_log = zlib.compress(self.log.encode("utf-8"), 9)
+
+        header = ("\u007Fcap 01\n"
+                  "{ourl}\n"
+                  "{curl}\n"
+                  "{stat}\n"
+                  "{dtyl}\n"
+                  "{elap:.6f}\n"
+                  "{clen} {llen}\n"
+                  .format(ourl=self.original_url,
+                          curl=self.canon_url,
+                          stat=self.status,
+                          dtyl=self.detail,
+                          elap=self.elapsed,
+                          clen=len(compressed_content),
+                          llen=len(compressed_log))
+                  .encode("utf-8"))
+
+        return header + compressed_content + compressed_log
+
+    def write_result(self, archive, serial, locale):
+        """Append the results for this URL to ARCHIVE (a
+           CaptureArchiveWriter), tagged with SERIAL and LOCALE."""
+        archive.append(serial, locale, self.original_url, self.encode())
 
 @asyncio.coroutine
 def do_capture(url, browser, loop):
@@ -148,9 +163,9 @@ def do_capture(url, browser, loop):
     return result
 
 class claim_one:
-    """Context manager which "claims" an entry from a list (as-if via
-       pop()).  If the with-context throws an exception, the entry
-       will be restored to the list.
+    """Context manager which "claims" an entry from a list or a
+       URLQueue (as-if via pop()).  If the with-context throws an
+       exception, the entry will be restored to the list.
     """
     def __init__(self, lst):
         self._lst = lst
@@ -184,21 +199,17 @@ class CaptureWorker:
 
     """Control the process of crunching through all the URLs for a given
        locale."""
-    def __init__(self, output_dir, locale, urls,
+    def __init__(self, archive, journal, locale, urls,
                  loop, max_workers, output_queue, quiet):
-        self.output_dir   = output_dir
+        self.archive      = archive
+        self.journal      = journal
         self.locale       = locale
         self.urls         = urls
         self.loop         = loop
         self.max_workers  = max_workers
         self.output_queue = output_queue
         self.quiet        = quiet
-
-    def output_fname(self, serial):
-        return "{}/{:02d}/{:03d}/{:03d}.{}".format(
-            self.output_dir,
-            serial // 1000000, (serial % 1000000) // 1000, serial % 1000,
-            self.locale)
+        URLS_REMAINING.labels(locale).set_function(urls.__len__)
 
     def progress(self, label, url, message):
         if self.quiet: return
@@ -207,10 +218,22 @@ class CaptureWorker:
         else:
             sys.stderr.write(label + url + ": " + message + "\n")
 
+    def write_result(self, result, serial):
+        """Write out RESULT, then record it in the journal.
+           Runs in an executor thread."""
+        try:
+            with WRITE_SECONDS.time():
+                result.write_result(self.archive, serial, self.locale)
+                self.journal.record(self.locale, serial)
+        finally:
+            WRITE_BACKLOG.dec()
+
     @asyncio.coroutine
     def run_worker(self, bmgr, proxy, i):
         """MAX_WORKERS instances of this coroutine are spawned by run()."""
         label = "{} {}: ".format(proxy.label(), i)
+        in_progress     = CAPTURES_IN_PROGRESS.labels(self.locale)
+        capture_seconds = CAPTURE_SECONDS.labels(self.locale)
 
         with (yield from bmgr.start_browser(proxy)) as browser:
             while True:
@@ -220,27 +243,42 @@ class CaptureWorker:
                     (serial, url) = task
 
                     self.progress(label, url, "...")
+                    in_progress.inc()
                     try:
-                        result = yield from do_capture(url, proxy, self.loop)
+                        result = yield from do_capture(url, browser,
+                                                       self.loop)
+                        proxy.stats.note_capture(not result.is_failure(),
+                                                 len(result.content),
+                                                 result.elapsed)
+                        CAPTURES.labels(self.locale, result.status).inc()
+                        capture_seconds.observe(result.elapsed)
                         self.progress(label, url, result.status)
                     except:
                         self.progress(label, url, "fail")
                         raise
+                    finally:
+                        in_progress.dec()
+
+                self.urls.complete(serial)
 
                 # The result is written out in an executor because neither
                 # file I/O nor zlib are asynchronous, and we don't want
                 # this to hold up the event loop. (Both do drop the GIL.)
                 # The output_queue_drainer waits for the future, and we go on.
+                WRITE_BACKLOG.inc()
                 yield from self.output_queue.put(
                     self.loop.run_in_executor(None,
-                        result.write_result,
-                        self.output_fname(serial)))
+                        self.write_result, result, serial))
 
     @asyncio.coroutine
     def run(self, bmgr, proxy):
         # There is no point in running more workers than we have URLs
         # (left) to process.
         nworkers = min(self.max_workers, len(self.urls))
+        if nworkers == 0:
+            # Possible when resuming a run.
+            proxy.close()
+            return
 
         # Unlike wait_for(), wait() does _not_ cancel everything it's
         # waiting for when it is itself cancelled.  Since that's what
@@ -276,34 +314,27 @@ class CaptureDispatcher:
         self.proxies      = ProxySet(args,
                                      nstag="cap",
                                      loop=self.loop,
-                                     proxy_sort_key=self.proxy_sort_key)
-
-        run = 1
-        while True:
-            try:
-                path = os.path.join(self.args.output_dir, str(run))
-                os.makedirs(path)
-                self.output_dir = path
-                break
-            except FileExistsError:
-                run += 1
-                continue
-
-        with open(self.args.urls) as f:
-            urls = [l for l in (ll.strip() for ll in f)
-                    if l and l[0] != '#']
-
-        random.shuffle(urls)
-        urls = list(enumerate(urls))
+                                     proxy_sort_key=self.proxy_sort_key,
+                                     remaining_work=self.remaining_work)
+
+        # One copy of the URL list, shuffled, is shared by all locales.
+        # When resuming, work already recorded in the run's journal
+        # has been taken out of each locale's queue.
+        (self.output_dir, self.archive, self.url_table, self.journal) = \
+            open_run(self.args.output_dir, self.args.urls, self.args.resume)
 
         self.workers = {
-            loc: CaptureWorker(self.output_dir, loc, urls[:],
+            loc: CaptureWorker(self.archive, self.journal, loc,
+                               self.url_table.queue(loc),
                                self.loop, self.args.workers_per_loc,
                                self.output_queue, self.args.quiet)
 
             for loc in self.proxies.locations.keys()
         }
 
+    def remaining_work(self, loc):
+        return len(self.workers[loc].urls)
+
     def proxy_sort_key(self, loc, method):
         # Consider locales with more work to do first.
         # Consider locales whose proxy is 'direct' first.
@@ -316,13 +347,21 @@ class CaptureDispatcher:
 
     @asyncio.coroutine
     def run(self):
-        with BrowserManager(...) as bmgr:
+        with BrowserManager(self.loop, self.output_dir,
+                            restart_every=self.args.restart_every,
+                            max_rss=self.args.browser_max_rss,
+                            visit_timeout=self.args.visit_timeout) as bmgr, \
+             self.archive, self.url_table, self.journal, \
+             metrics.exported(self.args.metrics_port,
+                              self.args.metrics_file):
             self.bmgr = bmgr
             yield from self.proxies.run(self)
             if self.active:
                 yield from asyncio.wait(self.active, loop=self.loop)
             yield from self.output_queue.put(None)
             yield from asyncio.wait_for(self.drainer, None)
+            if not self.args.quiet:
+                sys.stderr.write(bmgr.visit_stats.report())
 
     @asyncio.coroutine
     def proxy_online(self, proxy):
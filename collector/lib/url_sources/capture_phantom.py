@@ -12,16 +12,37 @@ import asyncio
 import json
 import os
 import os.path
-import random
+import signal
 import subprocess
 import sys
 import time
 import zlib
 
 from shared.util import canon_url_syntax, categorize_result_ph
+from shared import metrics
 from shared.aioproxies import ProxySet
+from shared.capture_journal import open_run
 from shared.strsignal import strsignal
 
+CAPTURES = metrics.counter(
+    "collector_captures_total",
+    "Captures completed, by result category.", ("locale", "status"))
+CAPTURE_SECONDS = metrics.histogram(
+    "collector_capture_seconds",
+    "Time taken by each capture.", ("locale",))
+CAPTURES_IN_PROGRESS = metrics.gauge(
+    "collector_captures_in_progress",
+    "Captures currently under way.", ("locale",))
+URLS_REMAINING = metrics.gauge(
+    "collector_urls_remaining",
+    "URLs not yet captured (or claimed for capture).", ("locale",))
+WRITE_BACKLOG = metrics.gauge(
+    "collector_write_backlog",
+    "Results waiting to be, or being, written out by executor threads.")
+WRITE_SECONDS = metrics.histogram(
+    "collector_write_seconds",
+    "Time taken to write out each result and journal it.")
+
 pj_trace_redir = os.path.realpath(os.path.join(
         os.path.dirname(__file__),
         "../../scripts/pj-trace-redir.js"))
@@ -35,6 +56,7 @@ class CaptureResult:
         self.canon_url    = ""
         self.content      = ""
         self.elapsed      = 0.
+        self.job_id       = None    # set by parse_stdout in server mode
 
         # Make sure the URL is not so mangled that phantomjs is just going
         # to give up and report nothing at all.
@@ -94,6 +116,7 @@ class CaptureResult:
             stdout = stdout.decode('utf-8')
             results = json.loads(stdout)
             self.canon_url     = results["canon"]
+            self.job_id        = results.get("id")
             self.status        = results["status"]
             self.detail        = results.get("detail")
             if not self.detail:
@@ -170,9 +193,10 @@ class CaptureResult:
         if anomalous_stderr:
             self.log["stderr"] = anomalous_stderr
 
-    def write_result(self, fname):
-        """Write the results file for this URL, to FNAME.  Results files are
-           binary, but the first chunk is mostly human-readable.
+    def encode(self):
+        """Encode the results for this URL as a capture file, and
+           return it as a bytes object.  Capture files are binary, but
+           the first chunk is mostly human-readable.
 
            The initial eight bytes of a result file are a magic number:
 
@@ -201,45 +225,41 @@ class CaptureResult:
            the compression.  (If either is *completely* empty, then it
            will be written out as zero bytes, rather than as the
            compression of zero bytes.)
-
-           If any parent directory of FNAME does not exist it will be
-           created.  It is an error if FNAME itself already exists.
-
         """
-        fname = os.path.abspath(fname)
-        os.makedirs(os.path.dirname(fname), exist_ok=True)
-
-        with open(fname, "xb") as fp:
-            if self.content:
-                compressed_content = zlib.compress(
-                    self.content.encode("utf-8"))
-            else:
-                compressed_content = b""
+        if self.content:
+            compressed_content = zlib.compress(
+                self.content.encode("utf-8"))
+        else:
+            compressed_content = b""
 
-            if self.log:
-                compressed_log = zlib.compress(
-                    json.dumps(self.log).encode("utf-8"))
-            else:
-                compressed_log = b""
-
-            fp.write("\u007Fcap 00\n"
-                     "{ourl}\n"
-                     "{curl}\n"
-                     "{stat}\n"
-                     "{dtyl}\n"
-                     "{elap:.6f}\n"
-                     "{clen} {llen}\n"
-                     .format(ourl=self.original_url,
-                             curl=self.canon_url,
-                             stat=self.status,
-                             dtyl=self.detail,
-                             elap=self.elapsed,
-                             clen=len(compressed_content),
-                             llen=len(compressed_log))
-                     .encode("utf-8"))
-
-            fp.write(compressed_content)
-            fp.write(compressed_log)
+        if self.log:
+            compressed_log = zlib.compress(
+                json.dumps(self.log).encode("utf-8"))
+        else:
+            compressed_log = b""
+
+        header = ("\u007Fcap 00\n"
+                  "{ourl}\n"
+                  "{curl}\n"
+                  "{stat}\n"
+                  "{dtyl}\n"
+                  "{elap:.6f}\n"
+                  "{clen} {llen}\n"
+                  .format(ourl=self.original_url,
+                          curl=self.canon_url,
+                          stat=self.status,
+                          dtyl=self.detail,
+                          elap=self.elapsed,
+                          clen=len(compressed_content),
+                          llen=len(compressed_log))
+                  .encode("utf-8"))
+
+        return header + compressed_content + compressed_log
+
+    def write_result(self, archive, serial, locale):
+        """Append the results for this URL to ARCHIVE (a
+           CaptureArchiveWriter), tagged with SERIAL and LOCALE."""
+        archive.append(serial, locale, self.original_url, self.encode())
 
 @asyncio.coroutine
 def do_capture(url, proxy, loop):
@@ -272,10 +292,253 @@ def do_capture(url, proxy, loop):
     result.set_result(proc.returncode, stdout, stderr, elapsed)
     return result
 
+class PhantomWorker:
+    """A long-lived PhantomJS process, running pj-trace-redir.js in
+       --server mode, which captures one URL after another through
+       PROXY.  This saves the cost of starting up PhantomJS, and
+       initializing WebKit, for every URL.
+
+       The worker is started on first use, and replaced with a fresh
+       process after MAX_CAPTURES captures, as soon as its resident
+       set grows beyond MAX_RSS bytes (None: no limit), since WebKit
+       leaks, or once it is MAX_AGE seconds old.  If a capture takes
+       longer than TIMEOUT seconds, or the process crashes, the
+       capture fails the same way it would have with do_capture, and
+       the next capture starts a new process.  So does a reply that
+       is not for the job just sent, which means the process is out
+       of step with us.
+
+       The per-process CPU limit that isolate would otherwise apply
+       is disabled, since it would be cumulative over all of the
+       captures; TIMEOUT takes its place.  The wall-clock limit is
+       kept only as a backstop, set far enough beyond MAX_AGE that it
+       cannot fire during a capture.
+    """
+
+    # Each result is a single line on stdout, including the entire
+    # content of the page.
+    MAX_RESULT_SIZE = 512 * 1024 * 1024
+
+    # How long to wait for a new process to report that it is ready.
+    STARTUP_TIMEOUT = 60
+
+    def __init__(self, proxy, loop, max_captures=100,
+                 max_rss=1024 * 1024 * 1024, timeout=600,
+                 max_age=6 * 3600):
+        self.proxy        = proxy
+        self.loop         = loop
+        self.max_captures = max_captures
+        self.max_rss      = max_rss
+        self.timeout      = timeout
+        self.max_age      = max_age
+        self.n_captures   = 0
+        self.n_processes  = 0
+        self._proc_captures = 0
+        self._proc        = None
+        self._proc_start  = 0.
+        self._stderr      = bytearray()
+        self._stderr_task = None
+        self._busy        = False
+        self._job_serial  = 0
+
+    @asyncio.coroutine
+    def capture(self, url):
+        result = CaptureResult(url)
+        if result.status:
+            return result
+
+        start = time.monotonic()
+        # A worker can sit idle for a long time (while its slot is not
+        # part of its proxy's share); don't let it hit the wall-clock
+        # limit in the middle of the next capture.
+        if self._proc is not None and self._too_old():
+            yield from self.stop()
+        if self._proc is None:
+            exitcode = yield from self._start()
+            if exitcode is not None:
+                result.set_result(exitcode, b"", self._take_stderr(),
+                                  time.monotonic() - start)
+                return result
+
+        self._job_serial += 1
+        job = json.dumps({ "id": self._job_serial,
+                           "url": result.original_url })
+        self._busy = True
+        self._take_stderr()
+        line = b""
+        timed_out = False
+        try:
+            self._proc.stdin.write(job.encode("utf-8") + b"\n")
+            yield from self._proc.stdin.drain()
+            line = yield from asyncio.wait_for(self._proc.stdout.readline(),
+                                               self.timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            timed_out = True
+        except (ConnectionError, ValueError):
+            # The process went away, or wrote an impossibly long line.
+            pass
+
+        if line:
+            self._busy = False
+            self.n_captures += 1
+            self._proc_captures += 1
+            result.set_result(0, line, self._take_stderr(),
+                              time.monotonic() - start)
+            if result.job_id != self._job_serial:
+                # A stray or late line (or one too garbled to tell);
+                # whatever the process is doing, it is not the job we
+                # sent it.
+                yield from self._terminate(signal.SIGTERM)
+                if result.status != "crawler failure":
+                    result.status = "crawler failure"
+                    result.detail = "tracer answered the wrong job"
+                    result.log["stdout"] = line.decode("utf-8",
+                                                       "backslashreplace")
+                    result.content = ""
+            elif self._worn_out():
+                yield from self.stop()
+        else:
+            # isolate relays SIGALRM to phantomjs, so a hung capture
+            # is reported as a timeout, just as it would be if isolate's
+            # own watchdog had fired.
+            exitcode = yield from self._terminate(
+                signal.SIGALRM if timed_out else signal.SIGTERM)
+            result.set_result(exitcode, b"", self._take_stderr(),
+                              time.monotonic() - start)
+        return result
+
+    @asyncio.coroutine
+    def stop(self):
+        """Shut down the worker process, if any.  An idle worker is
+           allowed to exit on its own; a busy one is killed."""
+        if self._proc is None:
+            return
+        if self._busy:
+            yield from self._terminate(signal.SIGTERM)
+            return
+
+        self._proc.stdin.close()
+        try:
+            yield from asyncio.wait_for(self._proc.wait(), 10,
+                                        loop=self.loop)
+        except asyncio.TimeoutError:
+            pass
+        yield from self._terminate(signal.SIGTERM)
+
+    @asyncio.coroutine
+    def _start(self):
+        """Start a new worker process and wait for it to be ready.
+           Returns None on success, or the exit code of the process
+           if it failed to start."""
+        self.n_processes += 1
+        self._proc_captures = 0
+        self._proc_start = time.monotonic()
+        self._busy = False
+        self._proc = yield from asyncio.create_subprocess_exec(
+            *self.proxy.adjust_command([
+                "isolate",
+                "ISOL_RL_MEM=unlimited",
+                "ISOL_RL_STACK=8388608",
+                "ISOL_RL_CPU=unlimited",
+                "ISOL_RL_WALL={}".format(int(self.max_age + self.timeout +
+                                             2 * self.STARTUP_TIMEOUT)),
+                "PHANTOMJS_DISABLE_CRASH_DUMPS=1",
+                "MALLOC_CHECK_=0",
+                "phantomjs",
+                "--local-url-access=no",
+                "--load-images=false",
+                pj_trace_redir,
+                "--server"
+            ]),
+            stdin  = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            limit  = self.MAX_RESULT_SIZE,
+            loop   = self.loop)
+        self._stderr_task = self.loop.create_task(
+            self._drain_stderr(self._proc.stderr))
+
+        try:
+            hello = yield from asyncio.wait_for(self._proc.stdout.readline(),
+                                                self.STARTUP_TIMEOUT,
+                                                loop=self.loop)
+            if json.loads(hello.decode("utf-8")).get("ready"):
+                return None
+        except (asyncio.TimeoutError, ValueError, AttributeError):
+            pass
+        return (yield from self._terminate(signal.SIGTERM))
+
+    @asyncio.coroutine
+    def _terminate(self, sig):
+        """Send SIG to the worker process and wait for it to exit.
+           isolate passes the signal along to phantomjs, and follows
+           up with SIGKILL if phantomjs doesn't exit within a second.
+           Returns the exit code."""
+        proc = self._proc
+        self._proc = None
+        self._busy = False
+        if proc.returncode is None:
+            try:
+                proc.send_signal(sig)
+            except ProcessLookupError:
+                pass
+        try:
+            yield from asyncio.wait_for(proc.wait(), 5, loop=self.loop)
+        except asyncio.TimeoutError:
+            proc.kill()
+            yield from proc.wait()
+
+        try:
+            yield from asyncio.wait_for(self._stderr_task, 5, loop=self.loop)
+        except asyncio.TimeoutError:
+            pass
+        self._stderr_task = None
+        return proc.returncode
+
+    @asyncio.coroutine
+    def _drain_stderr(self, stream):
+        while True:
+            data = yield from stream.read(65536)
+            if not data:
+                break
+            self._stderr.extend(data)
+
+    def _take_stderr(self):
+        stderr = bytes(self._stderr)
+        del self._stderr[:]
+        return stderr
+
+    def _too_old(self):
+        return time.monotonic() - self._proc_start >= self.max_age
+
+    def _worn_out(self):
+        if self._proc_captures >= self.max_captures or self._too_old():
+            return True
+        return self.max_rss is not None and self._rss() > self.max_rss
+
+    def _rss(self):
+        """The resident set size of the phantomjs process, in bytes,
+           or 0 if it cannot be determined.  The process we started
+           is isolate, so we have to look at its children."""
+        try:
+            with open("/proc/{0}/task/{0}/children"
+                      .format(self._proc.pid)) as f:
+                pids = f.read().split()
+            rss = 0
+            for pid in pids:
+                with open("/proc/{}/status".format(pid)) as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1]) * 1024
+                            break
+            return rss
+        except (OSError, ValueError):
+            return 0
+
 class claim_one:
-    """Context manager which "claims" an entry from a list (as-if via
-       pop()).  If the with-context throws an exception, the entry
-       will be restored to the list.
+    """Context manager which "claims" an entry from a list or a
+       URLQueue (as-if via pop()).  If the with-context throws an
+       exception, the entry will be restored to the list.
     """
     def __init__(self, lst):
         self._lst = lst
@@ -309,10 +572,12 @@ class CaptureWorker:
 
     """Control the process of crunching through all the URLs for a given
        locale."""
-    def __init__(self, output_dir, locale, urls,
+    def __init__(self, archive, journal, locale, urls,
                  loop, max_workers, global_bound,
-                 output_queue, quiet):
-        self.output_dir   = output_dir
+                 output_queue, quiet,
+                 captures_per_worker=100, worker_max_rss=None):
+        self.archive      = archive
+        self.journal      = journal
         self.locale       = locale
         self.urls         = urls
         self.loop         = loop
@@ -320,12 +585,9 @@ class CaptureWorker:
         self.global_bound = global_bound
         self.output_queue = output_queue
         self.quiet        = quiet
-
-    def output_fname(self, serial):
-        return "{}/{:02d}/{:03d}/{:03d}.{}".format(
-            self.output_dir,
-            serial // 1000000, (serial % 1000000) // 1000, serial % 1000,
-            self.locale)
+        URLS_REMAINING.labels(locale).set_function(urls.__len__)
+        self.captures_per_worker = captures_per_worker
+        self.worker_max_rss      = worker_max_rss
 
     def progress(self, label, url, message):
         if self.quiet: return
@@ -334,39 +596,81 @@ class CaptureWorker:
         else:
             sys.stderr.write(label + url + ": " + message + "\n")
 
+    def write_result(self, result, serial):
+        """Write out RESULT, then record it in the journal.
+           Runs in an executor thread."""
+        try:
+            with WRITE_SECONDS.time():
+                result.write_result(self.archive, serial, self.locale)
+                self.journal.record(self.locale, serial)
+        finally:
+            WRITE_BACKLOG.dec()
+
     @asyncio.coroutine
     def run_worker(self, proxy, i):
         """MAX_WORKERS instances of this coroutine are spawned by run()."""
         label = "{} {}: ".format(proxy.label(), i)
-        while True:
-            with (yield from self.global_bound), \
-                 claim_one(self.urls) as task:
-
-                if task is None: break
-                (serial, url) = task
-
-                self.progress(label, url, "...")
-                try:
-                    result = yield from do_capture(url, proxy, self.loop)
-                    self.progress(label, url, result.status)
-                except:
-                    self.progress(label, url, "fail")
-                    raise
-
-            # The result is written out in an executor because neither
-            # file I/O nor zlib are asynchronous, and we don't want
-            # this to hold up the event loop. (Both do drop the GIL.)
-            # The output_queue_drainer waits for the future, and we go on.
-            yield from self.output_queue.put(
-                self.loop.run_in_executor(None,
-                    result.write_result,
-                    self.output_fname(serial)))
+        in_progress     = CAPTURES_IN_PROGRESS.labels(self.locale)
+        capture_seconds = CAPTURE_SECONDS.labels(self.locale)
+        # Each worker slot has its own PhantomJS process, which must not
+        # outlive the slot (nor, therefore, the proxy).
+        phantom = PhantomWorker(proxy, self.loop,
+                                max_captures=self.captures_per_worker,
+                                max_rss=self.worker_max_rss)
+        try:
+            while True:
+                # ProxySet shares the workers out among the online
+                # proxies according to their throughput; stand by
+                # while this slot is not part of this proxy's share.
+                while (proxy.worker_quota is not None and
+                       i >= proxy.worker_quota and len(self.urls) > 0):
+                    yield from asyncio.sleep(5, loop=self.loop)
+
+                with (yield from self.global_bound), \
+                     claim_one(self.urls) as task:
+
+                    if task is None: break
+                    (serial, url) = task
+
+                    self.progress(label, url, "...")
+                    in_progress.inc()
+                    try:
+                        result = yield from phantom.capture(url)
+                        proxy.stats.note_capture(not result.is_failure(),
+                                                 len(result.content),
+                                                 result.elapsed)
+                        CAPTURES.labels(self.locale, result.status).inc()
+                        capture_seconds.observe(result.elapsed)
+                        self.progress(label, url, result.status)
+                    except:
+                        self.progress(label, url, "fail")
+                        raise
+                    finally:
+                        in_progress.dec()
+
+                self.urls.complete(serial)
+
+                # The result is written out in an executor because
+                # neither file I/O nor zlib are asynchronous, and we
+                # don't want this to hold up the event loop. (Both do
+                # drop the GIL.)  The output_queue_drainer waits for
+                # the future, and we go on.
+                WRITE_BACKLOG.inc()
+                yield from self.output_queue.put(
+                    self.loop.run_in_executor(None,
+                        self.write_result, result, serial))
+        finally:
+            yield from phantom.stop()
 
     @asyncio.coroutine
     def run(self, proxy):
         # There is no point in running more workers than we have URLs
         # (left) to process.
         nworkers = min(self.max_workers, len(self.urls))
+        if nworkers == 0:
+            # Possible when resuming a run.
+            proxy.close()
+            return
 
         # Unlike wait_for(), wait() does _not_ cancel everything it's
         # waiting for when it is itself cancelled.  Since that's what
@@ -403,35 +707,30 @@ class CaptureDispatcher:
         self.proxies      = ProxySet(args,
                                      nstag="cap",
                                      loop=self.loop,
-                                     proxy_sort_key=self.proxy_sort_key)
+                                     proxy_sort_key=self.proxy_sort_key,
+                                     remaining_work=self.remaining_work)
 
-        run = 1
-        while True:
-            try:
-                path = os.path.join(self.args.output_dir, str(run))
-                os.makedirs(path)
-                self.output_dir = path
-                break
-            except FileExistsError:
-                run += 1
-                continue
-
-        with open(self.args.urls) as f:
-            urls = [l for l in (ll.strip() for ll in f)
-                    if l and l[0] != '#']
-
-        random.shuffle(urls)
-        urls = list(enumerate(urls))
+        # One copy of the URL list, shuffled, is shared by all locales.
+        # When resuming, work already recorded in the run's journal
+        # has been taken out of each locale's queue.
+        (self.output_dir, self.archive, self.url_table, self.journal) = \
+            open_run(self.args.output_dir, self.args.urls, self.args.resume)
 
         self.workers = {
-            loc: CaptureWorker(self.output_dir, loc, urls[:],
+            loc: CaptureWorker(self.archive, self.journal, loc,
+                               self.url_table.queue(loc),
                                self.loop, self.args.workers_per_loc,
                                self.global_bound, self.output_queue,
-                               self.args.quiet)
+                               self.args.quiet,
+                               self.args.captures_per_worker,
+                               self.args.worker_max_rss)
 
             for loc in self.proxies.locations.keys()
         }
 
+    def remaining_work(self, loc):
+        return len(self.workers[loc].urls)
+
     def proxy_sort_key(self, loc, method):
         # Consider locales with more work to do first.
         # Consider locales whose proxy is 'direct' first.
@@ -444,11 +743,14 @@ class CaptureDispatcher:
 
     @asyncio.coroutine
     def run(self):
-        yield from self.proxies.run(self)
-        if self.active:
-            yield from asyncio.wait(self.active, loop=self.loop)
-        yield from self.output_queue.put(None)
-        yield from asyncio.wait_for(self.drainer, None)
+        with self.archive, self.url_table, self.journal, \
+             metrics.exported(self.args.metrics_port,
+                              self.args.metrics_file):
+            yield from self.proxies.run(self)
+            if self.active:
+                yield from asyncio.wait(self.active, loop=self.loop)
+            yield from self.output_queue.put(None)
+            yield from asyncio.wait_for(self.drainer, None)
 
     @asyncio.coroutine
     def proxy_online(self, proxy):
@@ -37,17 +37,29 @@ The second non-optional argument is the list of URLs to process, one per
 line.
 
 The third non-optional argument is the directory in which to store
-results.  Each result will be written to its own file in this
-directory; the directory hierarchy has the structure
-
-  ${OUTPUT_DIR}/${RUN}/AB/CDE/FGH.${LOCALE}
-
-where RUN starts at zero and is incremented by one each time the program is
-invoked, and AB,CDE,FGH is a 8-digit decimal number assigned to each URL.
-This number is not meaningful; you must look in each file to learn which
-URL goes with which result.
-
-The output files are binary; see CaptureResult.write_result for the format.
+results.  Results are appended to a capture archive in this directory;
+the directory hierarchy has the structure
+
+  ${OUTPUT_DIR}/${RUN}/NNNNNN.cas
+  ${OUTPUT_DIR}/${RUN}/NNNNNN.idx
+  ${OUTPUT_DIR}/${RUN}/progress.jnl
+
+where RUN starts at one and is incremented by one each time the
+program is invoked (except with --resume), and NNNNNN numbers the
+archive segments.  Each .cas file holds many results, and the matching
+.idx file lists the serial number, locale, offset, length, and URL of
+each of them.  The serial number assigned to each URL is not
+meaningful.  progress.jnl records which captures are complete, so that
+an interrupted run can be continued with --resume; see
+shared/capture_journal.py.
+
+The output files are binary; see shared/capture_archive.py for the
+archive format, and CaptureResult.encode for the format of each result.
+
+While the program runs, it keeps counters and latency histograms for
+proxies, captures, and result writing; --metrics-port and
+--metrics-file make these available for graphing.  See
+shared/metrics.py.
 
 """
 
@@ -68,6 +80,32 @@ def setup_argp(ap):
     ap.add_argument("-p", "--max-simultaneous-proxies",
                     action="store", type=int, default=10,
                     help="Maximum number of proxies to use simultaneously.")
+    ap.add_argument("-r", "--restart-every",
+                    action="store", type=int, default=50,
+                    help="Restart each Firefox process after this many "
+                    "visits.  Between restarts, cookies and storage are "
+                    "cleared before each visit.")
+    ap.add_argument("-m", "--browser-max-rss",
+                    action="store", type=lambda s: int(s) * 1024 * 1024,
+                    default=2048 * 1024 * 1024, metavar="MB",
+                    help="Restart a Firefox process whose memory usage "
+                    "grows beyond this many megabytes.")
+    ap.add_argument("-t", "--visit-timeout",
+                    action="store", type=float, default=300,
+                    help="Give up on a page after this many seconds, "
+                    "and restart the browser.")
+    ap.add_argument("-R", "--resume", action="store_true",
+                    help="Resume the most recent run in OUTPUT_DIR, "
+                    "skipping URLs it has already captured, instead of "
+                    "starting a new run.")
+    ap.add_argument("--metrics-port",
+                    action="store", type=int, metavar="PORT",
+                    help="Serve operational metrics, in the Prometheus "
+                    "text format, on http://127.0.0.1:PORT/metrics.")
+    ap.add_argument("--metrics-file",
+                    action="store", metavar="FILE",
+                    help="Write a JSON snapshot of operational metrics "
+                    "to FILE every 15 seconds.")
     ap.add_argument("-q", "--quiet", action="store_true",
                     help="Don't print progress messages.")
 
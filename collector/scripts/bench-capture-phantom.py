@@ -0,0 +1,118 @@
+#! /usr/bin/python3
+
+"""Measure PhantomJS capture throughput, starting a new process for
+every URL (do_capture) and with persistent worker processes
+(PhantomWorker).
+
+Usage: bench-capture-phantom.py [NURLS [WORKERS [CAPTURES_PER_WORKER ...]]]
+
+A local HTTP server on 127.0.0.1 serves NURLS small static pages, so
+that the measurement is dominated by the capture machinery rather than
+by the network.  WORKERS captures run concurrently, as they would in
+one locale of s_capture_phantom.  'isolate' and 'phantomjs' must be on
+the PATH.  Each persistent-worker run is labeled with the number of
+captures after which a worker process is replaced.
+"""
+
+import asyncio
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../lib"))
+from url_sources.capture_phantom import do_capture, PhantomWorker
+
+class LocalProxy:
+    """Just enough of a ProxySet proxy for do_capture and PhantomWorker."""
+    def adjust_command(self, cmd):
+        return cmd
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def generate(docroot, nurls):
+    for i in range(nurls):
+        with open(os.path.join(docroot, "{}.html".format(i)), "w") as f:
+            f.write("<!doctype html><html><head><title>page {0}</title>"
+                    "</head><body><h1>page {0}</h1>".format(i) +
+                    "<p>Lorem ipsum dolor sit amet.</p>" * 50 +
+                    "</body></html>")
+
+def serve(docroot):
+    # SimpleHTTPRequestHandler serves the current directory.
+    os.chdir(docroot)
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}/".format(httpd.server_address[1])
+
+@asyncio.coroutine
+def run_oneshot(urls, nworkers, loop):
+    results = []
+    @asyncio.coroutine
+    def worker():
+        while urls:
+            url = urls.pop()
+            results.append((yield from do_capture(url, LocalProxy(), loop)))
+    yield from asyncio.wait([worker() for _ in range(nworkers)], loop=loop)
+    return results
+
+@asyncio.coroutine
+def run_persistent(urls, nworkers, captures, loop):
+    results = []
+    phantoms = []
+    @asyncio.coroutine
+    def worker():
+        phantom = PhantomWorker(LocalProxy(), loop, max_captures=captures)
+        phantoms.append(phantom)
+        try:
+            while urls:
+                url = urls.pop()
+                results.append((yield from phantom.capture(url)))
+        finally:
+            yield from phantom.stop()
+    yield from asyncio.wait([worker() for _ in range(nworkers)], loop=loop)
+    return results, sum(p.n_processes for p in phantoms)
+
+def main():
+    nurls    = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nworkers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    captures = [int(a) for a in sys.argv[3:]] or [10, 100]
+
+    loop = asyncio.get_event_loop()
+    asyncio.get_child_watcher()
+
+    with tempfile.TemporaryDirectory() as docroot:
+        generate(docroot, nurls)
+        base = serve(docroot)
+        urls = [base + "{}.html".format(i) for i in range(nurls)]
+
+        sys.stdout.write("{:>10}  {:>9}  {:>8}  {:>12}  {:>6}\n"
+                         .format("mode", "processes", "seconds",
+                                 "captures/sec", "ok"))
+
+        start = time.monotonic()
+        results = loop.run_until_complete(
+            run_oneshot(list(urls), nworkers, loop))
+        elapsed = time.monotonic() - start
+        sys.stdout.write("{:>10}  {:>9}  {:>8.2f}  {:>12.2f}  {:>6}\n"
+                         .format("one-shot", nurls, elapsed,
+                                 nurls / elapsed,
+                                 sum(r.status == "ok" for r in results)))
+
+        for n in captures:
+            start = time.monotonic()
+            results, nproc = loop.run_until_complete(
+                run_persistent(list(urls), nworkers, n, loop))
+            elapsed = time.monotonic() - start
+            sys.stdout.write("{:>10}  {:>9}  {:>8.2f}  {:>12.2f}  {:>6}\n"
+                             .format("reuse " + str(n), nproc, elapsed,
+                                     nurls / elapsed,
+                                     sum(r.status == "ok" for r in results)))
+    loop.close()
+
+main()
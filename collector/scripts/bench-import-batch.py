@@ -0,0 +1,75 @@
+#! /usr/bin/python3
+
+"""Measure import-batch.py throughput as a function of batch size.
+
+Usage: bench-import-batch.py DBNAME [NFILES [BATCH_SIZE ...]]
+
+DBNAME must be a scratch database with the collection schema loaded
+(collector_schema_v2.sql and collector_populate_metadata.sql); the
+benchmark adds rows to it.  For each batch size (0 meaning the
+one-capture-at-a-time path) a fresh set of NFILES synthetic capture
+files is generated, so that no run is helped by an earlier run's rows,
+and imported.  A quarter of the pages share their HTML with some other
+page, which is roughly the duplication seen in real runs.
+"""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import_batch = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "import-batch.py")
+
+def write_capture(fname, url, html, mtime):
+    chtml = zlib.compress(html.encode("utf-8"))
+    clog  = zlib.compress(json.dumps({"events": [], "chain": [url],
+                                      "redirs": None}).encode("utf-8"))
+    with open(fname, "xb") as fp:
+        fp.write("\u007Fcap 00\n{url}\n{url}\n200\n200\n1.000000\n{} {}\n"
+                 .format(len(chtml), len(clog), url=url).encode("utf-8"))
+        fp.write(chtml)
+        fp.write(clog)
+    os.utime(fname, (mtime, mtime))
+
+def generate(topdir, tag, nfiles):
+    rng = random.Random(tag)
+    mtime = time.time()
+    for serial in range(nfiles):
+        d = os.path.join(topdir, "{:03d}".format(serial // 1000))
+        os.makedirs(d, exist_ok=True)
+        url = "http://bench-{}.example/{}".format(tag, serial)
+        if serial > 0 and rng.random() < 0.25:
+            body = rng.randrange(serial)
+        else:
+            body = serial
+        html = ("<html><body>" +
+                "<p>page {} of run {}</p>".format(body, tag) * 200 +
+                "</body></html>")
+        write_capture(os.path.join(d, "{:03d}.us".format(serial % 1000)),
+                      url, html, mtime)
+
+def main():
+    dbname = sys.argv[1]
+    nfiles = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    sizes  = [int(a) for a in sys.argv[3:]] or [0, 10, 100, 1000]
+
+    tag = "{:x}".format(int(time.time()))
+    sys.stdout.write("{:>10}  {:>8}  {:>10}\n"
+                     .format("batch", "seconds", "files/sec"))
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as topdir:
+            generate(topdir, "{}-{}".format(tag, size), nfiles)
+            start = time.monotonic()
+            subprocess.check_call([sys.executable, import_batch,
+                                   "-b", str(size), dbname, topdir],
+                                  stderr=subprocess.DEVNULL)
+            elapsed = time.monotonic() - start
+        sys.stdout.write("{:>10}  {:>8.2f}  {:>10.1f}\n"
+                         .format(size, elapsed, nfiles / elapsed))
+
+main()
@@ -1,25 +1,31 @@
 #! /usr/bin/python3
 
+import os
 import sys
 import pprint
 import json
+import mmap
 import zlib
 
-def dump_one(fname):
-    with open(fname, "rb") as f:
-        magic = f.read(8)
-        if magic != b'\x7fcap 00\n':
-            sys.stdout.write("{}: not a capture file\n\n".format(fname))
-            return
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../lib"))
+# See collector/lib/shared/capture_archive.py for the archive format.
+from shared.capture_archive import SEGMENT_MAGIC, FRAME
 
-        data = memoryview(f.read())
+def dump_record(label, data):
+    magic = data[:8].tobytes()
+    if magic not in (b'\x7fcap 00\n', b'\x7fcap 01\n'):
+        sys.stdout.write("{}: not a capture file\n\n".format(label))
+        return
 
-    b1 = data.obj.find(b'\n')
-    b2 = data.obj.find(b'\n', b1+1)
-    b3 = data.obj.find(b'\n', b2+1)
-    b4 = data.obj.find(b'\n', b3+1)
-    b5 = data.obj.find(b'\n', b4+1)
-    b6 = data.obj.find(b'\n', b5+1)
+    data = data[8:]
+    raw  = data.tobytes()
+    b1 = raw.find(b'\n')
+    b2 = raw.find(b'\n', b1+1)
+    b3 = raw.find(b'\n', b2+1)
+    b4 = raw.find(b'\n', b3+1)
+    b5 = raw.find(b'\n', b4+1)
+    b6 = raw.find(b'\n', b5+1)
 
     url  = data[     : b1].tobytes().decode("utf-8")
     rurl = data[b1+1 : b2].tobytes().decode("utf-8")
@@ -39,21 +45,68 @@ def dump_one(fname):
                      "  CLEN  {}\n"
                      "  LLEN  {}\n"
                      "  -- HTML --\n"
-                     .format(fname, url, rurl, stat, dtyl, elap, clen, llen))
+                     .format(label, url, rurl, stat, dtyl, elap, clen, llen))
 
     cbeg = b6 + 1
     cend = cbeg + clen
     lbeg = cend
     lend = lbeg + llen
     assert lend == len(data)
-    sys.stdout.write(zlib.decompress(data[cbeg:cend]).decode("utf-8"))
+    if clen:
+        sys.stdout.write(zlib.decompress(data[cbeg:cend]).decode("utf-8"))
     sys.stdout.write("\n  -- LOG --\n")
-    pprint.pprint(json.loads(zlib.decompress(data[lbeg:lend]).decode("utf-8")))
+    if llen:
+        pprint.pprint(json.loads(zlib.decompress(data[lbeg:lend])
+                                 .decode("utf-8")))
     sys.stdout.write("\n")
 
+def dump_segment(fname, data):
+    offset = len(SEGMENT_MAGIC)
+    while offset < len(data):
+        if offset + FRAME.size > len(data):
+            sys.stdout.write("{}@{}: truncated frame header\n\n"
+                             .format(fname, offset))
+            return
+        length, crc, atime, serial, loclen = FRAME.unpack_from(data, offset)
+        lbeg = offset + FRAME.size
+        pbeg = lbeg + loclen
+        pend = pbeg + length
+        if pend > len(data):
+            sys.stdout.write("{}@{}: truncated record\n\n"
+                             .format(fname, offset))
+            return
+
+        check = zlib.crc32(data[offset:offset+4])
+        check = zlib.crc32(data[offset+8:pend], check)
+        locale = data[lbeg:pbeg].tobytes().decode("ascii")
+        label = "{}@{} [{} {}]".format(fname, offset, serial, locale)
+        if check != crc:
+            sys.stdout.write("{}: checksum mismatch\n\n".format(label))
+        else:
+            dump_record(label, data[pbeg:pend])
+        offset = pend
+
+def dump_one(fname):
+    with open(fname, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            sys.stdout.write("{}: not a capture file\n\n".format(fname))
+            return
+
+    data = memoryview(m)
+    try:
+        if data[:8].tobytes() == SEGMENT_MAGIC:
+            dump_segment(fname, data)
+        else:
+            dump_record(fname, data)
+    finally:
+        data.release()
+        m.close()
+
 def main():
     for arg in sys.argv[1:]:
         dump_one(arg)
 
 main()
-
@@ -1,8 +1,12 @@
 #! /usr/bin/python3
 
+import argparse
 import collections
+import concurrent.futures
 import datetime
 import hashlib
+import io
+import mmap
 import os
 import psycopg2
 import re
@@ -11,6 +15,14 @@ import time
 import urllib.parse
 import zlib
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../lib"))
+# Capture archive segments; see collector/lib/shared/capture_archive.py
+# for the format.
+from shared.capture_archive import (SEGMENT_MAGIC, FRAME,
+                                    read_index, index_end)
+from shared.capture_journal import JOURNAL_NAME
+
 zlib_nothing = zlib.compress(b'')
 
 class savepoint:
@@ -178,14 +190,15 @@ def add_capture_result(cur, result, detail):
 
         return fid
 
-def add_capture_log_old(cur, log):
+def add_capture_log_old(cur, log, h=None):
     # Wrap the operation below in a savepoint, so that if it aborts any
     # outer transaction is not ruined.
     with savepoint(cur, "capture_log_old_insertion"):
         # This definitely should not be done in one query, because we can
         # avoid pushing the actual data over the connection if it's a dupe.
 
-        h = hashlib.sha256(log).digest()
+        if h is None:
+            h = hashlib.sha256(log).digest()
         cur.execute("SELECT id FROM capture_logs_old WHERE hash = %s", (h,))
         row = cur.fetchone()
         if row is not None:
@@ -196,14 +209,15 @@ def add_capture_log_old(cur, log):
                         "  RETURNING id", (h, log))
             return cur.fetchone()[0]
 
-def add_capture_html_content(cur, content):
+def add_capture_html_content(cur, content, h=None):
     # Wrap the operation below in a savepoint, so that if it aborts any
     # outer transaction is not ruined.
     with savepoint(cur, "capture_html_content_insertion"):
         # This definitely should not be done in one query, because we can
         # avoid pushing the actual data over the connection if it's a dupe.
 
-        h = hashlib.sha256(content).digest()
+        if h is None:
+            h = hashlib.sha256(content).digest()
         cur.execute("SELECT id FROM capture_html_content WHERE hash = %s",
                     (h,))
         row = cur.fetchone()
@@ -219,27 +233,28 @@ def add_capture_html_content(cur, content):
 CaptureResult = collections.namedtuple("CaptureResult", (
     "country", "vantage", "access_time", "elapsed",
     "orig_url", "redir_url", "status", "detail",
-    "html_content", "capture_log_old"
+    "html_content", "capture_log_old",
+    "html_hash", "log_hash"
 ))
 
-def load_result_file(fname):
-    _, _, loc = fname.partition('.')
-    cc2, _, vantage = loc.partition('_')
-
-    with open(fname, "rb") as fp:
-        magic = fp.read(8)
-        if magic != b"\x7fcap 00\n":
-            raise RuntimeError(fname + ": not a capture file")
-
-        data = memoryview(fp.read())
-        atim = os.stat(fp.fileno()).st_mtime
-
-    b1 = data.obj.find(b'\n')
-    b2 = data.obj.find(b'\n', b1+1)
-    b3 = data.obj.find(b'\n', b2+1)
-    b4 = data.obj.find(b'\n', b3+1)
-    b5 = data.obj.find(b'\n', b4+1)
-    b6 = data.obj.find(b'\n', b5+1)
+def parse_result(label, data, cc2, vantage, atim):
+    """Parse one capture file, already loaded into the memoryview DATA
+       (magic number included)."""
+    if data[:8].tobytes() != b"\x7fcap 00\n":
+        raise RuntimeError(label + ": not a capture file")
+    data = data[8:]
+
+    # The header is all on the first six lines, so there is no need
+    # to copy the compressed data in order to find its end.
+    head = data[:min(len(data), 65536)].tobytes()
+    b1 = head.find(b'\n')
+    b2 = head.find(b'\n', b1+1)
+    b3 = head.find(b'\n', b2+1)
+    b4 = head.find(b'\n', b3+1)
+    b5 = head.find(b'\n', b4+1)
+    b6 = head.find(b'\n', b5+1)
+    if b6 == -1:
+        raise RuntimeError(label + ": ill-formed capture file (header)")
 
     ourl = data[     : b1].tobytes().decode("utf-8")
     rurl = data[b1+1 : b2].tobytes().decode("utf-8")
@@ -260,7 +275,7 @@ def load_result_file(fname):
     lend = lbeg + llen
 
     if lend != len(data):
-        raise RuntimeError(fname + ": ill-formed capture file (lend != eof)")
+        raise RuntimeError(label + ": ill-formed capture file (lend != eof)")
 
     hcon = data[cbeg:cend].tobytes()
     clog = data[lbeg:lend].tobytes()
@@ -274,14 +289,215 @@ def load_result_file(fname):
 
     return CaptureResult(cc2, vantage, atim, elap,
                          ourl, rurl, stat, dtyl,
-                         hcon, clog)
+                         hcon, clog,
+                         hashlib.sha256(hcon).digest(),
+                         hashlib.sha256(clog).digest())
+
+def load_result_file(fname):
+    _, _, loc = fname.partition('.')
+    cc2, _, vantage = loc.partition('_')
+
+    with open(fname, "rb") as fp:
+        data = memoryview(fp.read())
+        atim = os.stat(fp.fileno()).st_mtime
+
+    return parse_result(fname, data, cc2, vantage, atim)
+
+
+def load_segment_record(fname, m, offset):
+    """Decode the record at OFFSET in the mapped segment M.  Returns
+       (label, result-or-exception, offset of the next record); the
+       last is None if the record is truncated."""
+    label = "{}@{}".format(fname, offset)
+    if offset + FRAME.size > len(m):
+        return label, RuntimeError("truncated record"), None
+
+    length, crc, atim, serial, loclen = FRAME.unpack_from(m, offset)
+    lbeg = offset + FRAME.size
+    pbeg = lbeg + loclen
+    pend = pbeg + length
+    if pend > len(m):
+        return label, RuntimeError("truncated record"), None
+
+    data = memoryview(m)
+    try:
+        check = zlib.crc32(data[offset:offset+4])
+        check = zlib.crc32(data[offset+8:pend], check)
+        if check != crc:
+            raise RuntimeError(label + ": checksum mismatch")
+
+        loc = data[lbeg:pbeg].tobytes().decode("ascii")
+        cc2, _, vantage = loc.partition('_')
+        return label, parse_result(label, data[pbeg:pend],
+                                   cc2, vantage, atim), pend
+    except Exception as e:
+        # The traceback would keep views of the map alive.
+        return label, e.with_traceback(None), pend
+    finally:
+        data.release()
+
+def load_segment(fname, offsets=None):
+    """Generate (label, result-or-exception) pairs for the records of
+       the capture archive segment FNAME: all of them, or just those
+       at OFFSETS (taken from the index) if that is not None."""
+    with open(fname, "rb") as fp:
+        m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with m:
+        if m[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+            raise RuntimeError(fname + ": not a capture archive segment")
+
+        if offsets is not None:
+            for offset in offsets:
+                label, result, _ = load_segment_record(fname, m, offset)
+                yield label, result
+            return
+
+        offset = len(SEGMENT_MAGIC)
+        while offset < len(m):
+            label, result, offset = load_segment_record(fname, m, offset)
+            yield label, result
+            if offset is None:
+                break
+
+def load_results(pname, offsets=None):
+    """Generate (label, result-or-exception) pairs for everything in
+       PNAME, which may be a single capture file or an archive segment."""
+    if pname.endswith(".cas"):
+        try:
+            yield from load_segment(pname, offsets)
+        except Exception as e:
+            yield pname, e
+    else:
+        try:
+            yield pname, load_result_file(pname)
+        except Exception as e:
+            yield pname, e
+
+# Decoding, validation, and hashing are done in a pool of worker
+# processes.  The main process enumerates the input, hands out tasks,
+# and is the only one that talks to the database.
+
+# Archive segments are split into tasks of this many records.
+RECORDS_PER_TASK = 256
+
+ImportTask = collections.namedtuple("ImportTask", (
+    "subdir", "pname", "offsets", "last"
+))
+
+def enumerate_tasks(dirs):
+    """Generate an ImportTask for each capture file, or chunk of an
+       archive segment, under DIRS.  Directories are read one at a
+       time as the generator is consumed, so work can begin at once
+       on arbitrarily large trees."""
+    for top in dirs:
+        pending = [top]
+        while pending:
+            subdir = pending.pop()
+            files = []
+            subdirs = []
+            with os.scandir(subdir) as it:
+                for ent in it:
+                    if ent.is_dir(follow_symlinks=False):
+                        subdirs.append(ent.path)
+                    elif not (ent.name == JOURNAL_NAME or
+                              ent.name.endswith((".idx", ".tmp"))):
+                        # Indexes, a resumable run's journal, and
+                        # half-written files are not captures.
+                        files.append(ent.path)
+
+            # Visit subdirectories in sorted order.
+            pending.extend(sorted(subdirs, reverse=True))
+            for pname in sorted(files):
+                yield from split_task(subdir, pname)
+
+def segment_offsets(pname, start=0):
+    """Walk the frame headers of the capture archive segment PNAME,
+       starting at START (zero for the beginning), and generate the
+       offset of each record.  Only the headers are read; checksums
+       and payloads are left to the decoders.  A truncated record at
+       the end is included, so that its decoder will report it."""
+    with open(pname, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size <= max(start, len(SEGMENT_MAGIC)):
+            return
+        m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with m:
+        offset = max(start, len(SEGMENT_MAGIC))
+        while offset < len(m):
+            yield offset
+            if offset + FRAME.size > len(m):
+                return
+            length, _, _, _, loclen = FRAME.unpack_from(m, offset)
+            offset += FRAME.size + loclen + length
+
+def split_task(subdir, pname):
+    """Generate ImportTasks for PNAME.  Archive segments are split into
+       tasks of RECORDS_PER_TASK records.  The offsets come from the
+       index, if there is one, and then from walking the segment after
+       the last indexed record, since the index may lag the segment if
+       the writer was interrupted."""
+    if not pname.endswith(".cas"):
+        yield ImportTask(subdir, pname, None, True)
+        return
+
+    with open(pname, "rb") as fp:
+        if fp.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            # Let the decoder report the problem.
+            yield ImportTask(subdir, pname, None, True)
+            return
+
+    def all_offsets():
+        end = 0
+        index = os.path.splitext(pname)[0] + ".idx"
+        if os.path.exists(index):
+            for entry in read_index(index):
+                yield entry.offset
+                end = index_end(entry)
+        yield from segment_offsets(pname, end)
+
+    offsets = []
+    for offset in all_offsets():
+        offsets.append(offset)
+        if len(offsets) == RECORDS_PER_TASK:
+            yield ImportTask(subdir, pname, offsets, False)
+            offsets = []
+    yield ImportTask(subdir, pname, offsets, True)
+
+def decode_task(task):
+    """Worker-process side: fully decode TASK."""
+    return list(load_results(task.pname, task.offsets))
+
+def decode_all(tasks, jobs):
+    """Generate (task, decoded) pairs for every task in TASKS, in order,
+       using JOBS worker processes.  At most a few tasks per worker are
+       in flight at once, so a slow database writer holds back the
+       enumeration and the decoders rather than letting decoded
+       captures pile up in memory."""
+    if jobs <= 1:
+        for task in tasks:
+            yield task, decode_task(task)
+        return
+
+    window = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        for task in tasks:
+            window.append((task, pool.submit(decode_task, task)))
+            if len(window) >= 4 * jobs:
+                t, f = window.popleft()
+                yield t, f.result()
+        while window:
+            t, f = window.popleft()
+            yield t, f.result()
 
 def record_result(cur, result):
     (ouid, _) = add_url_string(cur, result.orig_url)
     (ruid, _) = add_url_string(cur, result.redir_url)
     fid       = add_capture_result(cur, result.status, result.detail)
-    cid       = add_capture_html_content(cur, result.html_content)
-    lid       = add_capture_log_old(cur, result.capture_log_old)
+    cid       = add_capture_html_content(cur, result.html_content,
+                                         result.html_hash)
+    lid       = add_capture_log_old(cur, result.capture_log_old,
+                                    result.log_hash)
 
 
 
@@ -308,67 +524,386 @@ def record_result(cur, result):
                     result.elapsed,
                     fid, ruid, lid, cid))
 
+class RecordWriter:
+    """Records captures one at a time, committing whenever flushed
+       (which the Cruncher does at the end of each directory)."""
+    def __init__(self, db):
+        self.db    = db
+        self.nrecs = 0
+        self.cur   = db.cursor()
+        self.cur.execute("SET search_path TO collection, public")
+
+    def add(self, label, result):
+        try:
+            record_result(self.cur, result)
+            self.nrecs += 1
+        except Exception as e:
+            sys.stderr.write("{}: {}\n".format(label, e))
+
+    def end_directory(self):
+        self.db.commit()
+
+    def flush(self):
+        self.db.commit()
+
+# Bulk import.  Instead of a dozen round trips per capture, decoded
+# captures are staged in batches; URLs, result codes, and blob hashes
+# are resolved against bounded in-memory caches, and then against the
+# database with one query per table per batch; whatever is new is
+# loaded with COPY into temporary staging tables; and then each table
+# is merged with one INSERT ... SELECT.
+
+_copy_escapes = str.maketrans({ "\\": "\\\\", "\t": "\\t",
+                                "\n": "\\n",  "\r": "\\r" })
+def copy_text(s):
+    """Escape S for use as a field in COPY text format."""
+    return s.translate(_copy_escapes)
+
+def copy_bytea(b):
+    """Format B as a bytea field in COPY text format."""
+    return "\\\\x" + b.hex()
+
+def copy_rows(cur, table, columns, rows):
+    """Load ROWS, which are sequences of already-escaped fields,
+       into TABLE with COPY."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(row))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_from(buf, table, columns=columns)
+
+class IdCache:
+    """Bounded, least-recently-used mapping from keys (URLs or blob
+       hashes) to database ids."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.ids   = collections.OrderedDict()
+
+    def get(self, key):
+        id = self.ids.get(key)
+        if id is not None:
+            self.ids.move_to_end(key)
+        return id
+
+    def update(self, new):
+        for key, id in new.items():
+            self.ids[key] = id
+            self.ids.move_to_end(key)
+        while len(self.ids) > self.limit:
+            self.ids.popitem(last=False)
+
+class BulkLoader:
+    # Each of the URL, HTML and log caches holds at most this many ids.
+    # Anything not in them is looked up in the database, once per batch.
+    CACHE_LIMIT = 1000000
+
+    def __init__(self, db, batch_size, progress):
+        self.db         = db
+        self.batch_size = batch_size
+        self.progress   = progress
+        self.pending    = []
+        self.nrecs      = 0
+        self.cur        = db.cursor()
+
+        self.cur.execute("SET search_path TO collection, public")
+        with self.db:
+            self.cur.execute(
+                "CREATE TEMP TABLE import_stage_urls (url TEXT)")
+            self.cur.execute(
+                "CREATE TEMP TABLE import_stage_html"
+                " (hash BYTEA, content BYTEA)")
+            self.cur.execute(
+                "CREATE TEMP TABLE import_stage_logs"
+                " (hash BYTEA, log BYTEA)")
+            self.cur.execute(
+                "CREATE TEMP TABLE import_stage_pages"
+                " (url INTEGER, country TEXT, vantage TEXT,"
+                "  access_time DOUBLE PRECISION, elapsed_time REAL,"
+                "  result INTEGER, redir_url INTEGER,"
+                "  capture_log_old INTEGER, html_content INTEGER)")
+
+        self.url_ids  = IdCache(self.CACHE_LIMIT)
+        self.html_ids = IdCache(self.CACHE_LIMIT)
+        self.log_ids  = IdCache(self.CACHE_LIMIT)
+
+        # There are only a few hundred distinct fine results, so they
+        # are all loaded up front, along with their coarse results so
+        # that consistency can be checked as record_result does.
+        with self.db:
+            self.cur.execute("SELECT f.detail, f.id, c.result"
+                             "  FROM capture_fine_result f"
+                             "  JOIN capture_coarse_result c"
+                             "    ON f.result = c.id")
+            self.result_ids = { detail: (fid, result)
+                                for detail, fid, result in self.cur }
+
+    def end_directory(self):
+        pass
+
+    def add(self, label, result):
+        self.pending.append((label, result))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch = self.pending
+        self.pending = []
+        if not batch:
+            return
+
+        try:
+            with self.db:
+                updates, nstaged = self.merge(batch)
+        except Exception as e:
+            # Something in this batch is unacceptable to the database.
+            # Fall back to the slow path, which will isolate the problem.
+            self.progress("bulk merge failed ({}); retrying one by one"
+                          .format(e))
+            with self.db:
+                for label, result in batch:
+                    try:
+                        record_result(self.cur, result)
+                        self.nrecs += 1
+                    except Exception as e:
+                        sys.stderr.write("{}: {}\n".format(label, e))
+            return
+
+        # Only now that the transaction has committed is it safe
+        # to remember the new ids.
+        self.nrecs += nstaged
+        urls, html, logs, fids = updates
+        self.url_ids.update(urls)
+        self.html_ids.update(html)
+        self.log_ids.update(logs)
+        self.result_ids.update(fids)
+
+    def known_ids(self, cache, table, column, keys):
+        """Return a dictionary key -> id for each of KEYS that is
+           already in TABLE, consulting CACHE first."""
+        found = {}
+        missing = []
+        for key in keys:
+            id = cache.get(key)
+            if id is None:
+                missing.append(key)
+            else:
+                found[key] = id
+        if missing:
+            if column == "hash":
+                missing = [psycopg2.Binary(k) for k in missing]
+            self.cur.execute('SELECT "{c}", id FROM "{t}"'
+                             ' WHERE "{c}" = ANY(%s)'
+                             .format(t=table, c=column), (missing,))
+            for k, id in self.cur:
+                if isinstance(k, memoryview):
+                    k = k.tobytes()
+                found[k] = id
+        return found
+
+    def merge(self, batch):
+        cur      = self.cur
+        new_fids = {}
+        staged   = []
+        urls     = set()
+        html     = {}
+        logs     = {}
+
+        # Pass 1: canonicalize, check, and collect everything the
+        # batch refers to.
+        for label, result in batch:
+            try:
+                ourl = canon_url_syntax(result.orig_url)
+                rurl = canon_url_syntax(result.redir_url)
+
+                known = (self.result_ids.get(result.detail) or
+                         new_fids.get(result.detail))
+                if known is None:
+                    fid = add_capture_result(cur, result.status,
+                                             result.detail)
+                    new_fids[result.detail] = (fid, result.status)
+                elif known[1] != result.status:
+                    raise RuntimeError("{!r}: coarse result {!r} inconsistent "
+                                       "with prior coarse result {!r}"
+                                       .format(result.detail, result.status,
+                                               known[1]))
+            except Exception as e:
+                sys.stderr.write("{}: {}\n".format(label, e))
+                continue
+
+            urls.add(ourl)
+            urls.add(rurl)
+            html[result.html_hash] = result.html_content
+            logs[result.log_hash]  = result.capture_log_old
+            staged.append((result, ourl, rurl))
+
+        # Pass 2: look up what is already in the database, and stage
+        # and merge the rest.
+        url_ids = self.known_ids(self.url_ids, "url_strings", "url", urls)
+        new_urls = [u for u in urls if u not in url_ids]
+        if new_urls:
+            copy_rows(cur, "import_stage_urls", ("url",),
+                      ((copy_text(u),) for u in new_urls))
+            cur.execute("INSERT INTO url_strings (url)"
+                        " SELECT DISTINCT s.url FROM import_stage_urls s"
+                        "  WHERE NOT EXISTS (SELECT 1 FROM url_strings u"
+                        "                     WHERE u.url = s.url)")
+            cur.execute("SELECT u.url, u.id FROM url_strings u"
+                        "  JOIN import_stage_urls s ON u.url = s.url")
+            url_ids.update(cur.fetchall())
+            cur.execute("TRUNCATE import_stage_urls")
+
+        html_ids = self.known_ids(self.html_ids, "capture_html_content",
+                                  "hash", html)
+        html_ids.update(self.merge_blobs(
+            "capture_html_content", "content", "import_stage_html",
+            { h: b for h, b in html.items() if h not in html_ids }))
+        log_ids = self.known_ids(self.log_ids, "capture_logs_old",
+                                 "hash", logs)
+        log_ids.update(self.merge_blobs(
+            "capture_logs_old", "log", "import_stage_logs",
+            { h: b for h, b in logs.items() if h not in log_ids }))
+
+        # Pass 3: stage and merge the captured_pages rows themselves.
+        rows = []
+        for result, ourl, rurl in staged:
+            fid = (self.result_ids.get(result.detail) or
+                   new_fids[result.detail])[0]
+            rows.append((
+                str(url_ids[ourl]),
+                copy_text(result.country),
+                copy_text(result.vantage),
+                repr(result.access_time),
+                repr(result.elapsed),
+                str(fid),
+                str(url_ids[rurl]),
+                str(log_ids[result.log_hash]),
+                str(html_ids[result.html_hash])
+            ))
+        copy_rows(cur, "import_stage_pages",
+                  ("url", "country", "vantage", "access_time",
+                   "elapsed_time", "result", "redir_url",
+                   "capture_log_old", "html_content"),
+                  rows)
+        cur.execute(
+            "INSERT INTO captured_pages"
+            "  (url, country, vantage, access_time, elapsed_time,"
+            "   result, redir_url, capture_log, capture_log_old,"
+            "   html_content)"
+            " SELECT DISTINCT ON (s.url, s.country, s.vantage, s.access_time)"
+            "        s.url, s.country, s.vantage, s.access_time,"
+            "        s.elapsed_time, s.result, s.redir_url, NULL,"
+            "        s.capture_log_old, s.html_content"
+            "   FROM (SELECT url, country, vantage,"
+            "                TIMESTAMP WITHOUT TIME ZONE 'epoch' +"
+            "                    access_time * INTERVAL '1 second'"
+            "                    AS access_time,"
+            "                elapsed_time, result, redir_url,"
+            "                capture_log_old, html_content"
+            "           FROM import_stage_pages) s"
+            "  WHERE NOT EXISTS ("
+            "    SELECT 1 FROM captured_pages p"
+            "     WHERE p.url = s.url AND p.country = s.country"
+            "       AND p.vantage = s.vantage"
+            "       AND p.access_time = s.access_time)")
+        cur.execute("TRUNCATE import_stage_pages")
+
+        return (url_ids, html_ids, log_ids, new_fids), len(staged)
+
+    def merge_blobs(self, table, column, stage, blobs):
+        """Merge BLOBS, a dictionary hash -> data, into TABLE via STAGE.
+           Returns a dictionary hash -> id."""
+        if not blobs:
+            return {}
+        cur = self.cur
+        copy_rows(cur, stage, ("hash", column),
+                  ((copy_bytea(h), copy_bytea(b)) for h, b in blobs.items()))
+        cur.execute('INSERT INTO "{t}" (hash, "{c}")'
+                    ' SELECT s.hash, s."{c}" FROM "{s}" s'
+                    '  WHERE NOT EXISTS (SELECT 1 FROM "{t}" x'
+                    '                     WHERE x.hash = s.hash)'
+                    .format(t=table, c=column, s=stage))
+        cur.execute('SELECT x.hash, x.id FROM "{t}" x'
+                    '  JOIN "{s}" s ON x.hash = s.hash'
+                    .format(t=table, s=stage))
+        ids = { h.tobytes(): id for h, id in cur }
+        cur.execute('TRUNCATE "{}"'.format(stage))
+        return ids
+
 
 class Cruncher:
-    def __init__(self, dbname, dirs):
+    def __init__(self, dbname, dirs, batch_size=0, jobs=1):
         self.dbname = dbname
         self.dirs   = dirs
         self.db     = psycopg2.connect(dbname=dbname)
         self.start  = time.monotonic()
-        self.ndirs  = len(dirs)
-        self.nfiles = 0
         self.pdirs  = None
         self.pfiles = None
+        self.nrecs  = 0
+        self.batch_size = batch_size
+        self.jobs   = jobs
 
     def run(self):
-        self.count_files()
-        self.import_files()
-
-    def count_files(self):
-        self.progress("counting files to be imported:")
-        for d in self.dirs:
-            self.progress("  " + d)
-            for subdir, dirs, files in os.walk(d):
-                self.nfiles += len(files)
-
-        self.progress("total {} dirs {} files".format(self.ndirs, self.nfiles))
+        if self.batch_size > 0:
+            writer = BulkLoader(self.db, self.batch_size, self.progress)
+        else:
+            writer = RecordWriter(self.db)
 
-    def import_files(self):
-        self.progress("importing...")
+        self.progress("importing with {} decoders...".format(self.jobs))
         self.pdirs = 0
         self.pfiles = 0
-        cur = self.db.cursor()
-        cur.execute("SET search_path TO collection, public")
-        for d in self.dirs:
-            for subdir, dirs, files in os.walk(d):
-                if not files: continue
-                self.progress(subdir)
-                with self.db:
-                    for fname in files:
-                        pname = os.path.join(subdir, fname)
-                        try:
-                            record_result(cur, load_result_file(pname))
-                        except Exception as e:
-                            sys.stderr.write("{}: {}\n".format(pname, e))
-                        self.pfiles += 1
-            self.pdirs += 1
-        self.progress("done")
+        cursubdir = None
+        for task, decoded in decode_all(enumerate_tasks(self.dirs),
+                                        self.jobs):
+            if task.subdir != cursubdir:
+                writer.end_directory()
+                cursubdir = task.subdir
+                self.pdirs += 1
+                self.progress(cursubdir)
+
+            for label, result in decoded:
+                if isinstance(result, Exception):
+                    sys.stderr.write("{}: {}\n".format(label, result))
+                else:
+                    writer.add(label, result)
+            if task.last:
+                self.pfiles += 1
+
+        writer.flush()
+        self.nrecs = writer.nrecs
+        elapsed = time.monotonic() - self.start
+        self.progress("done: {} records in {:.3f}s, {:.1f} records/sec"
+                      .format(self.nrecs, elapsed,
+                              self.nrecs / elapsed if elapsed else 0))
 
     def progress(self, message):
         now = time.monotonic()
         delta = datetime.timedelta(seconds = now - self.start)
 
         if self.pdirs is not None:
-            sys.stderr.write("[{}] processed {}/{}d {}/{}f | {}\n"
-                             .format(delta, self.pdirs, self.ndirs,
-                                     self.pfiles, self.nfiles, message))
+            sys.stderr.write("[{}] processed {}d {}f | {}\n"
+                             .format(delta, self.pdirs, self.pfiles,
+                                     message))
         else:
             sys.stderr.write("[{}] {}\n".format(delta, message))
 
 
 def main():
-    dbname = sys.argv[1]
-    dirs   = sys.argv[2:]
-    Cruncher(dbname, dirs).run()
-
-main()
+    ap = argparse.ArgumentParser(
+        description="Import capture files and archives into the database.")
+    ap.add_argument("dbname", help="Database to import into.")
+    ap.add_argument("dirs", nargs="+",
+                    help="Directories to scan for captures.")
+    ap.add_argument("-b", "--batch-size", type=int, default=0,
+                    help="Import in batches of this many captures, using "
+                    "COPY and in-memory id caches.  The default, 0, imports "
+                    "each capture individually.")
+    ap.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                    help="Number of processes to use for decoding captures.")
+    args = ap.parse_args()
+    Cruncher(args.dbname, args.dirs, args.batch_size, args.jobs).run()
+
+# The guard is necessary for the decoder processes to start under
+# any multiprocessing start method other than fork.
+if __name__ == "__main__":
+    main()
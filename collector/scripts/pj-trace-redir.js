@@ -25,34 +25,62 @@
 // "content" the text content of the page, and "render" a base64-ed PNG of
 // the rendering of the page.  These properties will be absent for
 // unsuccessful canonicalizations.
+//
+// If invoked with --server, no URL is given on the command line.
+// Instead, once ready, the script writes
+//
+// { "ready": true, "pid": process ID }
+//
+// on stdout, and then reads capture jobs from stdin, one JSON object
+// per line: { "id": anything, "url": "URL to capture" }.  Each job is
+// answered with one line, the same dictionary as --capture would
+// produce, plus the job's "id".  Jobs are processed one at a time, in
+// order.  The script exits at end of input.
 
 function usage() {
     console.error(
-        'Usage: phantomjs pj-trace-redir.js [--capture|--render] URL');
+        'Usage: phantomjs pj-trace-redir.js [--capture|--render] URL\n' +
+        '       phantomjs pj-trace-redir.js --server');
     phantom.exit(1);
 }
 
 var system = require('system');
 if (system.args.length < 2 || system.args.length > 3)
     usage();
-var capture = (system.args[1] === "--capture" ||
+var server = (system.args[1] === "--server");
+var capture = (server ||
+               system.args[1] === "--capture" ||
                system.args[1] === "--render");
 var render = (system.args[1] === "--render");
-if (capture && system.args.length < 3)
+if (server ? system.args.length !== 2
+           : capture && system.args.length < 3)
     usage();
-var address = capture ? system.args[2] : system.args[1];
+var address = server ? null : capture ? system.args[2] : system.args[1];
 var WebPage = require('webpage');
 
 // Log events as Phantom passes them back up.  The report we want has
 // to be reconstructed from several of these once the task is  complete.
-var pending_resources = {};
-var resource_status = {};
-var event_log = [];
-var redirection_chain = [];
-var redirs = { http: 0, html: 0, js: 0 };
-var window_serial = 0;
+// All of this state is per job; see start_job.
+var pending_resources;
+var resource_status;
+var event_log;
+var redirection_chain;
+var redirs;
+var window_serial;
 var really_loaded_timeout = null;
-var navPending = false;
+var global_timeout = null;
+var navPending;
+
+// Every page belongs to a job, and events for pages that belong to
+// a finished job are ignored.
+var job_serial = 0;
+var job_id = null;
+var job_done = false;
+var job_pages = [];
+
+function stale(page) {
+    return page.job !== job_serial;
+}
 
 function redirection_chain_last() {
     if (redirection_chain.length > 0)
@@ -122,6 +150,9 @@ function inline_all_frames(page) {
 function report(page) {
     var i, final_url, status, output;
 
+    if (job_done)
+        return;
+
     for (i = redirection_chain.length - 1; i >= 0; i--) {
         final_url = redirection_chain[i];
         if (/^about:/.test(final_url))
@@ -147,20 +178,45 @@ function report(page) {
         if (render)
             output.render = page.renderBase64("PNG");
 
-        system.stdout.writeLine(JSON.stringify(output));
-        phantom.exit(0);
-        // phantom.exit does not exit immediately.
+        finish_job(output);
         return;
     }
 
-    system.stdout.writeLine(JSON.stringify({
+    finish_job({
         ourl: address,
         status: "abnormal failure",
         detail: null,
         redirs: redirs,
         log: event_log
-    }));
-    phantom.exit(0);
+    });
+}
+
+function finish_job(output) {
+    var i;
+    job_done = true;
+    if (job_id !== null)
+        output.id = job_id;
+    system.stdout.writeLine(JSON.stringify(output));
+
+    if (!server) {
+        phantom.exit(0);
+        // phantom.exit does not exit immediately.
+        return;
+    }
+
+    if (really_loaded_timeout !== null) {
+        clearTimeout(really_loaded_timeout);
+        really_loaded_timeout = null;
+    }
+    clearTimeout(global_timeout);
+    global_timeout = null;
+    for (i = 0; i < job_pages.length; i++)
+        job_pages[i].close();
+    job_pages = [];
+    phantom.clearCookies();
+
+    // Let the event loop unwind before blocking on stdin.
+    setTimeout(next_job, 0);
 }
 
 //
@@ -169,19 +225,24 @@ function report(page) {
 // to confuse the caller.
 //
 function p_onConsoleMessage(msg, lineNum, sourceId) {
+    if (stale(this)) return;
     log_event({e: "console", w: this.serial, u: this.url, d: msg});
 };
 function p_onError(msg, trace) {
+    if (stale(this)) return;
     log_event({e: "jserror", w: this.serial, u: this.url, d: msg});
 };
 function p_onAlert(msg) {
+    if (stale(this)) return;
     log_event({e: "alert",   w: this.serial, u: this.url, d: msg});
 };
 function p_onConfirm(msg) {
+    if (stale(this)) return true;
     log_event({e: "confirm", w: this.serial, u: this.url, d: msg});
     return true;
 };
 function p_onPrompt(msg) {
+    if (stale(this)) return "fuzzy wuzzy";
     log_event({e: "prompt",  w: this.serial, u: this.url, d: msg});
     return "fuzzy wuzzy";
 };
@@ -194,7 +255,7 @@ function p_onPrompt(msg) {
 //
 
 function p_onLoadFinished(status) {
-
+    if (stale(this)) return;
     var serial = this.serial;
     var url = this.url;
 
@@ -297,6 +358,7 @@ function p_onLoadFinished(status) {
 //
 
 function p_onNavigationRequested(url, type, willNavigate, main) {
+    if (stale(this)) return;
     log_event({e: "nav", w: this.serial, u: this.url,
                d: { dest: url,
                     main: main,
@@ -322,6 +384,7 @@ function p_onNavigationRequested(url, type, willNavigate, main) {
 // This function may not actually be necessary.
 function p_onLoadStarted () {
     var cleared;
+    if (stale(this)) return;
     if (really_loaded_timeout !== null && this.serial === 0) {
         clearTimeout(really_loaded_timeout);
         really_loaded_timeout = null;
@@ -357,6 +420,7 @@ function frobHeaders(headers) {
 }
 
 function p_onResourceRequested(requestData, networkRequest) {
+    if (stale(this)) return;
     pending_resources[requestData.id] = requestData.url;
     log_event({
         e: "request",
@@ -369,6 +433,7 @@ function p_onResourceRequested(requestData, networkRequest) {
 }
 
 function p_onResourceReceived(response) {
+    if (stale(this)) return;
     if (pending_resources[response.id]) {
         var origUrl = pending_resources[response.id];
         var status = {
@@ -407,6 +472,7 @@ function p_onResourceReceived(response) {
 };
 
 function p_onResourceTimeout(request) {
+    if (stale(this)) return;
     if (pending_resources[request.id]) {
         var origUrl = pending_resources[request.id];
         var status = {
@@ -432,6 +498,7 @@ function p_onResourceTimeout(request) {
 };
 
 function p_onResourceError(resourceError) {
+    if (stale(this)) return;
     if (pending_resources[resourceError.id]) {
         var origUrl = pending_resources[resourceError.id];
 
@@ -478,6 +545,8 @@ function p_onResourceError(resourceError) {
 var userAgent;
 function p_onPageCreated(page) {
     page.serial = window_serial++;
+    page.job = this.job;
+    job_pages.push(page);
 
     // A just-created page does not know its URL yet.
     log_event({e: "open", w: page.serial, u: null, d: { parent: this.serial }});
@@ -513,21 +582,20 @@ function p_onPageCreated(page) {
 }
 
 
-var page = WebPage.create();
-
 // Our modified user agent should not be _too_ much of a lie; in
 // particular if the PhantomJS embedded Webkit changes too much we
 // should change ours to match.  Unfortunately, neither of the
 // AppleWebKit/xxx.yy strings corresponding to PhantomJS's
 // *actual* WebKit are common in real browsers.
 
-if (/ AppleWebKit\/534\.34 /.test(page.settings.userAgent)) {
+var probe = WebPage.create();
+if (/ AppleWebKit\/534\.34 /.test(probe.settings.userAgent)) {
     // PhantomJS 1.9. Pretend to be Safari 5.1 on OSX.
     userAgent =
         'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7) ' +
         'AppleWebKit/534.34.4 ' +
         '(KHTML, like Gecko) Version/5.1 Safari/534.34.4';
-} else if (/ AppleWebKit\/538.1 /.test(page.settings.userAgent)) {
+} else if (/ AppleWebKit\/538.1 /.test(probe.settings.userAgent)) {
     // PhantomJS 2.0. Pretend to be Safari 6.0.5 on OSX.
     userAgent =
         'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_8_4) ' +
@@ -535,28 +603,74 @@ if (/ AppleWebKit\/534\.34 /.test(page.settings.userAgent)) {
         '(KHTML, like Gecko) Version/6.0.5 Safari/536.30.1';
 } else {
     console.error("Unexpected stock user agent: " +
-                  page.settings.userAgent);
+                  probe.settings.userAgent);
     phantom.exit(1);
 }
+probe.close();
+
+function start_job(url, id) {
+    pending_resources = {};
+    resource_status = {};
+    event_log = [];
+    redirection_chain = [];
+    redirs = { http: 0, html: 0, js: 0 };
+    window_serial = 0;
+    navPending = false;
+
+    job_serial += 1;
+    job_id = id;
+    job_done = false;
+    address = url;
+
+    var page = WebPage.create();
+    p_onPageCreated.bind({serial: -1, job: job_serial})(page);
+
+    // Global 9-minute timeout (just below isolate.c's 10-minute SIGKILL,
+    // and the capture_phantom.py watchdog when running as a server).
+    global_timeout = setTimeout(function () {
+        // If this fires in the middle of onLoadFinished's ten-second
+        // delay to give JS a chance to send us somewhere else, just cut
+        // that off early.  Otherwise, make note of it in the log and mark
+        // all outstanding resources as timed out.
+        if (really_loaded_timeout === null) {
+            var i;
+            for (i in pending_resources)
+                resource_status[pending_resources[i]] = { code: "timeout" };
+            log_event({ e: "global-timeout", w: null, u: null, d: null });
+        }
+        report(page);
+    }, 9 * 60 * 1000);
+
+    navPending = address;
+    page.open(address);
+}
 
-p_onPageCreated.bind({serial:-1})(page);
-
-// Global 9-minute timeout (just below isolate.c's 10-minute SIGKILL);
-setTimeout(function () {
-    // If this fires in the middle of onLoadFinished's ten-second
-    // delay to give JS a chance to send us somewhere else, just cut
-    // that off early.  Otherwise, make note of it in the log and mark
-    // all outstanding resources as timed out.
-    if (really_loaded_timeout === null) {
-        var i;
-        for (i in pending_resources)
-            resource_status[pending_resources[i]] = { code: "timeout" };
-        log_event({ e: "global-timeout", w: null, u: null, d: null });
+function next_job() {
+    var line, job;
+    for (;;) {
+        if (system.stdin.atEnd()) {
+            phantom.exit(0);
+            return;
+        }
+        line = system.stdin.readLine();
+        if (line.trim() !== "")
+            break;
+    }
+    try {
+        job = JSON.parse(line);
+    } catch (e) {
+        console.error("Malformed job: " + line);
+        phantom.exit(1);
+        return;
     }
-    report(page);
-}, 9 * 60 * 1000);
+    start_job(job.url, job.hasOwnProperty("id") ? job.id : null);
+}
 
-navPending = address;
-page.open(address);
+if (server) {
+    system.stdout.writeLine(JSON.stringify({ ready: true, pid: system.pid }));
+    next_job();
+} else {
+    start_job(address, null);
+}
 
 /*global require, console, phantom, setTimeout, clearTimeout */
@@ -0,0 +1,174 @@
+#! /usr/bin/python3
+
+"""Simulate a capture run through aioproxies.ProxySet, with fake
+proxies that inject latency, and compare throughput-aware scheduling
+with scheduling in plain sort-key order.
+
+Usage: sim-proxy-scheduling.py [NLOCS [URLS_PER_LOC [SEED]]]
+
+Each fake proxy is a DirectProxyManager with a random connection
+delay, per-capture latency, and failure rate.  Some of them degrade
+partway through a session (their latency goes up tenfold until they
+are restarted), as OpenVPN endpoints sometimes do.  Timescales are
+compressed: the scheduler's intervals are shrunk so that a run takes
+seconds.  Progress messages from ProxySet go to stderr; redirect it
+to see only the results.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../lib"))
+from shared.aioproxies import ProxySet, DirectProxyManager
+
+TIME_SCALE = 0.01
+
+class FakeProxy(DirectProxyManager):
+    TYPE = 'fake'
+
+    def __init__(self, loop, loc, profile):
+        DirectProxyManager.__init__(self, loop, loc)
+        self.profile = profile
+        self.session_jobs = 0
+
+    @asyncio.coroutine
+    def start(self, ns):
+        yield from asyncio.sleep(self.profile["connect"], loop=self._loop)
+        self.session_jobs = 0
+        yield from DirectProxyManager.start(self, ns)
+
+    @asyncio.coroutine
+    def capture(self, rng):
+        self.session_jobs += 1
+        latency = self.profile["latency"] * rng.uniform(0.5, 1.5)
+        if self.session_jobs > self.profile["degrade_after"]:
+            latency *= 10
+        yield from asyncio.sleep(latency, loop=self._loop)
+        return rng.random() >= self.profile["fail"], latency
+
+class OrderOnlyProxySet(ProxySet):
+    """Sort-key order and no restarts of degraded proxies: what
+       ProxySet did before it kept statistics.  The client's workers
+       are shared equally among the online proxies."""
+    def _expected_work(self, proxies):
+        return [0] * len(proxies)
+    def _stop_degraded_proxies(self):
+        pass
+    def _assign_worker_quotas(self):
+        online = [p for p in self.active_proxies if p.online]
+        for proxy in online:
+            proxy.worker_quota = max(1, self.args.total_workers // len(online))
+
+class Client:
+    def __init__(self, loop, remaining, workers_per_loc, seed):
+        self.loop      = loop
+        self.remaining = remaining
+        self.workers   = workers_per_loc
+        self.rng       = random.Random(seed)
+        self.active    = {}
+        self.captures  = 0
+
+    @asyncio.coroutine
+    def worker(self, proxy, i):
+        while self.remaining[proxy.loc] > 0:
+            if proxy.worker_quota is not None and i >= proxy.worker_quota:
+                yield from asyncio.sleep(0.05, loop=self.loop)
+                continue
+            self.remaining[proxy.loc] -= 1
+            try:
+                ok, elapsed = yield from proxy.capture(self.rng)
+            except asyncio.CancelledError:
+                self.remaining[proxy.loc] += 1
+                raise
+            proxy.stats.note_capture(ok, 50000 if ok else 0, elapsed)
+            if ok:
+                self.captures += 1
+            else:
+                self.remaining[proxy.loc] += 1
+
+    @asyncio.coroutine
+    def run_proxy(self, proxy):
+        workers = [self.loop.create_task(self.worker(proxy, i))
+                   for i in range(self.workers)]
+        try:
+            yield from asyncio.wait(workers, loop=self.loop)
+        except asyncio.CancelledError:
+            for w in workers: w.cancel()
+            yield from asyncio.wait(workers, loop=self.loop)
+            raise
+        proxy.close()
+
+    @asyncio.coroutine
+    def proxy_online(self, proxy):
+        self.active[proxy.loc] = self.loop.create_task(self.run_proxy(proxy))
+
+    @asyncio.coroutine
+    def proxy_offline(self, proxy):
+        job = self.active.pop(proxy.loc, None)
+        if job is not None:
+            job.cancel()
+            try: yield from asyncio.wait_for(job, None)
+            except: pass
+
+def profiles(nlocs, rng):
+    result = {}
+    for i in range(nlocs):
+        result["l{}".format(chr(ord('a') + i % 26) * 2)] = {
+            "connect":       rng.uniform(5, 60) * TIME_SCALE,
+            "latency":       rng.choice([2, 4, 8, 30]) * TIME_SCALE,
+            "fail":          rng.choice([0.02, 0.05, 0.3]),
+            "degrade_after": rng.choice([10**9, 10**9, 100]),
+        }
+    return result
+
+def simulate(cls, config, profs, urls_per_loc, seed):
+    loop = asyncio.new_event_loop()
+    args = argparse.Namespace(locations=config,
+                              max_simultaneous_proxies=3,
+                              total_workers=12,
+                              proxy_start_interval=5 * TIME_SCALE)
+    remaining = { loc: urls_per_loc for loc in profs }
+    # Like the capture dispatchers, sort locations with more work first.
+    pset = cls(args, loop=loop,
+               proxy_sort_key=lambda loc, method: (-remaining[loc], loc),
+               proxy_factory=lambda loop, loc, method, a:
+                   FakeProxy(loop, loc, profs[loc]),
+               remaining_work=remaining.get)
+    pset.STATS_INTERVAL = 30 * TIME_SCALE
+    client = Client(loop, remaining, 8, seed)
+
+    start = time.monotonic()
+    loop.run_until_complete(pset.run(client))
+    elapsed = time.monotonic() - start
+    loop.close()
+    return client.captures, elapsed
+
+def main():
+    nlocs        = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    urls_per_loc = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    seed         = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    profs = profiles(nlocs, random.Random(seed))
+    with tempfile.NamedTemporaryFile("wt", suffix=".cfg") as cfg:
+        for loc in profs:
+            cfg.write("{} fake\n".format(loc))
+        cfg.flush()
+
+        sys.stdout.write("{:>12}  {:>8}  {:>8}  {:>12}\n"
+                         .format("scheduler", "captures", "seconds",
+                                 "captures/sec"))
+        for label, cls in (("sort order", OrderOnlyProxySet),
+                           ("throughput", ProxySet)):
+            captures, elapsed = simulate(cls, cfg.name, profs,
+                                         urls_per_loc, seed)
+            sys.stdout.write("{:>12}  {:>8}  {:>8.2f}  {:>12.1f}\n"
+                             .format(label, captures, elapsed,
+                                     captures / elapsed))
+
+main()